@@ -1,14 +1,21 @@
 import streamlit as st
-from PIL import Image
 import os
+import contextlib
+import functools
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
 
-# Modern UI imports
-from streamlit_extras.metric_cards import style_metric_cards
+# Modern UI imports (plotly is imported by the pages that draw charts)
 from streamlit_extras.colored_header import colored_header
-from streamlit_extras.card import card
 from streamlit_option_menu import option_menu
-import plotly.express as px
-import plotly.graph_objects as go
+
+# Sending, data access and templates live in core.py, which has no UI dependencies
+from core import *
+from core import _parquet_available, _read_file_bytes, _xlsx_available
 
 # Set page config must be the first Streamlit command
 st.set_page_config(
@@ -19,1037 +26,257 @@ st.set_page_config(
 )
 
 # Custom CSS for modern styling
-def load_css():
+@st.cache_data(show_spinner=False)
+def _read_css():
     with open("static/styles.css") as f:
-        st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
+        return f.read()
+
+def load_css():
+    st.markdown(f'<style>{_read_css()}</style>', unsafe_allow_html=True)
 
 # Load modern CSS
 load_css()
 
-# Logo will be added to sidebar
-
-import os
-import sqlite3
-import pandas as pd
-from datetime import datetime
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.mime.application import MIMEApplication
-from email.utils import make_msgid, formatdate
-import time
-import imaplib
-import traceback
-
-DATABASE_FILE = 'compliance_emails.db'
-SMTP_SERVER = "mail.dithetoaccountants.co.za"
-IMAP_SERVER = "mail.dithetoaccountants.co.za"
-SMTP_PORT = 587
-IMAP_PORT = 993
-SENDER_EMAIL = "gamu@dithetoaccountants.co.za"
-
-def init_db():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS companies (
-                UIF_REFERENCE TEXT PRIMARY KEY,
-                TRADE_NAME TEXT,
-                EMAIL_ADDRESS TEXT,
-                PHONE TEXT,
-                emails_sent INTEGER DEFAULT 0,
-                last_sent TEXT,
-                completed INTEGER DEFAULT 0
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_templates (
-                template_key TEXT PRIMARY KEY,
-                subject TEXT,
-                body TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS company_emails (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                UIF_REFERENCE TEXT,
-                EMAIL TEXT,
-                UNIQUE(UIF_REFERENCE, EMAIL)
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_error_logs (
-                error_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                UIF_REFERENCE TEXT,
-                recipient TEXT,
-                stage TEXT,
-                timestamp TEXT,
-                error_type TEXT,
-                error_message TEXT,
-                traceback TEXT
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_logs (
-                log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                UIF_REFERENCE TEXT,
-                timestamp TEXT,
-                date TEXT,
-                subject TEXT,
-                status TEXT,
-                FOREIGN KEY (UIF_REFERENCE) REFERENCES companies(UIF_REFERENCE)
-            )
-        ''')
-        # Migration: ensure completed column exists
-        cursor.execute("PRAGMA table_info(companies)")
-        cols = [row[1] for row in cursor.fetchall()]
-        if 'completed' not in cols:
-            cursor.execute("ALTER TABLE companies ADD COLUMN completed INTEGER DEFAULT 0")
-        if 'PHONE' not in cols:
-            cursor.execute("ALTER TABLE companies ADD COLUMN PHONE TEXT")
-        # Seed default email templates if missing
-        try:
-            defaults = {
-                'initial': {
-                    'subject': 'Initial Request for Documentation – UIF TERS Compliance Audit',
-                    'body': (
-                        """
-                        <!DOCTYPE html>
-                        <html>
-                          <head>
-                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                          </head>
-                          <body>
-                            <p>Good day,</p>
-                            <p>I trust this email finds you well.</p>
-                            <p>My name is Gamu, and I am an Auditor at Ditheto Accountants. We are conducting a compliance review on behalf of the Unemployment Insurance Fund (UIF), regarding the COVID-19 TERS funds disbursed to <strong>{TRADE_NAME}</strong> with UIF Ref Number: <strong>{UIF_REFERENCE}</strong>.</p>
-                            <p>The following documents are required to complete the audit:</p>
-                            <ul>
-                              <li>Bank statements showing receipt of the TERS funds</li>
-                              <li>Proof of payments made to employees</li>
-                              <li>Payroll records or payslips for January to December 2020</li>
-                              <li>2021 IRP5 certificates</li>
-                              <li>EMP501s/201s for the 2020/2021 financial year</li>
-                            </ul>
-                            <p>We fully understand that administrative delays can occur. However, these documents are essential to finalising the audit in line with UIF compliance procedures. Without them, the file remains incomplete and may be subject to further administrative steps.</p>
-                            <p>Kindly forward the requested documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> at your earliest convenience.</p>
-                            <p>Your cooperation in resolving this matter is greatly appreciated.</p>
-                            <p>Kind regards,<br>
-                              <strong>Gamu Dambanjera</strong></p>
-                            <div class="moz-signature"> <img src='cid:signature'></div>
-                          </body>
-                        </html>
-                        """
-                    )
-                },
-                'followup': {
-                    'subject': 'Follow-up: Urgent Action Required – UIF TERS Compliance Audit',
-                    'body': (
-                        """
-                        <!DOCTYPE html>
-                        <html>
-                          <head>
-                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                          </head>
-                          <body>
-                            <p>Dear {TRADE_NAME},</p>
-                            <p>This is a reminder that the requested documentation for the COVID-19 TERS audit is still outstanding. This is an urgent matter that requires your immediate attention.</p>
-                            <p>Failure to provide the necessary documents may result in non-compliance with UIF regulations, which could lead to further administrative actions.</p>
-                            <p>Please submit the required documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> without delay.</p>
-                            <p>Kind regards,<br>
-                              <strong>Gamu Dambanjera</strong></p>
-                            <div class="moz-signature"> <img src='cid:signature'></div>
-                          </body>
-                        </html>
-                        """
-                    )
-                },
-                'final': {
-                    'subject': 'Final Notice: Non-Compliance with UIF TERS Audit Requirements',
-                    'body': (
-                        """
-                        <!DOCTYPE html>
-                        <html>
-                          <head>
-                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                          </head>
-                          <body>
-                            <p>Good day,</p>
-                            <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
-                            <p>Despite multiple attempts to obtain the required documentation, including:</p>
-                            <ol>
-                              <li>Initial audit notification</li>
-                              <li>Detailed information request</li>
-                              <li>Follow-up communication</li>
-                            </ol>
-                            <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
-                            <ul>
-                              <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
-                              <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
-                            </ul>
-                            <h3>NOTICE OF ESCALATION</h3>
-                            <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
-                            <ol>
-                              <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
-                              <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
-                              <li>Potential criminal charges for non-compliance and fraud</li>
-                            </ol>
-                            <h3>REQUIRED IMMEDIATE ACTION</h3>
-                            <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
-                            <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
-                            <p>Kind regards,<br>
-                              <strong>Gamu Dambanjera</strong></p>
-                            <div class="moz-signature"> <img src='cid:signature'></div>
-                          </body>
-                        </html>
-                        """
-                    )
-                }
-            }
-            for k, v in defaults.items():
-                cursor.execute(
-                    "INSERT OR IGNORE INTO email_templates (template_key, subject, body) VALUES (?, ?, ?)",
-                    (k, v['subject'], v['body'])
-                )
-        except Exception:
-            pass
-        # Add test company
-        cursor.execute('''
-            INSERT OR IGNORE INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS) VALUES (?, ?, ?)
-        ''', ('TEST123456', 'Test Company', 'nicknungu@gmail.com'))
-        conn.commit()
-
-def log_send_error(stage, uif_ref, recipient, exc: Exception):
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO email_error_logs (UIF_REFERENCE, recipient, stage, timestamp, error_type, error_message, traceback) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (
-                    uif_ref or '',
-                    recipient or '',
-                    stage,
-                    datetime.now().isoformat(),
-                    type(exc).__name__,
-                    str(exc),
-                    traceback.format_exc()
-                )
-            )
-            conn.commit()
-    except Exception as e:
-        st.error(f"Failed to write error log: {e}")
-
-def get_companies_data():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        df = pd.read_sql_query("SELECT * FROM companies", conn)
-    return df
-
-def get_company_emails(uif_ref):
-    """Return a deduplicated list of all recipient emails for a company.
-    Includes the primary `companies.EMAIL_ADDRESS` and any in `company_emails`.
-    """
-    emails = []
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            # Primary email from companies table
-            cursor.execute("SELECT EMAIL_ADDRESS FROM companies WHERE UIF_REFERENCE = ?", (uif_ref,))
-            row = cursor.fetchone()
-            if row and row[0]:
-                emails.append(row[0].strip())
-            # Additional emails
-            cursor.execute("SELECT EMAIL FROM company_emails WHERE UIF_REFERENCE = ?", (uif_ref,))
-            emails.extend([r[0].strip() for r in cursor.fetchall() if r and r[0]])
-    except Exception:
-        pass
-    # Deduplicate while preserving order
-    seen = set()
-    deduped = []
-    for e in emails:
-        if e and e not in seen:
-            seen.add(e)
-            deduped.append(e)
-    return deduped
-
-def add_additional_email(uif_ref, email):
-    """Add an additional email for a company (no-op if duplicate)."""
-    if not uif_ref or not email:
-        return False, "Missing UIF reference or email"
-    email = email.strip()
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            # Do not add if matches primary (case-insensitive)
-            cursor.execute("SELECT EMAIL_ADDRESS FROM companies WHERE UIF_REFERENCE = ?", (uif_ref,))
-            row = cursor.fetchone()
-            if row and row[0] and row[0].strip().lower() == email.lower():
-                return False, "Email matches the primary address"
-            cursor.execute(
-                "INSERT OR IGNORE INTO company_emails (UIF_REFERENCE, EMAIL) VALUES (?, ?)",
-                (uif_ref, email)
-            )
-            conn.commit()
-        return True, "Email added"
-    except Exception as e:
-        return False, str(e)
-
-def remove_additional_email(uif_ref, email):
-    """Remove an additional email for a company."""
-    if not uif_ref or not email:
-        return False, "Missing UIF reference or email"
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM company_emails WHERE UIF_REFERENCE = ? AND EMAIL = ?",
-                (uif_ref, email)
-            )
-            conn.commit()
-        return True, "Email removed"
-    except Exception as e:
-        return False, str(e)
-
-def _parse_email_candidates(raw_text: str):
-    """Parse a raw string of emails separated by commas, semicolons, or whitespace into unique emails."""
-    if not raw_text:
-        return []
-    separators = [',', ';', '\n', '\t']
-    text = raw_text.strip().replace('\r', ' ')
-    for sep in separators:
-        text = text.replace(sep, ' ')
-    parts = [p.strip() for p in text.split(' ') if p and p.strip()]
-    # Deduplicate preserving order; basic sanity filter
-    seen = set()
-    result = []
-    for p in parts:
-        candidate = p.strip()
-        if candidate and candidate.lower() not in seen:
-            seen.add(candidate.lower())
-            result.append(candidate)
-    return result
-
-def add_additional_emails_bulk(uif_ref: str, raw_text: str):
-    """Add multiple additional emails from a pasted list. Returns summary dict."""
-    emails = _parse_email_candidates(raw_text)
-    added = []
-    skipped_duplicates = []
-    skipped_invalid = []
-    for e in emails:
-        # Basic validation
-        lower = e.lower()
-        if '@' not in lower or '.' not in lower.split('@')[-1]:
-            skipped_invalid.append(e)
-            continue
-        ok, msg = add_additional_email(uif_ref, e)
-        if ok:
-            added.append(e)
-        else:
-            # If duplicate or matches primary, treat as duplicate skip
-            skipped_duplicates.append(e)
-    return {
-        'added': added,
-        'skipped_duplicates': skipped_duplicates,
-        'skipped_invalid': skipped_invalid
-    }
-
-def remove_additional_emails_bulk(uif_ref: str, emails_to_remove: list):
-    """Remove multiple additional emails. Returns summary dict."""
-    removed = []
-    failed = []
-    for email in emails_to_remove:
-        ok, msg = remove_additional_email(uif_ref, email)
-        if ok:
-            removed.append(email)
-        else:
-            failed.append({'email': email, 'error': msg})
-    return {
-        'removed': removed,
-        'failed': failed
-    }
-
-def validate_email_list(emails: list):
-    """Validate a list of emails and return validation results."""
-    valid = []
-    invalid = []
-    for email in emails:
-        email = email.strip()
-        if '@' in email and '.' in email.split('@')[-1] and len(email) > 5:
-            valid.append(email)
-        else:
-            invalid.append(email)
-    return valid, invalid
-
-def update_final_email_template():
-    """Update the final email template in the database with the new content."""
-    new_final_template = {
-        'subject': 'Final Notice: Non-Compliance with UIF TERS Audit Requirements',
-        'body': '''<!DOCTYPE html>
-<html>
-  <head>
-    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-  </head>
-  <body>
-    <p>Good day,</p>
-    <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
-    <p>Despite multiple attempts to obtain the required documentation, including:</p>
-    <ol>
-      <li>Initial audit notification</li>
-      <li>Detailed information request</li>
-      <li>Follow-up communication</li>
-    </ol>
-    <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
-    <ul>
-      <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
-      <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
-    </ul>
-    <h3>NOTICE OF ESCALATION</h3>
-    <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
-    <ol>
-      <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
-      <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
-      <li>Potential criminal charges for non-compliance and fraud</li>
-    </ol>
-    <h3>REQUIRED IMMEDIATE ACTION</h3>
-    <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
-    <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
-    <p>Kind regards,<br>
-      <strong>Gamu Dambanjera</strong></p>
-    <div class="moz-signature"> <img src='cid:signature'></div>
-  </body>
-</html>'''
-    }
-    
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE email_templates SET subject = ?, body = ? WHERE template_key = 'final'",
-                (new_final_template['subject'], new_final_template['body'])
-            )
-            conn.commit()
-        return True, "Final email template updated successfully"
-    except Exception as e:
-        return False, f"Failed to update template: {str(e)}"
-
-def get_bounced_companies():
-    """Get all companies with bounced emails along with their details."""
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            # Get companies with bounced emails
-            bounced_query = """
-                SELECT DISTINCT c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE,
-                       COUNT(el.log_id) as bounce_count,
-                       MAX(el.timestamp) as last_bounce_date,
-                       GROUP_CONCAT(DISTINCT el.subject) as bounced_subjects
-                FROM companies c
-                INNER JOIN email_logs el ON c.UIF_REFERENCE = el.UIF_REFERENCE
-                WHERE el.status = 'Bounced'
-                GROUP BY c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE
-                ORDER BY last_bounce_date DESC
-            """
-            bounced_df = pd.read_sql_query(bounced_query, conn)
-            return bounced_df
-    except Exception as e:
-        st.error(f"Error retrieving bounced companies: {e}")
-        return pd.DataFrame()
-
-def get_failed_companies():
-    """Get all companies with failed emails along with their details."""
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            # Get companies with failed emails
-            failed_query = """
-                SELECT DISTINCT c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE,
-                       COUNT(el.log_id) as failure_count,
-                       MAX(el.timestamp) as last_failure_date,
-                       GROUP_CONCAT(DISTINCT el.subject) as failed_subjects
-                FROM companies c
-                INNER JOIN email_logs el ON c.UIF_REFERENCE = el.UIF_REFERENCE
-                WHERE el.status = 'Failed'
-                GROUP BY c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE
-                ORDER BY last_failure_date DESC
-            """
-            failed_df = pd.read_sql_query(failed_query, conn)
-            return failed_df
-    except Exception as e:
-        st.error(f"Error retrieving failed companies: {e}")
-        return pd.DataFrame()
-
-def get_unreachable_companies():
-    """Get comprehensive list of all unreachable companies (bounced + failed)."""
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            # Get companies with any email delivery issues
-            unreachable_query = """
-                SELECT DISTINCT c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE,
-                       COUNT(CASE WHEN el.status = 'Bounced' THEN 1 END) as bounce_count,
-                       COUNT(CASE WHEN el.status = 'Failed' THEN 1 END) as failure_count,
-                       COUNT(el.log_id) as total_issues,
-                       MAX(el.timestamp) as last_issue_date,
-                       GROUP_CONCAT(DISTINCT CASE WHEN el.status = 'Bounced' THEN el.subject END) as bounced_subjects,
-                       GROUP_CONCAT(DISTINCT CASE WHEN el.status = 'Failed' THEN el.subject END) as failed_subjects
-                FROM companies c
-                INNER JOIN email_logs el ON c.UIF_REFERENCE = el.UIF_REFERENCE
-                WHERE el.status IN ('Bounced', 'Failed')
-                GROUP BY c.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE
-                ORDER BY last_issue_date DESC, total_issues DESC
-            """
-            unreachable_df = pd.read_sql_query(unreachable_query, conn)
-            return unreachable_df
-    except Exception as e:
-        st.error(f"Error retrieving unreachable companies: {e}")
-        return pd.DataFrame()
-
-def export_unreachable_companies():
-    """Export unreachable companies to CSV format."""
-    try:
-        df = get_unreachable_companies()
-        if not df.empty:
-            csv_data = df.to_csv(index=False).encode('utf-8')
-            return csv_data
-        else:
-            return None
-    except Exception as e:
-        st.error(f"Error exporting unreachable companies: {e}")
-        return None
-
-def log_email(uif_reference, subject, status):
-    """Log email activity to the database"""
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            date = datetime.now().strftime('%Y-%m-%d')
-            cursor.execute(
-                "INSERT INTO email_logs (UIF_REFERENCE, timestamp, date, subject, status) VALUES (?, ?, ?, ?, ?)",
-                (uif_reference, timestamp, date, subject, status)
-            )
-            conn.commit()
-    except Exception as e:
-        st.warning(f"Failed to log email activity: {e}")
-
-def get_email_logs(uif_ref=None):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        if uif_ref:
-            df = pd.read_sql_query(f"SELECT * FROM email_logs WHERE UIF_REFERENCE = '{uif_ref}'", conn)
-        else:
-            df = pd.read_sql_query("SELECT * FROM email_logs", conn)
-    return df
-
-def get_error_logs(uif_ref=None):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        try:
-            if uif_ref:
-                df = pd.read_sql_query(
-                    f"SELECT * FROM email_error_logs WHERE UIF_REFERENCE = '{uif_ref}' ORDER BY error_id DESC",
-                    conn
-                )
-            else:
-                df = pd.read_sql_query(
-                    "SELECT * FROM email_error_logs ORDER BY error_id DESC",
-                    conn
-                )
-        except Exception:
-            # Table might not exist yet
-            df = pd.DataFrame()
-    return df
-
-def upsert_company(uif_ref, trade_name, email_address, phone=None):
-    """Insert or update a company record."""
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, PHONE) VALUES (?, ?, ?, ?)",
-                (uif_ref, trade_name, email_address, phone)
-            )
-            conn.commit()
-        return True, "Company upserted successfully"
-    except Exception as e:
-        return False, str(e)
-
-def append_signature(body):
-    signature_image_path = "Email Signature/asignature1.png"
-    signature = f"<br><br><img src='cid:signature'><br>"
-    return body + signature
-
-def _list_mailbox_names(mail: imaplib.IMAP4_SSL):
-    names = []
-    try:
-        typ, mailboxes = mail.list()
-        if typ == 'OK' and mailboxes:
-            for mb in mailboxes:
-                decoded = mb.decode(errors='ignore') if isinstance(mb, bytes) else str(mb)
-                # Mailbox name is typically the last quoted string; fallback to last token
-                if ' "' in decoded:
-                    name = decoded.split(' "')[-1].rstrip('"')
-                else:
-                    name = decoded.split()[-1].strip('"')
-                if name:
-                    names.append(name)
-    except Exception:
-        return names
-    return names
+def _streamlit_notifier(level, message):
+    getattr(st, level)(message)
 
-def _find_sent_folder(mail: imaplib.IMAP4_SSL) -> str:
-    """Try to detect and select an existing Sent folder; return a usable name if selectable."""
-    try:
-        names = _list_mailbox_names(mail)
-        # Rank candidates: special-use names first, then common names
-        preferred = []
-        for nm in names:
-            lower = nm.lower()
-            if 'sent' in lower:
-                preferred.append(nm)
-        # Add common static candidates as a fallback order
-        preferred.extend([
-            'Sent', 'Sent Items', 'Sent Mail', 'INBOX.Sent'
-        ])
-        # Deduplicate preserving order
-        seen = set()
-        ordered = [x for x in preferred if not (x in seen or seen.add(x))]
-        for cand in ordered:
-            typ, _ = mail.select(cand, readonly=True)
-            if typ == 'OK':
-                try:
-                    mail.close()
-                except Exception:
-                    pass
-                return cand
-    except Exception:
-        pass
-    return ''
+# Messages from core functions (attachment warnings, send errors, dry-run previews) render on the page
+set_notifier(_streamlit_notifier)
 
-def append_email_to_sent_folder(msg, smtp_password):
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(SENDER_EMAIL, smtp_password)
-        sent_folder = _find_sent_folder(mail)
-        # If we couldn't select an existing one, create a simple 'Sent' folder
-        if not sent_folder:
-            simple_name = 'Sent'
-            try:
-                mail.create(simple_name)
-            except Exception:
-                # If create fails, we cannot proceed safely
-                raise
-            mail.select(simple_name)
-            target_mailbox = simple_name
-        else:
-            mail.select(sent_folder)
-            target_mailbox = sent_folder
-        mail.append(target_mailbox, '(\\Seen)', imaplib.Time2Internaldate(time.localtime()), msg.as_bytes())
-        mail.logout()
-    except Exception as e:
-        st.error(f"Failed to append email to Sent folder: {e}")
-        try:
-            recipient = msg.get('To', '')
-            uif_ref = None
-        except Exception:
-            recipient = ''
-            uif_ref = None
-        log_send_error('IMAP Append to Sent', uif_ref, recipient, e)
-
-def send_email(recipient_email, subject, body, smtp_password, dry_run=False, uif_reference=None, emails_sent=0):
-    # Support one or many recipients; normalize to list for sending, keep header readable
-    if isinstance(recipient_email, (list, tuple, set)):
-        recipient_list = [e for e in list(recipient_email) if e]
-        recipient_header = ", ".join(recipient_list)
-    else:
-        recipient_list = [recipient_email] if recipient_email else []
-        recipient_header = recipient_email
-
-    if dry_run:
-        st.info(f"DRY RUN: Would send email to {recipient_header} with subject: {subject}")
-        st.code(body)
-        return True
-
-    msg = MIMEMultipart()
-    msg["From"] = SENDER_EMAIL
-    msg["To"] = recipient_header
-    # Do not BCC self; we'll append the message to Sent via IMAP
-    msg["Subject"] = subject
-    msg["Date"] = formatdate(localtime=True)
-    if not msg.get('Message-ID'):
-        msg['Message-ID'] = make_msgid()
-    msg.attach(MIMEText(append_signature(body), "html"))
-    signature_image_path = "Email Signature/asignature1.png"
-    try:
-        with open(signature_image_path, 'rb') as img:
-            mime_img = MIMEImage(img.read(), _subtype="png")
-            mime_img.add_header('Content-ID', '<signature>')
-            msg.attach(mime_img)
-    except Exception as e:
-        st.warning(f"Signature image not attached: {e}")
+# Logo will be added to sidebar
 
-    # Attach the PDF
-    pdf_path = "Ditheto Accountants - Appointment Letter and Audit Notification.pdf"
-    try:
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_attachment = MIMEApplication(pdf_file.read(), _subtype="pdf")
-            pdf_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(pdf_path))
-            msg.attach(pdf_attachment)
-    except Exception as e:
-        st.warning(f"PDF not attached: {e}")
+def render_export_buttons(kind, filters, label, file_stem, key):
+    """CSV (and XLSX when openpyxl is installed) download buttons that only build the file when clicked."""
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    st.download_button(
+        label=f"📥 {label} (CSV)",
+        data=lambda: export_bytes(kind, filters, 'csv'),
+        file_name=f"{file_stem}_{stamp}.csv",
+        mime="text/csv",
+        key=f"{key}_csv",
+        on_click="ignore",
+        use_container_width=True
+    )
+    if _xlsx_available():
+        st.download_button(
+            label=f"📥 {label} (XLSX)",
+            data=lambda: export_bytes(kind, filters, 'xlsx'),
+            file_name=f"{file_stem}_{stamp}.xlsx",
+            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            key=f"{key}_xlsx",
+            on_click="ignore",
+            use_container_width=True
+        )
 
-    # Attach the Letter of demand PDF for 3rd email onwards (emails_sent >= 2)
-    if emails_sent >= 2:
-        demand_letter_path = "Letter of demand _UIF TERS Audit_250729_150955.pdf"
-        try:
-            with open(demand_letter_path, 'rb') as demand_file:
-                demand_attachment = MIMEApplication(demand_file.read(), _subtype="pdf")
-                demand_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(demand_letter_path))
-                msg.attach(demand_attachment)
-                st.info(f"Letter of demand attached for email #{emails_sent + 1}")
-        except Exception as e:
-            st.warning(f"Letter of demand PDF not attached: {e}")
-
-    # Attach company-specific summaries using UIF reference from multiple folders (Phase 4 and Phase 3)
-    if uif_reference and uif_reference != "TEST-UIF-REF":
-        summary_folders = [
-            "PHASE 4 - Employer Claims Summaries",
-            "Phase 3 - Employer Claims Summaries",
-        ]
-        # Clean the UIF reference to match the filename format
-        clean_uif = uif_reference.replace('/', '_').replace('\\', '_')
-        attached_any = False
-        attached_paths = set()
-        for folder in summary_folders:
+def profile_when_requested(target):
+    """Decorator: profile the call when this session armed a capture for `target` (see the sidebar Profiling panel)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            request = st.session_state.get('profile_request')
+            if not request or request['target'] != target:
+                return func(*args, **kwargs)
+            del st.session_state['profile_request']
+            capture = start_profile(f"{target}-{func.__name__}", request['mode'])
             try:
-                if not os.path.isdir(folder):
-                    continue
-                summary_files = [f for f in os.listdir(folder) if clean_uif in f and f.endswith('.xlsx')]
-                for summary_filename in summary_files:
-                    summary_path = os.path.join(folder, summary_filename)
-                    if summary_path in attached_paths:
-                        continue
-                    try:
-                        with open(summary_path, 'rb') as summary_file:
-                            summary_attachment = MIMEApplication(summary_file.read(), _subtype="xlsx")
-                            summary_attachment.add_header(
-                                'Content-Disposition',
-                                'attachment',
-                                filename=summary_filename
-                            )
-                            msg.attach(summary_attachment)
-                            attached_paths.add(summary_path)
-                            attached_any = True
-                    except Exception as e:
-                        st.error(f"Error attaching summary file '{summary_filename}' for {uif_reference}: {e}")
-            except Exception as e:
-                st.warning(f"Could not scan folder '{folder}' for summaries: {e}")
-        if not attached_any:
-            st.warning(f"No summary files found for UIF reference: {uif_reference}")
-    else:
-        st.info("Skipping summary attachment for test email")
-
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, smtp_password)
-            # Use sendmail with explicit recipient list for multi-recipient reliability
-            server.sendmail(SENDER_EMAIL, recipient_list, msg.as_string())
-        append_email_to_sent_folder(msg, smtp_password)
-        return True
-    except smtplib.SMTPRecipientsRefused as e:
-        st.error(f"Email to {recipient_email} bounced: {e}")
-        log_email(uif_reference, subject, "Bounced")
-        log_send_error('SMTP Send (RecipientsRefused)', uif_reference, recipient_email, e)
-        return False
-    except Exception as e:
-        st.error(f"Error sending email to {recipient_email}: {e}")
-        log_send_error('SMTP Send', uif_reference, recipient_email, e)
-        return False
-
-def send_test_email(smtp_password, dry_run=False):
-    # Use the first company as an example for the test email
-    uif_reference = "TEST-UIF-REF"
-    trade_name = "Test Company"
-    emails_sent = 0  # Use initial email template
-    
-    subject, body = get_email_template(uif_reference, trade_name, emails_sent)
-    body = append_signature(body)
-    
-    return send_email("nicknungu@gmail.com", subject, body, smtp_password, dry_run, uif_reference, emails_sent)
-
-def test_smtp_connection(smtp_password):
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SENDER_EMAIL, smtp_password)
-        return True, "SMTP connection successful!"
-    except Exception as e:
-        return False, f"SMTP connection failed: {e}"
-
-def get_email_template(uif_reference, trade_name, emails_sent):
-    # Determine template key
-    if emails_sent == 0:
-        template_key = 'initial'
-    elif 1 <= emails_sent < 10:
-        template_key = 'followup'
-    else:
-        template_key = 'final'
-
-    subject = None
-    body = None
-    try:
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            df_tpl = pd.read_sql_query(
-                f"SELECT subject, body FROM email_templates WHERE template_key = '{template_key}'",
-                conn
-            )
-            if not df_tpl.empty:
-                subject = df_tpl.iloc[0]['subject'] or ''
-                body = df_tpl.iloc[0]['body'] or ''
-    except Exception:
-        subject = None
-        body = None
-
-    # Fallback to built-in defaults if DB missing
-    if not subject or not body:
-        if template_key == 'initial':
-            subject = "Initial Request for Documentation – UIF TERS Compliance Audit"
-            body = (
-                """
-                <!DOCTYPE html>
-                <html>
-                  <head>
-                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                  </head>
-                  <body>
-                    <p>Good day,</p>
-                    <p>I trust this email finds you well.</p>
-                    <p>My name is Gamu, and I am an Auditor at Ditheto Accountants. We are conducting a compliance review on behalf of the Unemployment Insurance Fund (UIF), regarding the COVID-19 TERS funds disbursed to <strong>{TRADE_NAME}</strong> with UIF Ref Number: <strong>{UIF_REFERENCE}</strong>.</p>
-                    <p>The following documents are required to complete the audit:</p>
-                    <ul>
-                      <li>Bank statements showing receipt of the TERS funds</li>
-                      <li>Proof of payments made to employees</li>
-                      <li>Payroll records or payslips for January to December 2020</li>
-                      <li>2021 IRP5 certificates</li>
-                      <li>EMP501s/201s for the 2020/2021 financial year</li>
-                    </ul>
-                    <p>We fully understand that administrative delays can occur. However, these documents are essential to finalising the audit in line with UIF compliance procedures. Without them, the file remains incomplete and may be subject to further administrative steps.</p>
-                    <p>Kindly forward the requested documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> at your earliest convenience.</p>
-                    <p>Your cooperation in resolving this matter is greatly appreciated.</p>
-                    <p>Kind regards,<br>
-                      <strong>Gamu Dambanjera</strong></p>
-                    <div class="moz-signature"> <img src='cid:signature'></div>
-                  </body>
-                </html>
-                """
-            )
-        elif template_key == 'followup':
-            subject = "Follow-up: Urgent Action Required – UIF TERS Compliance Audit"
-            body = (
-                """
-                <!DOCTYPE html>
-                <html>
-                  <head>
-                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                  </head>
-                  <body>
-                    <p>Dear {TRADE_NAME},</p>
-                    <p>This is a reminder that the requested documentation for the COVID-19 TERS audit is still outstanding. This is an urgent matter that requires your immediate attention.</p>
-                    <p>Failure to provide the necessary documents may result in non-compliance with UIF regulations, which could lead to further administrative actions.</p>
-                    <p>Please submit the required documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> without delay.</p>
-                    <p>Kind regards,<br>
-                      <strong>Gamu Dambanjera</strong></p>
-                    <div class="moz-signature"> <img src='cid:signature'></div>
-                  </body>
-                </html>
-                """
-            )
-        else:
-            subject = "Final Notice: Non-Compliance with UIF TERS Audit Requirements"
-            body = (
-                """
-                <!DOCTYPE html>
-                <html>
-                  <head>
-                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
-                  </head>
-                  <body>
-                    <p>Good day,</p>
-                    <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
-                    <p>Despite multiple attempts to obtain the required documentation, including:</p>
-                    <ol>
-                      <li>Initial audit notification</li>
-                      <li>Detailed information request</li>
-                      <li>Follow-up communication</li>
-                    </ol>
-                    <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
-                    <ul>
-                      <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
-                      <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
-                    </ul>
-                    <h3>NOTICE OF ESCALATION</h3>
-                    <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
-                    <ol>
-                      <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
-                      <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
-                      <li>Potential criminal charges for non-compliance and fraud</li>
-                    </ol>
-                    <h3>REQUIRED IMMEDIATE ACTION</h3>
-                    <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
-                    <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
-                    <p>Kind regards,<br>
-                      <strong>Gamu Dambanjera</strong></p>
-                    <div class="moz-signature"> <img src='cid:signature'></div>
-                  </body>
-                </html>
-                """
-            )
-
-    # Replace placeholders
-    placeholder_values = {
-        'UIF_REFERENCE': uif_reference,
-        'TRADE_NAME': trade_name,
-    }
-    def replace_placeholders(text):
-        try:
-            for k, v in placeholder_values.items():
-                text = text.replace('{' + k + '}', str(v))
-            return text
-        except Exception:
-            return text
-
-    subject_final = replace_placeholders(subject)
-    body_final = replace_placeholders(body)
-    return subject_final, body_final
-
-def get_daily_email_count(date=None):
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        if date is None:
-            date = datetime.now().strftime('%Y-%m-%d')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM email_logs WHERE date = ? AND status = 'Sent'", (date,))
-        return cursor.fetchone()[0]
-
-def get_email_stats():
-    with sqlite3.connect(DATABASE_FILE) as conn:
-        cursor = conn.cursor()
-        # Get today's count
-        today = datetime.now().strftime('%Y-%m-%d')
-        cursor.execute("SELECT COUNT(*) FROM email_logs WHERE date = ? AND status = 'Sent'", (today,))
-        today_count = cursor.fetchone()[0]
-        
-        # Get total count
-        cursor.execute("SELECT COUNT(*) FROM email_logs WHERE status = 'Sent'")
-        total_count = cursor.fetchone()[0]
-        
-        # Get daily breakdown for last 7 days
-        cursor.execute("""
-            SELECT date, COUNT(*) as count 
-            FROM email_logs 
-            WHERE status = 'Sent' AND date >= date('now', '-7 days')
-            GROUP BY date 
-            ORDER BY date DESC
-        """)
-        daily_breakdown = cursor.fetchall()
-        
-        return {
-            'today_count': today_count,
-            'total_count': total_count,
-            'daily_breakdown': daily_breakdown
-        }
-
-def send_follow_up_emails(selected_companies_df, smtp_password, dry_run, email_type="Auto (Based on current count)"):
+                return func(*args, **kwargs)
+            finally:
+                summary = stop_profile(capture)
+                st.session_state['profile_last'] = summary['label']
+        return wrapper
+    return decorator
+
+@profile_when_requested('send')
+def send_follow_up_emails(selected_companies_df, smtp_password, dry_run, email_type="Auto (Based on current count)", breaker=None, batch_key=None):
     progress_text = st.empty()
     progress_bar = st.progress(0)
+    breaker = breaker or new_circuit_breaker()
+    batch_key = batch_key or manual_batch_key()
+    circuit_given_up = False
     total_companies = len(selected_companies_df)
     first_iter_index = None
-    last_iter_index = None
     try:
         indices_list = list(selected_companies_df.index)
         first_iter_index = indices_list[0] if indices_list else None
-        last_iter_index = indices_list[-1] if indices_list else None
     except Exception:
         first_iter_index = None
-        last_iter_index = None
-
-    for i, row in selected_companies_df.iterrows():
-        uif_reference = row["UIF_REFERENCE"]
-        trade_name = row["TRADE_NAME"]
-        email_address = row["EMAIL_ADDRESS"]
-        current_emails_sent = row["emails_sent"]
-        is_completed = False
-        if "completed" in row:
-            try:
-                is_completed = int(row["completed"]) == 1
-            except Exception:
-                is_completed = False
+
+    # Lease the whole selection before rendering anything, so another operator's batch skips these companies
+    selected_refs = selected_companies_df["UIF_REFERENCE"].tolist()
+    leases = contextlib.nullcontext(set(selected_refs)) if dry_run else company_leases(
+        selected_refs, get_lease_holder(), label="Send Emails page"
+    )
+    with leases as leased:
+        # Re-read completed/paused flags and counts: the reply watcher or another session may have changed them since the grid was rendered
+        current_states = get_company_states(selected_refs) if total_companies else {}
+        # Resolve every recipient (minus suppressed addresses) up front in a few queries
+        try:
+            resolved_recipients = resolve_company_recipients(selected_refs) if total_companies else {}
+        except Exception as e:
+            st.error(f"⛔ Could not check recipients against the suppression list, so nothing was sent: {e}")
+            progress_text.empty()
+            progress_bar.empty()
+            return
+
+        for i, row in selected_companies_df.iterrows():
+            attempted_send = False
+            uif_reference = row["UIF_REFERENCE"]
+            trade_name = row["TRADE_NAME"]
+            current_emails_sent = row["emails_sent"]
+            is_completed = False
+            if "completed" in row:
+                try:
+                    is_completed = int(row["completed"]) == 1
+                except Exception:
+                    is_completed = False
+            is_paused = False
+            if "paused" in row:
+                try:
+                    is_paused = int(row["paused"]) == 1
+                except Exception:
+                    is_paused = False
+            if uif_reference in current_states:
+                is_completed = is_completed or current_states[uif_reference]['completed']
+                is_paused = is_paused or current_states[uif_reference]['paused']
+                current_emails_sent = current_states[uif_reference]['emails_sent']
         
-        # Determine which email to send based on email_type selection
-        if email_type == "Auto (Based on current count)":
-            email_count_to_use = current_emails_sent
-        elif email_type == "Initial Email (Override count)":
-            email_count_to_use = 0
-        else:
-            # Extract follow-up number from selection
-            follow_up_num = int(email_type.split("#")[1].split()[0]) if "#" in email_type else 0
-            email_count_to_use = follow_up_num
-
-        if is_completed:
-            status_message = f"🟢 Skipped {trade_name} (UIF Ref: {uif_reference}): Marked as completed."
-            st.info(status_message)
-            log_email(uif_reference, "N/A", "Skipped - Completed")
-        else:
-            # Show warning if this is beyond the 10th email
-            if current_emails_sent >= 10:
-                warning_message = f"⚠️ WARNING: {trade_name} (UIF Ref: {uif_reference}) has already received {current_emails_sent} emails. Proceeding with email #{current_emails_sent + 1}..."
-                st.warning(warning_message)
+            # Determine which email to send based on email_type selection
+            email_count_to_use = email_step_for_type(email_type, current_emails_sent)
+
+            if uif_reference not in leased:
+                st.info(f"🔒 Skipped {trade_name} (UIF Ref: {uif_reference}): another session is sending to this company right now.")
+            elif is_completed:
+                status_message = f"🟢 Skipped {trade_name} (UIF Ref: {uif_reference}): Marked as completed."
+                st.info(status_message)
+                log_email(uif_reference, "N/A", "Skipped - Completed")
+            elif is_paused:
+                status_message = f"🟡 Skipped {trade_name} (UIF Ref: {uif_reference}): Paused after a reply was received."
+                st.info(status_message)
+                log_email(uif_reference, "N/A", "Skipped - Paused")
+            elif resolved_recipients.get(uif_reference, {}).get('suppressed') and not resolved_recipients[uif_reference]['recipients']:
+                suppressed_count = len(resolved_recipients[uif_reference]['suppressed'])
+                status_message = f"⛔ Skipped {trade_name} (UIF Ref: {uif_reference}): all {suppressed_count} recipient(s) are suppressed after hard bounces."
+                st.warning(status_message)
+                log_email(uif_reference, "N/A", "Skipped - Suppressed")
+            else:
+                # Show warning if this is beyond the 10th email
+                if current_emails_sent >= 10:
+                    warning_message = f"⚠️ WARNING: {trade_name} (UIF Ref: {uif_reference}) has already received {current_emails_sent} emails. Proceeding with email #{current_emails_sent + 1}..."
+                    st.warning(warning_message)
             
-            # Proceed with email sending for all non-completed companies
-            subject, body = get_email_template(uif_reference, trade_name, email_count_to_use)
-            if subject and body:
-                recipients = get_company_emails(uif_reference)
-                if not recipients:
-                    recipients = [email_address] if pd.notna(email_address) and email_address else []
-                attempted_send = False
-                if recipients:
-                    if send_email(recipients, subject, body, smtp_password, dry_run, uif_reference, email_count_to_use):
+                # Proceed with email sending for all non-completed companies
+                subject, body = get_email_template(uif_reference, trade_name, email_count_to_use)
+                if subject and body:
+                    # The primary address is part of the resolved list; never send around the suppression check
+                    recipients = resolved_recipients.get(uif_reference, {}).get('recipients', [])
+                    if recipients and not dry_run and breaker['state'] == 'open' and not circuit_given_up:
+                        # Relay is failing: stop burning connects and probe until it recovers
+                        circuit_placeholder = st.empty()
+                        circuit_placeholder.error(f"⛔ Sending paused: SMTP relay errors ({breaker['last_error']}). Probing connection...")
+                        recovered = circuit_wait_for_recovery(
+                            breaker, smtp_password,
+                            on_probe=lambda attempt, ok, message, remaining: circuit_placeholder.warning(
+                                f"⛔ Sending paused — probe #{attempt}: {message} ({remaining}s until the batch is deferred)"
+                            )
+                        )
+                        circuit_placeholder.empty()
+                        if recovered:
+                            st.info("🔌 SMTP relay is healthy again; resuming the batch")
+                        else:
+                            circuit_given_up = True
+                            st.error("⛔ SMTP relay did not recover; remaining companies are queued for retry")
+                    if recipients and circuit_given_up:
+                        retry_at = schedule_retry(
+                            uif_reference, email_count_to_use, recipients, f"Circuit open: {breaker['last_error']}", campaign=batch_key
+                        )
+                        set_next_due([uif_reference])
+                        st.warning(f"⏳ Deferred {trade_name} (UIF Ref: {uif_reference}) while the relay is unavailable; retry at {retry_at:%H:%M}")
+                        log_email(uif_reference, subject, "Deferred")
+                    elif recipients and not dry_run and not claim_send(uif_reference, email_count_to_use, batch_key, single_step=True):
+                        # A rerun, double click or parallel worker already sent this company a step in this batch, or has one in flight
+                        st.info(f"🔁 Skipped {trade_name} (UIF Ref: {uif_reference}): already emailed from this page today, or a send is in flight.")
+                        log_email(uif_reference, subject, "Skipped - Duplicate")
+                    elif recipients:
+                        if not dry_run:
+                            # Timed only once the claim is won; record_send_outcome closes the record
+                            begin_send_metrics()
+                        result = send_email_detailed(recipients, subject, body, smtp_password, dry_run, uif_reference, email_count_to_use, record=False)
                         attempted_send = True
-                        email_type_display = f" ({email_type})" if email_type != "Auto (Based on current count)" else ""
-                        st.success(f"✅ Email sent to {trade_name} (UIF Ref: {uif_reference}){email_type_display} — {len(recipients)} recipient(s)")
                         if not dry_run:
-                            log_email(uif_reference, subject, "Sent")
+                            circuit_record(breaker, result['ok'], result.get('provider_error'), result['error'])
+                        if result['ok']:
+                            email_type_display = f" ({email_type})" if email_type != "Auto (Based on current count)" else ""
+                            st.success(f"✅ Email sent to {trade_name} (UIF Ref: {uif_reference}){email_type_display} — {len(recipients)} recipient(s)")
+                            if not dry_run:
+                                record_send_outcome(uif_reference, subject, "Sent", result, email_count_to_use, batch_key)
+                        elif dry_run:
+                            st.error(f"❌ Failed to send email to {trade_name} (UIF Ref: {uif_reference})")
+                        else:
+                            retry_at = None
+                            if result['status'] == 'Deferred':
+                                retry_at = schedule_retry(uif_reference, email_count_to_use, recipients, result['error'], campaign=batch_key)
+                            if retry_at:
+                                st.warning(f"⏳ Temporary failure for {trade_name} (UIF Ref: {uif_reference}); retry scheduled for {retry_at:%H:%M}")
+                                outcome_status = "Deferred"
+                            else:
+                                st.error(f"❌ Failed to send email to {trade_name} (UIF Ref: {uif_reference})")
+                                outcome_status = "Bounced" if result['status'] == 'Bounced' else "Failed"
+                            record_send_outcome(uif_reference, subject, outcome_status, result, email_count_to_use, batch_key)
                     else:
-                        attempted_send = True
-                        st.error(f"❌ Failed to send email to {trade_name} (UIF Ref: {uif_reference})")
-                        log_email(uif_reference, subject, "Failed")
-            else:
-                status_message = f"❌ Skipped {trade_name} (UIF Ref: {uif_reference}): No email template found for this count."
-                st.warning(status_message)
-                log_email(uif_reference, "N/A", "Skipped - No template")
+                        st.warning(f"❌ Skipped {trade_name} (UIF Ref: {uif_reference}): No recipient address on file.")
+                        log_email(uif_reference, "N/A", "Skipped - No recipients")
+                else:
+                    status_message = f"❌ Skipped {trade_name} (UIF Ref: {uif_reference}): No email template found for this count."
+                    st.warning(status_message)
+                    log_email(uif_reference, "N/A", "Skipped - No template")
 
-        progress_bar.progress(min(1.0, max(0.0, (i + 1) / total_companies)))
-        progress_text.text(f"Processing company {i + 1} of {total_companies}")
+            progress_bar.progress(min(1.0, max(0.0, (i + 1) / total_companies)))
+            progress_text.text(f"Processing company {i + 1} of {total_companies}")
 
-        # Enforce 15-second interval between sends to avoid provider flags
-        # First email is sent immediately, delay applies from 2nd email onwards
-        if not dry_run:
-            try:
-                if (
-                    'attempted_send' in locals()
-                    and attempted_send
-                    and (first_iter_index is None or i != first_iter_index)
-                ):
-                    countdown_placeholder = st.empty()
-                    for remaining in range(15, 0, -1):
-                        countdown_placeholder.info(f"Waiting {remaining} seconds before next email...")
-                        time.sleep(1)
-                    countdown_placeholder.empty()
-            except Exception:
-                # Fallback to a single sleep if UI countdown fails
-                time.sleep(15)
+            # Enforce 15-second interval between sends to avoid provider flags
+            # First email is sent immediately, delay applies from 2nd email onwards
+            if not dry_run:
+                try:
+                    if (
+                        attempted_send
+                        and breaker['state'] != 'open'
+                        and (first_iter_index is None or i != first_iter_index)
+                    ):
+                        countdown_placeholder = st.empty()
+                        for remaining in range(SEND_INTERVAL_SECONDS, 0, -1):
+                            countdown_placeholder.info(f"Waiting {remaining} seconds before next email...")
+                            time.sleep(1)
+                        countdown_placeholder.empty()
+                except Exception:
+                    # Fallback to a single sleep if UI countdown fails
+                    time.sleep(SEND_INTERVAL_SECONDS)
 
+    flush_log_buffer()
     progress_text.empty()
     progress_bar.empty()
     st.success("Email sending process completed!")
 
+@st.cache_resource
+def _init_database():
+    """Create and migrate the schema once per process rather than on every rerun."""
+    init_db()
+    return True
+
 # Initialize database
-init_db()
+_init_database()
+# Land anything buffered by a previous run or a worker thread before the page reads it
+flush_log_buffer()
+if LOG_BUFFER['last_error']:
+    st.warning(f"Buffered log rows could not be written yet: {LOG_BUFFER['last_error']}")
+if LOG_BUFFER['dead_letters']:
+    st.error(f"{LOG_BUFFER['dead_letters']} buffered write(s) were rejected by the database and saved to {LOG_DEAD_LETTER_FILE}")
+metrics_exporter = start_metrics_exporter()
+
+# A page-render capture cut short by st.rerun()/st.stop() is saved as-is on the next run
+if 'page_profile' in st.session_state:
+    stop_profile(st.session_state.pop('page_profile'), label="render-interrupted")
+if st.session_state.get('profile_request', {}).get('target') == 'render':
+    st.session_state['page_profile'] = start_profile("render", st.session_state.pop('profile_request')['mode'])
 
 # Modern UI Main Section
 st.markdown('''
@@ -1081,14 +308,13 @@ div[data-testid="stSidebar"] {
 """, unsafe_allow_html=True)
 
 # Add logo to sidebar with modern styling
-try:
-    logo = Image.open("GD logo.png")
+if os.path.exists("GD logo.png"):
     st.sidebar.markdown('<div class="sidebar-header">', unsafe_allow_html=True)
     col1, col2, col3 = st.sidebar.columns([1, 2, 1])
     with col2:
-        st.image(logo, width=120)
+        st.image("GD logo.png", width=120)
     st.sidebar.markdown('</div>', unsafe_allow_html=True)
-except Exception as e:
+else:
     st.sidebar.markdown('<div class="sidebar-header"><h3>Ditheto Accountants</h3></div>', unsafe_allow_html=True)
 if 'current_page' not in st.session_state:
     st.session_state.current_page = 'dashboard'
@@ -1177,8 +403,277 @@ with col2:
 
 # Dry Run Mode Toggle with modern styling
 dry_run = st.sidebar.checkbox("🧪 Dry Run Mode", help="Preview emails without sending")
+if metrics_exporter['error'] or metrics_exporter['file_error']:
+    st.sidebar.caption(f"📡 {metrics_exporter['error'] or metrics_exporter['file_error']}")
+elif metrics_exporter['url']:
+    st.sidebar.caption(f"📡 Metrics: {metrics_exporter['url']}")
 st.sidebar.markdown('</div>', unsafe_allow_html=True)
 
+# Reply detection: pause or complete companies that reply so follow-ups stop automatically
+with st.sidebar.expander("📥 Reply Detection"):
+    reply_action_label = st.selectbox(
+        "When a company replies",
+        ["Pause follow-ups", "Mark as completed"],
+        help="Replies are matched by sender address, In-Reply-To or References"
+    )
+    reply_action = 'complete' if reply_action_label == "Mark as completed" else 'pause'
+
+    if st.button("🔍 Check Replies Now", use_container_width=True):
+        if smtp_password:
+            try:
+                result = scan_inbox_for_replies(smtp_password, action=reply_action)
+                st.success(f"Checked {result['checked']} message(s), updated {len(result['updated'])} company(ies)")
+                if result['bounces']:
+                    st.info(f"Processed {result['bounces']} bounce(s); {result['suppressed']} address(es) suppressed")
+                if result['ambiguous']:
+                    st.warning(f"{result['ambiguous']} reply(ies) matched several companies; review in Company Management")
+            except Exception as e:
+                st.error(f"Reply check failed: {e}")
+                log_send_error('IMAP Reply Check', None, SENDER_EMAIL, e)
+        else:
+            st.error("Enter password")
+
+    watcher = st.session_state.get('reply_watcher')
+    watcher_running = bool(watcher and watcher['thread'].is_alive())
+    watch_enabled = st.checkbox("👂 Watch inbox (IDLE)", value=watcher_running, help="Keep watching the inbox in the background")
+    if watch_enabled and not watcher_running:
+        if smtp_password:
+            stop_event = threading.Event()
+            watcher_status = {}
+            thread = threading.Thread(
+                target=watch_inbox_for_replies,
+                args=(smtp_password, stop_event, reply_action, watcher_status),
+                daemon=True,
+                name="reply-watcher"
+            )
+            thread.start()
+            st.session_state['reply_watcher'] = {'thread': thread, 'stop': stop_event, 'status': watcher_status}
+            watcher_running = True
+        else:
+            st.error("Enter password")
+    elif not watch_enabled and watcher_running:
+        watcher['stop'].set()
+        watcher_running = False
+
+    if watcher_running:
+        watcher_status = st.session_state['reply_watcher']['status']
+        st.caption(
+            f"Mode: {watcher_status.get('mode', 'starting')} · "
+            f"Last check: {watcher_status.get('last_checked', '—')} · "
+            f"Updated: {watcher_status.get('total_updated', 0)}"
+        )
+        if watcher_status.get('last_error'):
+            st.caption(f"⚠️ {watcher_status['last_error']}")
+
+# Circuit breaker settings: pause a batch when the relay starts failing
+with st.sidebar.expander("⚡ Circuit Breaker"):
+    circuit_consecutive = st.number_input(
+        "Trip after consecutive relay failures", min_value=1, max_value=20,
+        value=CIRCUIT_CONSECUTIVE_FAILURES, help="Connection, auth and throttling errors"
+    )
+    circuit_rate = st.slider(
+        "…or relay error rate over the last sends", min_value=10, max_value=100,
+        value=int(CIRCUIT_ERROR_RATE * 100), step=5, format="%d%%"
+    )
+    circuit_max_pause = st.number_input(
+        "Max pause before deferring the batch (minutes)", min_value=1, max_value=120,
+        value=CIRCUIT_MAX_PAUSE_SECONDS // 60
+    )
+
+def build_circuit_breaker():
+    return new_circuit_breaker(
+        consecutive_failures=int(circuit_consecutive),
+        error_rate=circuit_rate / 100,
+        max_pause=int(circuit_max_pause) * 60
+    )
+
+def get_lease_holder():
+    """This browser session's company-lease holder id; other sessions see its batches as in flight."""
+    if 'lease_holder' not in st.session_state:
+        st.session_state['lease_holder'] = new_lease_holder('ui')
+    return st.session_state['lease_holder']
+
+def start_campaign_runner(campaign_id, smtp_password):
+    """Run a campaign on a background thread owned by this session."""
+    campaign_stop = threading.Event()
+    campaign_status = {}
+    campaign_thread = threading.Thread(
+        target=run_campaign,
+        args=(campaign_id, smtp_password, campaign_stop, campaign_status),
+        kwargs={'breaker': build_circuit_breaker()},
+        daemon=True,
+        name=f"campaign-{campaign_id}"
+    )
+    campaign_thread.start()
+    st.session_state.setdefault('campaign_runners', {})[campaign_id] = {
+        'thread': campaign_thread, 'stop': campaign_stop, 'status': campaign_status
+    }
+
+# Follow-up schedule: cadence, SAST send window and the background due-date sender
+with st.sidebar.expander("📅 Follow-up Schedule"):
+    schedule_settings = get_schedule_settings()
+    with st.form("schedule_settings_form"):
+        cadence_days = st.number_input(
+            "Follow up every N business days", min_value=1, max_value=60,
+            value=schedule_settings['cadence_days']
+        )
+        window_start, window_end = st.slider(
+            "Send window (SAST, Mon–Fri)", min_value=0, max_value=23,
+            value=(schedule_settings['window_start'], schedule_settings['window_end'])
+        )
+        if st.form_submit_button("💾 Save Schedule", use_container_width=True):
+            if window_start >= window_end:
+                st.error("Window start must be before window end")
+            else:
+                save_app_settings({
+                    'follow_up_cadence_days': int(cadence_days),
+                    'send_window_start_hour': window_start,
+                    'send_window_end_hour': window_end,
+                })
+                schedule_settings = get_schedule_settings()
+                st.success("Schedule saved")
+
+    window_open = is_within_send_window(settings=schedule_settings)
+    st.caption(
+        f"{count_due_companies()} due now · window {'open' if window_open else 'closed'} "
+        f"({schedule_settings['window_start']:02d}:00–{schedule_settings['window_end']:02d}:00 SAST)"
+    )
+    unenrolled = count_unenrolled_companies()
+    if unenrolled:
+        st.caption(f"{unenrolled} never-emailed company(ies) are not on the schedule; send to them or enrol them first")
+        if st.button("📥 Enrol never-emailed companies", use_container_width=True,
+                     help="Makes them due now, so the auto-sender sends their initial email in the next window"):
+            st.success(f"Enrolled {enrol_companies()} companies")
+
+    scheduler = st.session_state.get('follow_up_scheduler')
+    scheduler_running = bool(scheduler and scheduler['thread'].is_alive())
+    auto_schedule = st.checkbox("🗓️ Auto-send due follow-ups", value=scheduler_running)
+    if auto_schedule and not scheduler_running and not dry_run:
+        if smtp_password:
+            scheduler_stop = threading.Event()
+            scheduler_status = {}
+            scheduler_thread = threading.Thread(
+                target=run_follow_up_scheduler,
+                args=(smtp_password, scheduler_stop, scheduler_status),
+                kwargs={'breaker_factory': build_circuit_breaker},
+                daemon=True,
+                name="follow-up-scheduler"
+            )
+            scheduler_thread.start()
+            st.session_state['follow_up_scheduler'] = {'thread': scheduler_thread, 'stop': scheduler_stop, 'status': scheduler_status}
+            scheduler_running = True
+        else:
+            st.error("Enter password")
+    elif not auto_schedule and scheduler_running:
+        scheduler['stop'].set()
+        scheduler_running = False
+
+    if scheduler_running:
+        scheduler_status = st.session_state['follow_up_scheduler']['status']
+        totals = scheduler_status.get('totals', {})
+        st.caption(
+            f"Last run: {scheduler_status.get('last_run', '—')} · sent {totals.get('sent', 0)} · "
+            f"deferred {totals.get('deferred', 0)} · failed {totals.get('failed', 0)}"
+        )
+        if scheduler_status.get('outside_window'):
+            st.caption("🌙 Outside the send window; waiting for the next one")
+        if scheduler_status.get('circuit_open'):
+            st.caption("⛔ Paused by circuit breaker; will try again next cycle")
+        if scheduler_status.get('last_error'):
+            st.caption(f"⚠️ {scheduler_status['last_error']}")
+
+# Retry queue: transient failures are resent with backoff outside the batch loop
+with st.sidebar.expander("🔁 Retry Queue"):
+    pending_retries = get_retry_queue('pending')
+    if not pending_retries.empty:
+        st.caption(f"{len(pending_retries)} pending · next at {pending_retries.iloc[0]['next_attempt_at']}")
+    else:
+        st.caption("No pending retries")
+
+    stale_claims = get_stale_claims()
+    if not stale_claims.empty:
+        st.warning(f"⚠️ {len(stale_claims)} send(s) stuck in flight — delivery unknown")
+        st.dataframe(stale_claims[['UIF_REFERENCE', 'step', 'campaign', 'claimed_at']], hide_index=True, use_container_width=True)
+        if st.button("🔓 Release (not in Sent folder)", use_container_width=True,
+                     help="Only release after confirming these emails are not in the Sent folder; released steps can be sent again"):
+            release_stale_claims(stale_claims['ledger_id'].tolist())
+            st.rerun()
+
+    if st.button("▶️ Process Due Retries", use_container_width=True):
+        if smtp_password:
+            retry_summary = process_due_retries(smtp_password, breaker=build_circuit_breaker())
+            st.success(
+                f"Sent {retry_summary['sent']}, rescheduled {retry_summary['rescheduled']}, "
+                f"failed {retry_summary['failed']}, cancelled {retry_summary['cancelled']}"
+            )
+            if retry_summary['in_flight']:
+                st.info(f"🔒 {retry_summary['in_flight']} retry(ies) left due: another session is sending to those companies")
+            if retry_summary['circuit_open']:
+                st.error("⛔ Stopped early: SMTP relay errors tripped the circuit breaker")
+        else:
+            st.error("Enter password")
+
+    retry_worker = st.session_state.get('retry_worker')
+    retry_worker_running = bool(retry_worker and retry_worker['thread'].is_alive())
+    auto_retry = st.checkbox("🔄 Auto-retry in background", value=retry_worker_running)
+    if auto_retry and not retry_worker_running and not dry_run:
+        if smtp_password:
+            retry_stop = threading.Event()
+            retry_status = {}
+            retry_thread = threading.Thread(
+                target=run_retry_worker,
+                args=(smtp_password, retry_stop, retry_status),
+                daemon=True,
+                name="retry-worker"
+            )
+            retry_thread.start()
+            st.session_state['retry_worker'] = {'thread': retry_thread, 'stop': retry_stop, 'status': retry_status}
+            retry_worker_running = True
+        else:
+            st.error("Enter password")
+    elif not auto_retry and retry_worker_running:
+        retry_worker['stop'].set()
+        retry_worker_running = False
+
+    if retry_worker_running:
+        retry_status = st.session_state['retry_worker']['status']
+        totals = retry_status.get('totals', {})
+        st.caption(f"Last run: {retry_status.get('last_run', '—')} · sent {totals.get('sent', 0)} · rescheduled {totals.get('rescheduled', 0)}")
+        if retry_status.get('circuit_open'):
+            st.caption("⛔ Paused by circuit breaker; will try again next cycle")
+        if retry_status.get('last_error'):
+            st.caption(f"⚠️ {retry_status['last_error']}")
+
+# Profiling: capture the next page render or send batch to find where the time goes
+with st.sidebar.expander("🔬 Profiling"):
+    profile_targets = {"Next page render": 'render', "Next send batch": 'send'}
+    profile_target = st.selectbox("Profile", list(profile_targets))
+    profile_mode = st.selectbox("Profiler", list(PROFILE_MODES))
+    if st.button("🎯 Profile this run", use_container_width=True):
+        st.session_state['profile_request'] = {'target': profile_targets[profile_target], 'mode': PROFILE_MODES[profile_mode]}
+        if profile_targets[profile_target] == 'render':
+            st.rerun()
+    profile_request = st.session_state.get('profile_request')
+    if profile_request:
+        st.caption(f"Armed: next {'send batch' if profile_request['target'] == 'send' else 'page render'} ({profile_request['mode']})")
+        if st.button("Cancel", use_container_width=True):
+            del st.session_state['profile_request']
+            st.rerun()
+
+    profile_captures = get_profile_captures()
+    if profile_captures:
+        capture_labels = [f"{capture['started_at']} · {capture['label']} · {capture['duration_ms']:.0f} ms" for capture in profile_captures]
+        chosen_capture = profile_captures[st.selectbox("Recent captures", range(len(profile_captures)), format_func=capture_labels.__getitem__)]
+        st.dataframe(pd.DataFrame(chosen_capture['top']), hide_index=True, use_container_width=True)
+        for path in chosen_capture['files']:
+            if os.path.exists(path):
+                st.download_button(
+                    f"⬇️ {os.path.basename(path)}", data=functools.partial(_read_file_bytes, path),
+                    file_name=os.path.basename(path), on_click="ignore", use_container_width=True, key=f"profile_download_{path}"
+                )
+    else:
+        st.caption(f"No captures yet; they are saved under {PROFILE_DIR}/")
+
 # Modern Dashboard Function
 def show_modern_dashboard():
     st.markdown('<div class="modern-card">', unsafe_allow_html=True)
@@ -1192,7 +687,7 @@ def show_modern_dashboard():
     st.markdown("### 📈 Key Performance Indicators")
 
     stats = get_email_stats()
-    companies_df = get_companies_data()
+    company_summary = get_company_summary()
 
     col1, col2, col3, col4 = st.columns(4)
 
@@ -1213,7 +708,7 @@ def show_modern_dashboard():
         """, unsafe_allow_html=True)
 
     with col3:
-        completed_count = len(companies_df[companies_df['completed'] == 1]) if 'completed' in companies_df.columns else 0
+        completed_count = company_summary['completed']
         st.markdown(f"""
         <div class="metric-card">
             <div class="metric-value">{completed_count}</div>
@@ -1222,7 +717,7 @@ def show_modern_dashboard():
         """, unsafe_allow_html=True)
 
     with col4:
-        total_companies = len(companies_df)
+        total_companies = company_summary['total']
         st.markdown(f"""
         <div class="metric-card">
             <div class="metric-value">{total_companies}</div>
@@ -1302,6 +797,7 @@ def show_modern_dashboard():
 
     # Activity Chart
     if stats['daily_breakdown']:
+        import plotly.express as px
         st.markdown("### 📊 Recent Activity")
         st.markdown('<div class="modern-card">', unsafe_allow_html=True)
 
@@ -1339,9 +835,8 @@ elif st.session_state.current_page == 'company_management':
     st.markdown("### 🔍 Company Search & Update")
 
     # Get all companies for searchable dropdown (type-ahead)
-    conn = sqlite3.connect('compliance_emails.db')
-    all_companies = pd.read_sql_query("SELECT UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, PHONE FROM companies", conn)
-    conn.close()
+    with connect() as conn:
+        all_companies = pd.read_sql_query("SELECT UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, PHONE FROM companies", conn)
 
     # Company selection (outside forms so it can be reused by both sections)
     if not all_companies.empty:
@@ -1372,19 +867,20 @@ elif st.session_state.current_page == 'company_management':
                 new_phone = st.text_input("Phone Number", value=current_phone, help="Contact phone number")
 
             with col2:
-                conn = sqlite3.connect('compliance_emails.db')
-                current_completed = pd.read_sql_query(
-                    f"SELECT completed FROM companies WHERE UIF_REFERENCE = '{uif_ref}'",
-                    conn
-                )
-                conn.close()
-                is_completed = bool(int(current_completed.iloc[0]['completed'])) if not current_completed.empty else False
+                current_state = get_company_states([uif_ref]).get(uif_ref, {})
+                is_completed = current_state.get('completed', False)
+                is_paused = current_state.get('paused', False)
 
                 completed_toggle = st.checkbox(
                     "Mark as Completed",
                     value=is_completed,
                     help="Mark this company as completed (no further follow-ups)"
                 )
+                paused_toggle = st.checkbox(
+                    "Pause Follow-ups",
+                    value=is_paused,
+                    help="Set automatically when a reply is detected; clear to resume follow-ups"
+                )
 
             st.markdown("---")
             col1, col2, col3 = st.columns([1, 1, 1])
@@ -1402,14 +898,12 @@ elif st.session_state.current_page == 'company_management':
             # Save logic here
             if new_email and new_email != current_email:
                 try:
-                    conn = sqlite3.connect('compliance_emails.db')
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE companies SET EMAIL_ADDRESS = ? WHERE UIF_REFERENCE = ?",
-                        (new_email, uif_ref)
-                    )
-                    conn.commit()
-                    conn.close()
+                    with connect() as conn:
+                        conn.execute(
+                            "UPDATE companies SET EMAIL_ADDRESS = ? WHERE UIF_REFERENCE = ?",
+                            (new_email, uif_ref)
+                        )
+                        conn.commit()
                     st.success(f"✅ Successfully updated email for {uif_ref} to {new_email}")
                     log_email(uif_ref, "Email Address Updated", f"Changed from {current_email} to {new_email}")
                 except Exception as e:
@@ -1417,14 +911,12 @@ elif st.session_state.current_page == 'company_management':
 
             if new_phone != current_phone:
                 try:
-                    conn = sqlite3.connect('compliance_emails.db')
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE companies SET PHONE = ? WHERE UIF_REFERENCE = ?",
-                        (new_phone, uif_ref)
-                    )
-                    conn.commit()
-                    conn.close()
+                    with connect() as conn:
+                        conn.execute(
+                            "UPDATE companies SET PHONE = ? WHERE UIF_REFERENCE = ?",
+                            (new_phone, uif_ref)
+                        )
+                        conn.commit()
                     st.success(f"✅ Successfully updated phone for {uif_ref} to {new_phone}")
                 except Exception as e:
                     st.error(f"❌ Error updating phone: {str(e)}")
@@ -1434,14 +926,12 @@ elif st.session_state.current_page == 'company_management':
                 new_completed_value = 1 if completed_toggle else 0
                 old_completed_value = 1 if is_completed else 0
                 if new_completed_value != old_completed_value:
-                    conn = sqlite3.connect('compliance_emails.db')
-                    cursor = conn.cursor()
-                    cursor.execute(
-                        "UPDATE companies SET completed = ? WHERE UIF_REFERENCE = ?",
-                        (new_completed_value, uif_ref)
-                    )
-                    conn.commit()
-                    conn.close()
+                    with connect() as conn:
+                        conn.execute(
+                            "UPDATE companies SET completed = ? WHERE UIF_REFERENCE = ?",
+                            (new_completed_value, uif_ref)
+                        )
+                        conn.commit()
                     if new_completed_value == 1:
                         st.success("✅ Company marked as completed")
                         log_email(uif_ref, "Marked Completed", "Completed")
@@ -1451,6 +941,24 @@ elif st.session_state.current_page == 'company_management':
             except Exception as e:
                 st.error(f"❌ Error saving completion status: {str(e)}")
 
+            # Update paused status
+            try:
+                if paused_toggle != is_paused:
+                    with connect() as conn:
+                        conn.execute(
+                            "UPDATE companies SET paused = ? WHERE UIF_REFERENCE = ?",
+                            (1 if paused_toggle else 0, uif_ref)
+                        )
+                        conn.commit()
+                    if paused_toggle:
+                        st.warning("⏸️ Follow-ups paused for this company")
+                        log_email(uif_ref, "Marked Paused", "Paused")
+                    else:
+                        st.success("▶️ Follow-ups resumed for this company")
+                        log_email(uif_ref, "Marked Resumed", "Resumed")
+            except Exception as e:
+                st.error(f"❌ Error saving paused status: {str(e)}")
+
         if reset:
             st.rerun()
 
@@ -1459,7 +967,8 @@ elif st.session_state.current_page == 'company_management':
         # Email Summary Section
         st.markdown("### 📊 Email Summary")
 
-        addl_emails = get_company_emails(uif_ref)
+        addl_emails = get_company_emails(uif_ref, include_suppressed=True)
+        suppressed_for_company = resolve_company_recipients([uif_ref]).get(uif_ref, {}).get('suppressed', [])
         recipient_preview = []
         if current_email:
             recipient_preview.append(current_email)
@@ -1495,15 +1004,34 @@ elif st.session_state.current_page == 'company_management':
             """, unsafe_allow_html=True)
 
         # Recipient preview for clarity
-        if recipient_preview:
+        deliverable_preview = [e for e in recipient_preview if e not in suppressed_for_company]
+        if deliverable_preview:
             st.markdown("**📧 Will send to:**")
-            st.code(", ".join(recipient_preview))
+            st.code(", ".join(deliverable_preview))
+        elif recipient_preview:
+            st.warning("⛔ All addresses for this company are suppressed after hard bounces")
         else:
             st.warning("⚠️ No email addresses configured for this company")
+        if suppressed_for_company:
+            st.caption(f"⛔ Suppressed (hard bounce): {', '.join(suppressed_for_company)}")
+
+        company_replies = get_reply_events(uif_ref, limit=5)
+        if not company_replies.empty:
+            st.markdown("**📥 Replies received:**")
+            for _, reply in company_replies.iterrows():
+                st.caption(f"{reply['received'] or reply['timestamp']} — {reply['sender']}: {reply['subject']} ({reply['matched_by']})")
 
     else:
         st.info("📝 No companies found. Upload a CSV file to get started.")
 
+    with st.expander("📥 Recent Replies (all companies)"):
+        recent_replies = get_reply_events(limit=100)
+        if not recent_replies.empty:
+            st.dataframe(recent_replies, use_container_width=True, hide_index=True)
+            st.caption("Rows with action 'Review' matched several companies by sender and were not applied automatically.")
+        else:
+            st.info("No replies detected yet. Use Reply Detection in the sidebar.")
+
     st.markdown('</div>', unsafe_allow_html=True)
 
     # Bulk Email Management Section
@@ -1612,7 +1140,7 @@ elif st.session_state.current_page == 'company_management':
             # Test database connection
             if st.button("Test Database Connection", key=f"test_db_{uif_ref}"):
                 try:
-                    with sqlite3.connect(DATABASE_FILE) as conn:
+                    with connect() as conn:
                         cursor = conn.cursor()
                         cursor.execute("SELECT EMAIL FROM company_emails WHERE UIF_REFERENCE = ?", (uif_ref,))
                         db_emails = [row[0] for row in cursor.fetchall()]
@@ -1740,42 +1268,12 @@ elif st.session_state.current_page == 'company_management':
             st.error("Please upload an Excel file first")
         else:
             try:
-                # Read Excel
-                xls = pd.ExcelFile(uploaded_excel)
-                target_sheet = sheet_name if sheet_name.strip() else xls.sheet_names[0]
-                df_new = pd.read_excel(xls, sheet_name=target_sheet)
-                # Normalize columns: trim and rename likely variants
-                df_new.columns = df_new.columns.astype(str).str.strip()
-                rename_map = {
-                    "﻿UIF Reference": "UIF_REFERENCE",
-                    "UIF Reference": "UIF_REFERENCE",
-                    "UIF_REFERENCE": "UIF_REFERENCE",
-                    "TRADE NAMES": "TRADE_NAME",
-                    "TRADE NAME": "TRADE_NAME",
-                    "TRADE_NAME": "TRADE_NAME",
-                    "EMAIL_ADDRESS": "EMAIL_ADDRESS",
-                    "EMAIL": "EMAIL_ADDRESS",
-                    "Email": "EMAIL_ADDRESS",
-                    "PHONE": "PHONE",
-                    "Phone": "PHONE",
-                    "CONTACT NUMBER": "PHONE",
-                }
-                df_new.rename(columns={k: v for k, v in rename_map.items() if k in df_new.columns}, inplace=True)
-                required_columns = ["UIF_REFERENCE", "TRADE_NAME", "EMAIL_ADDRESS"]
-                if not all(col in df_new.columns for col in required_columns):
-                    missing = [c for c in required_columns if c not in df_new.columns]
-                    st.error(f"Missing required columns: {', '.join(missing)}")
+                df_new, target_sheet = read_company_file(uploaded_excel, sheet_name)
+                result = import_companies(df_new)
+                if result['missing']:
+                    st.error(f"Missing required columns: {', '.join(result['missing'])}")
                 else:
-                    added = 0
-                    for _, row in df_new.iterrows():
-                        uif = str(row.get("UIF_REFERENCE", "")).strip()
-                        name = str(row.get("TRADE_NAME", "")).strip()
-                        email = str(row.get("EMAIL_ADDRESS", "")).strip()
-                        phone = str(row.get("PHONE", "")).strip() if "PHONE" in df_new.columns else None
-                        if uif and name:
-                            upsert_company(uif, name, email, phone)
-                            added += 1
-                    st.success(f"Imported or updated {added} companie(s) from sheet '{target_sheet}'")
+                    st.success(f"Imported or updated {result['imported']} companie(s) from sheet '{target_sheet}'")
                     st.rerun()
             except Exception as e:
                 st.error(f"Failed to import: {e}")
@@ -1804,6 +1302,8 @@ elif st.session_state.current_page == 'send_emails':
         selection_df = filtered_df_email.copy()
         if 'completed' in selection_df.columns:
             selection_df = selection_df[selection_df['completed'] != 1]
+        if 'paused' in selection_df.columns:
+            selection_df = selection_df[selection_df['paused'] != 1]
 
         # Quick search functionality
         st.markdown("**🔍 Quick Company Search**")
@@ -1827,7 +1327,7 @@ elif st.session_state.current_page == 'send_emails':
 
         # Multi-select interface
         st.markdown("**📋 Multi-Select Companies**")
-        st.info("💡 Select multiple companies using the checkboxes below (Max 30 companies)")
+        st.info(f"💡 Select multiple companies using the checkboxes below (over {INLINE_SEND_LIMIT} run as a background campaign)")
 
         # Add selection column and pre-select quick choice if present
         selection_df = selection_df.copy()
@@ -1839,6 +1339,20 @@ elif st.session_state.current_page == 'send_emails':
             except Exception:
                 pass
 
+        # Companies another session or background runner is sending to right now
+        active_leases = get_company_leases(exclude_holder=get_lease_holder())
+        selection_df['in_flight'] = selection_df['UIF_REFERENCE'].map(
+            lambda ref: f"🔒 {active_leases[ref]['label'] or 'another session'}" if ref in active_leases else ""
+        )
+        in_flight_count = int((selection_df['in_flight'] != "").sum())
+        if in_flight_count:
+            st.caption(f"🔒 {in_flight_count} company(ies) are in flight in another session; they are skipped if selected here")
+
+        due_now = get_due_companies(limit=30)
+        if not due_now.empty:
+            if st.checkbox(f"📅 Pre-select companies due for follow-up now ({len(due_now)}{'+' if len(due_now) == 30 else ''})"):
+                selection_df.loc[selection_df['UIF_REFERENCE'].isin(due_now['UIF_REFERENCE']), 'Select'] = True
+
         # Modern data editor for selection
         st.markdown('<div class="modern-table">', unsafe_allow_html=True)
         edited_df = st.data_editor(
@@ -1864,9 +1378,17 @@ elif st.session_state.current_page == 'send_emails':
                 "emails_sent": st.column_config.NumberColumn(
                     "Emails Sent",
                     help="Number of emails already sent to this company"
+                ),
+                "next_due_at": st.column_config.TextColumn(
+                    "Next Due",
+                    help="When the next follow-up is due (SAST); blank means never emailed"
+                ),
+                "in_flight": st.column_config.TextColumn(
+                    "In Flight",
+                    help="Leased by a batch in another session or a background runner; released when that batch finishes"
                 )
             },
-            disabled=["UIF_REFERENCE", "TRADE_NAME", "EMAIL_ADDRESS", "emails_sent", "last_sent"],
+            disabled=["UIF_REFERENCE", "TRADE_NAME", "EMAIL_ADDRESS", "emails_sent", "last_sent", "completed", "paused", "next_due_at", "in_flight"],
             hide_index=True,
             use_container_width=True,
             key="email_selection_editor"
@@ -1880,7 +1402,13 @@ elif st.session_state.current_page == 'send_emails':
         if len(selected_companies) > 0:
             st.markdown("### 📊 Selection Summary")
 
-            col1, col2, col3 = st.columns(3)
+            selection_recipients = resolve_company_recipients(selected_companies['UIF_REFERENCE'].tolist())
+            fully_suppressed = [
+                ref for ref, info in selection_recipients.items()
+                if info['suppressed'] and not info['recipients']
+            ]
+
+            col1, col2, col3, col4 = st.columns(4)
 
             with col1:
                 st.markdown(f"""
@@ -1900,10 +1428,7 @@ elif st.session_state.current_page == 'send_emails':
                 """, unsafe_allow_html=True)
 
             with col3:
-                total_recipients = 0
-                for _, row in selected_companies.iterrows():
-                    emails = get_company_emails(row['UIF_REFERENCE'])
-                    total_recipients += len(emails)
+                total_recipients = sum(len(info['recipients']) for info in selection_recipients.values())
                 st.markdown(f"""
                 <div class="metric-card">
                     <div class="metric-value">{total_recipients}</div>
@@ -1911,9 +1436,40 @@ elif st.session_state.current_page == 'send_emails':
                 </div>
                 """, unsafe_allow_html=True)
 
-            # Validation
-            if len(selected_companies) > 30:
-                st.error(f"⚠️ You can select maximum 30 companies. Currently selected: {len(selected_companies)}")
+            with col4:
+                st.markdown(f"""
+                <div class="metric-card">
+                    <div class="metric-value">{len(fully_suppressed)}</div>
+                    <div class="metric-label">⛔ All Recipients Suppressed</div>
+                </div>
+                """, unsafe_allow_html=True)
+
+            if fully_suppressed:
+                st.warning(f"⛔ {len(fully_suppressed)} selected company(ies) will be skipped: every recipient is suppressed after hard bounces")
+            selected_in_flight = int((selected_companies['in_flight'] != "").sum())
+            if selected_in_flight:
+                st.warning(f"🔒 {selected_in_flight} selected company(ies) are in flight in another session and will be skipped unless it finishes first")
+
+            # Large selections run as a tracked campaign instead of the inline loop
+            if len(selected_companies) > INLINE_SEND_LIMIT:
+                st.info(
+                    f"📦 {len(selected_companies)} companies selected — more than {INLINE_SEND_LIMIT} run as a tracked campaign "
+                    f"in the background, in chunks of {CAMPAIGN_CHUNK_SIZE} at one email every {SEND_INTERVAL_SECONDS}s"
+                )
+                col1, col2 = st.columns(2)
+                with col1:
+                    selection_campaign_name = st.text_input("Campaign name", value=f"Selection {datetime.now():%Y-%m-%d %H:%M}")
+                with col2:
+                    selection_campaign_type = st.selectbox("Email Type:", options=EMAIL_TYPE_OPTIONS, key="selection_campaign_type")
+                if st.button("🚀 Create & Start Campaign", type="primary"):
+                    if not smtp_password and not dry_run:
+                        st.error("❌ Please enter SMTP password in the sidebar")
+                    else:
+                        new_campaign_id = create_campaign(
+                            selection_campaign_name, selected_companies['UIF_REFERENCE'].tolist(), selection_campaign_type, dry_run
+                        )
+                        start_campaign_runner(new_campaign_id, smtp_password)
+                        st.success(f"Campaign #{new_campaign_id} started — track it under 🗂️ Campaigns below")
             else:
                 st.success(f"✅ Ready to send emails to {len(selected_companies)} companies")
 
@@ -1929,8 +1485,11 @@ elif st.session_state.current_page == 'send_emails':
                             else:
                                 status = f"⚠️ Warning: {emails_sent} emails sent"
 
-                        recipients = get_company_emails(row['UIF_REFERENCE'])
-                        st.write(f"• **{row['TRADE_NAME']}** (UIF: {row['UIF_REFERENCE']}) - Status: {status} - Recipients: {len(recipients)}")
+                        recipient_info = selection_recipients.get(row['UIF_REFERENCE'], {'recipients': [], 'suppressed': []})
+                        if recipient_info['suppressed'] and not recipient_info['recipients']:
+                            status = "⛔ All recipients suppressed"
+                        suppressed_note = f" ({len(recipient_info['suppressed'])} suppressed)" if recipient_info['suppressed'] else ""
+                        st.write(f"• **{row['TRADE_NAME']}** (UIF: {row['UIF_REFERENCE']}) - Status: {status} - Recipients: {len(recipient_info['recipients'])}{suppressed_note}")
 
                 # Email Type Selection
                 st.markdown("### 📧 Campaign Configuration")
@@ -1940,13 +1499,7 @@ elif st.session_state.current_page == 'send_emails':
                 with col1:
                     email_type = st.selectbox(
                         "Email Type:",
-                        options=[
-                            "Auto (Based on current count)",
-                            "Initial Email (Override count)",
-                            "Follow-up #1", "Follow-up #2", "Follow-up #3",
-                            "Follow-up #4", "Follow-up #5", "Follow-up #6",
-                            "Follow-up #7", "Follow-up #8", "Follow-up #9 (Final)"
-                        ],
+                        options=EMAIL_TYPE_OPTIONS,
                         help="Choose the type of email to send"
                     )
 
@@ -1969,13 +1522,7 @@ elif st.session_state.current_page == 'send_emails':
                         preview_row = selected_companies.loc[preview_company]
 
                         # Determine email count for preview based on selection
-                        if email_type == "Auto (Based on current count)":
-                            preview_email_count = preview_row['emails_sent']
-                        elif email_type == "Initial Email (Override count)":
-                            preview_email_count = 0
-                        else:
-                            follow_up_num = int(email_type.split("#")[1].split()[0]) if "#" in email_type else 0
-                            preview_email_count = follow_up_num
+                        preview_email_count = email_step_for_type(email_type, preview_row['emails_sent'])
 
                         preview_subject, preview_body = get_email_template(
                             preview_row['UIF_REFERENCE'],
@@ -2011,7 +1558,7 @@ elif st.session_state.current_page == 'send_emails':
                                     st.error("❌ Please enter SMTP password in the sidebar")
                                 else:
                                     st.info("🚀 Starting email campaign...")
-                                    send_follow_up_emails(selected_companies, smtp_password, dry_run, email_type)
+                                    send_follow_up_emails(selected_companies, smtp_password, dry_run, email_type, breaker=build_circuit_breaker())
                                     st.rerun()
 
                         with col2:
@@ -2024,12 +1571,88 @@ elif st.session_state.current_page == 'send_emails':
             st.info("💡 Select companies using the checkboxes above to proceed with email campaigns")
 
         st.markdown('</div>', unsafe_allow_html=True)
+
+        # Campaigns: persisted, resumable runs for whole phase lists
+        st.markdown("### 🗂️ Campaigns")
+        with st.expander("➕ New campaign from a list"):
+            campaign_source = st.radio(
+                "Companies", ["Due for follow-up now", "All open companies", "Paste UIF references"], horizontal=True
+            )
+            if campaign_source == "Paste UIF references":
+                pasted_refs = st.text_area("UIF references (one per line, or comma separated)", height=150)
+                known_refs = set(companies_df['UIF_REFERENCE'])
+                campaign_refs = [ref for ref in re.split(r"[\s,;]+", pasted_refs) if ref]
+                unknown_refs = [ref for ref in campaign_refs if ref not in known_refs]
+                if unknown_refs:
+                    st.warning(f"{len(unknown_refs)} reference(s) not found and will be skipped: {', '.join(unknown_refs[:10])}")
+                campaign_refs = [ref for ref in campaign_refs if ref in known_refs]
+            elif campaign_source == "Due for follow-up now":
+                campaign_refs = get_due_companies(limit=None)['UIF_REFERENCE'].tolist()
+            else:
+                campaign_refs = selection_df['UIF_REFERENCE'].tolist()
+            col1, col2 = st.columns(2)
+            with col1:
+                list_campaign_name = st.text_input("Campaign name", value=f"{campaign_source} {datetime.now():%Y-%m-%d}", key="list_campaign_name")
+            with col2:
+                list_campaign_type = st.selectbox("Email Type:", options=EMAIL_TYPE_OPTIONS, key="list_campaign_type")
+            st.caption(f"{len(campaign_refs)} companies")
+            if st.button("🚀 Create & Start", disabled=not campaign_refs):
+                if not smtp_password and not dry_run:
+                    st.error("❌ Please enter SMTP password in the sidebar")
+                else:
+                    new_campaign_id = create_campaign(list_campaign_name, campaign_refs, list_campaign_type, dry_run)
+                    start_campaign_runner(new_campaign_id, smtp_password)
+                    st.success(f"Campaign #{new_campaign_id} started")
+
+        campaigns_df = get_campaigns()
+        if campaigns_df.empty:
+            st.info("No campaigns yet.")
+        else:
+            if st.button("🔄 Refresh Progress"):
+                st.rerun()
+            campaign_runners = st.session_state.setdefault('campaign_runners', {})
+            for _, campaign in campaigns_df.iterrows():
+                campaign_id = int(campaign['campaign_id'])
+                runner = campaign_runners.get(campaign_id)
+                runner_alive = bool(runner and runner['thread'].is_alive())
+                progress = get_campaign_progress(campaign_id)
+                campaign_status = campaign['status']
+                if campaign_status == 'running' and not runner_alive:
+                    campaign_status = 'interrupted'
+                mode = " · 🧪 dry run" if campaign['dry_run'] else ""
+                st.markdown(f"**#{campaign_id} {campaign['name']}** — {campaign_status}{mode} · {campaign['email_type']}")
+                st.progress(progress['fraction'])
+                counts_text = " · ".join(f"{key} {value}" for key, value in sorted(progress['counts'].items()))
+                eta_text = f" · ETA {timedelta(seconds=progress['eta_seconds'])}" if progress['pending'] and runner_alive else ""
+                st.caption(f"{progress['done']}/{progress['total']} · {counts_text}{eta_text}")
+                if campaign['last_error']:
+                    st.caption(f"⚠️ {campaign['last_error']}")
+                if progress['pending'] and campaign_status != 'cancelled':
+                    col1, col2, _ = st.columns([1, 1, 3])
+                    with col1:
+                        if runner_alive:
+                            if st.button("⏸️ Pause", key=f"pause_campaign_{campaign_id}"):
+                                runner['stop'].set()
+                                st.rerun()
+                        elif st.button("▶️ Resume", key=f"resume_campaign_{campaign_id}"):
+                            if not smtp_password and not campaign['dry_run']:
+                                st.error("❌ Please enter SMTP password in the sidebar")
+                            else:
+                                start_campaign_runner(campaign_id, smtp_password)
+                                st.rerun()
+                    with col2:
+                        if not runner_alive and st.button("🗑️ Cancel", key=f"cancel_campaign_{campaign_id}"):
+                            set_campaign_status(campaign_id, 'cancelled')
+                            st.rerun()
     else:
         st.info("📝 No companies in database. Please upload a CSV file first in the Company Management section.")
 
     st.markdown('</div>', unsafe_allow_html=True)
 
 elif st.session_state.current_page == 'email_logs':
+    import plotly.express as px
+    import plotly.graph_objects as go
+
     st.markdown('<div class="modern-card">', unsafe_allow_html=True)
     colored_header(
         label="Email Analytics",
@@ -2039,11 +1662,23 @@ elif st.session_state.current_page == 'email_logs':
 
     st.markdown("### 📈 Email Performance Dashboard")
 
-    # Get companies data for completed count
-    companies_df = get_companies_data()
+    # Company counts and email KPIs come from the rollup tables
+    company_summary = get_company_summary()
+
+    today = datetime.now().date()
+    trend_range = st.date_input(
+        "Trend date range",
+        value=(today - timedelta(days=7), today),
+        max_value=today,
+        key="analytics_trend_range"
+    )
+    if isinstance(trend_range, (tuple, list)) and len(trend_range) == 2:
+        trend_start, trend_end = trend_range
+    else:
+        trend_start = trend_end = trend_range[0] if isinstance(trend_range, (tuple, list)) and trend_range else today
 
     # Email Statistics
-    stats = get_email_stats()
+    stats = get_email_stats(trend_start, trend_end)
 
     col1, col2, col3, col4 = st.columns(4)
 
@@ -2064,7 +1699,7 @@ elif st.session_state.current_page == 'email_logs':
         """, unsafe_allow_html=True)
 
     with col3:
-        completed_count = len(companies_df[companies_df['completed'] == 1]) if 'completed' in companies_df.columns else 0
+        completed_count = company_summary['completed']
         st.markdown(f"""
         <div class="metric-card">
             <div class="metric-value">{completed_count}</div>
@@ -2073,7 +1708,7 @@ elif st.session_state.current_page == 'email_logs':
         """, unsafe_allow_html=True)
 
     with col4:
-        total_companies = len(companies_df)
+        total_companies = company_summary['total']
         st.markdown(f"""
         <div class="metric-card">
             <div class="metric-value">{total_companies}</div>
@@ -2100,7 +1735,7 @@ elif st.session_state.current_page == 'email_logs':
         ))
 
         fig.update_layout(
-            title='Daily Email Activity (Last 7 Days)',
+            title=f'Daily Email Activity ({trend_start:%d %b %Y} – {trend_end:%d %b %Y})',
             xaxis_title='Date',
             yaxis_title='Number of Emails',
             height=300,
@@ -2111,10 +1746,58 @@ elif st.session_state.current_page == 'email_logs':
 
         st.plotly_chart(fig, use_container_width=True)
 
+    status_counts = get_daily_status_counts(trend_start, trend_end)
+    if not status_counts.empty:
+        with st.expander("📊 Outcomes by Status", expanded=False):
+            totals = status_counts.groupby('status', as_index=False)['count'].sum().sort_values('count', ascending=False)
+            top_statuses = totals.head(8)['status'].tolist()
+            status_counts = status_counts[status_counts['status'].isin(top_statuses)]
+            status_fig = px.bar(
+                status_counts, x='date', y='count', color='status',
+                title='Logged Outcomes per Day', labels={'date': 'Date', 'count': 'Log Entries', 'status': 'Status'}
+            )
+            status_fig.update_layout(height=300, margin=dict(l=20, r=20, t=40, b=40))
+            st.plotly_chart(status_fig, use_container_width=True)
+            st.dataframe(totals.rename(columns={'status': 'Status', 'count': 'Entries'}), use_container_width=True, hide_index=True)
+
+    stage_latency = get_send_stage_latency(trend_start, trend_end)
+    if not stage_latency.empty:
+        with st.expander("⏱️ Send Path Timings", expanded=False):
+            st.caption(
+                "Per-message time spent in each stage of the send path. Attachments include reading and "
+                "base64-encoding the files; DB writes include any buffer flush the message triggered."
+            )
+            stage_only = stage_latency[stage_latency['stage'] != 'total']
+            latency_fig = px.bar(
+                stage_only.melt(id_vars='stage', value_vars=['p50_ms', 'p95_ms', 'p99_ms'], var_name='percentile', value_name='ms'),
+                x='stage', y='ms', color='percentile', barmode='group',
+                title='Stage Latency Percentiles', labels={'stage': 'Stage', 'ms': 'Milliseconds', 'percentile': 'Percentile'}
+            )
+            latency_fig.update_layout(height=300, margin=dict(l=20, r=20, t=40, b=40))
+            st.plotly_chart(latency_fig, use_container_width=True)
+            st.dataframe(
+                stage_latency.rename(columns={
+                    'stage': 'Stage', 'messages': 'Messages', 'p50_ms': 'p50 (ms)', 'p95_ms': 'p95 (ms)',
+                    'p99_ms': 'p99 (ms)', 'mean_ms': 'Mean (ms)'
+                }),
+                use_container_width=True, hide_index=True
+            )
+            throughput = get_send_throughput(trend_start, trend_end, 3600 if (trend_end - trend_start).days <= 7 else 86400)
+            throughput_fig = px.line(
+                throughput, x='bucket', y='messages', markers=True, hover_data=['bytes', 'avg_total_ms'],
+                title='Messages Sent over Time', labels={'bucket': 'Time', 'messages': 'Messages', 'avg_total_ms': 'Avg total (ms)'}
+            )
+            throughput_fig.update_layout(height=300, margin=dict(l=20, r=20, t=40, b=40))
+            st.plotly_chart(throughput_fig, use_container_width=True)
+
     st.markdown("### 📋 Detailed Email Logs")
 
-    # Get email logs
-    logs_df = get_email_logs()
+    # Get email logs (the period is a range scan on the epoch index)
+    log_periods = {"All time": None, "Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "Last 365 days": 365}
+    log_period = st.selectbox("Log period", list(log_periods), help="Only load log entries from this period")
+    period_days = log_periods[log_period]
+    logs_df = get_email_logs(start=(today - timedelta(days=period_days)) if period_days else None)
+    st.caption("Older months are read from archived partitions when the period reaches past the retention window.")
 
     if not logs_df.empty:
         # Enhanced filter section
@@ -2130,7 +1813,7 @@ elif st.session_state.current_page == 'email_logs':
         with col2:
             status_filter = st.selectbox(
                 "Filter by Status",
-                ["All", "Sent", "Failed", "Bounced", "Skipped"],
+                ["All", "Sent", "Failed", "Deferred", "Bounced", "Skipped"],
                 help="Filter logs by delivery status"
             )
 
@@ -2189,7 +1872,7 @@ elif st.session_state.current_page == 'email_logs':
                 "status": st.column_config.SelectboxColumn(
                     "Status",
                     help="Email delivery status",
-                    options=["Sent", "Failed", "Bounced", "Skipped"],
+                    options=["Sent", "Failed", "Deferred", "Bounced", "Skipped"],
                     required=True
                 ),
                 "timestamp": st.column_config.DatetimeColumn(
@@ -2209,13 +1892,14 @@ elif st.session_state.current_page == 'email_logs':
         col1, col2 = st.columns(2)
 
         with col1:
-            csv_data = filtered_logs.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📥 Download Filtered Logs (CSV)",
-                data=csv_data,
-                file_name=f"email_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                mime="text/csv",
-                use_container_width=True
+            render_export_buttons(
+                'email_logs',
+                {
+                    'uif_ref': None if uif_filter == "All" else uif_filter,
+                    'status': None if status_filter == "All" else status_filter,
+                    'start': str(today - timedelta(days=period_days)) if period_days else None,
+                },
+                "Download Filtered Logs", "email_logs", "export_logs"
             )
 
         with col2:
@@ -2225,6 +1909,161 @@ elif st.session_state.current_page == 'email_logs':
     else:
         st.info("📭 No email logs found. Send some emails first!")
 
+    # Per-recipient delivery records
+    with st.expander("📬 Delivery Records (per recipient)"):
+        delivery_cols = st.columns(3)
+        with delivery_cols[0]:
+            delivery_uif = st.text_input("UIF Reference", key="delivery_uif_filter")
+        with delivery_cols[1]:
+            delivery_recipient = st.text_input("Recipient", key="delivery_recipient_filter")
+        with delivery_cols[2]:
+            delivery_msgid = st.text_input("Message-ID", key="delivery_msgid_filter")
+        deliveries_df = get_email_deliveries(
+            uif_ref=delivery_uif.strip() or None,
+            message_id=delivery_msgid.strip() or None,
+            recipient=delivery_recipient.strip() or None
+        )
+        if not deliveries_df.empty:
+            st.dataframe(deliveries_df, use_container_width=True, hide_index=True)
+        else:
+            st.info("No delivery records match.")
+
+    with st.expander("🧮 Reconcile Email Counters"):
+        st.caption(
+            "Rebuild each company's Emails Sent count and last sent date from the 'Sent' rows in the email logs. "
+            "By default counts only go up, so companies emailed before logging started keep their higher count."
+        )
+        exact_reconcile = st.checkbox("Make the logs authoritative (may lower counts)")
+        if st.button("🧮 Reconcile Now"):
+            changed = reconcile_email_counters(exact=exact_reconcile)
+            st.success(f"Updated {changed} company record(s)")
+
+    with st.expander("🗄️ Log Retention & Archive"):
+        retention = get_retention_settings()
+        st.caption(
+            f"Closed months older than the retention window are moved to {'Parquet' if _parquet_available() else 'gzip CSV'} "
+            f"files under `{LOG_ARCHIVE_DIR}/`. Dashboard totals and trends keep counting archived months."
+        )
+        with st.form("retention_form"):
+            retention_months = st.number_input(
+                "Months to keep in the database (besides the current month)",
+                min_value=1, max_value=60, value=retention['months']
+            )
+            if st.form_submit_button("💾 Save Retention"):
+                save_app_settings({'log_retention_months': int(retention_months)})
+                st.success("Retention saved")
+        if st.button("🗄️ Archive Closed Months Now"):
+            try:
+                result = archive_closed_months()
+                if result['rows']:
+                    st.success(f"Archived {result['rows']} row(s) in {len(result['partitions'])} partition(s) before {result['cutoff']}")
+                else:
+                    st.info(f"Nothing older than {result['cutoff']} to archive")
+            except Exception as e:
+                st.error(f"Archiving failed: {e}")
+        archives_df = get_log_archives()
+        if not archives_df.empty:
+            st.dataframe(archives_df.drop(columns=['path']), use_container_width=True, hide_index=True)
+
+    with st.expander("🛠️ Database Maintenance"):
+        db_stats = get_database_stats()
+        maintenance = get_maintenance_settings()
+        cols = st.columns(4)
+        cols[0].markdown(f"**File**<br>{db_stats['file_bytes'] / (1024 * 1024):.1f} MB", unsafe_allow_html=True)
+        cols[1].markdown(f"**WAL**<br>{db_stats['wal_bytes'] / (1024 * 1024):.1f} MB", unsafe_allow_html=True)
+        cols[2].markdown(f"**Pages**<br>{db_stats['page_count']:,} × {db_stats['page_size']} B", unsafe_allow_html=True)
+        cols[3].markdown(
+            f"**Free pages**<br>{db_stats['freelist_count']:,} ({db_stats['free_ratio']:.1%})", unsafe_allow_html=True
+        )
+        st.caption(
+            f"Journal: {db_stats['journal_mode']} · auto-vacuum: {db_stats['auto_vacuum']} · "
+            f"last backup {maintenance['last_backup'] or 'never'} · last optimize {maintenance['last_optimize'] or 'never'} · "
+            f"last vacuum {maintenance['last_vacuum'] or 'never'}"
+        )
+
+        with st.form("maintenance_settings_form"):
+            cols = st.columns(4)
+            backup_hours = cols[0].number_input("Back up every (h)", min_value=0, max_value=24 * 30, value=maintenance['backup_hours'])
+            optimize_hours = cols[1].number_input("Optimize every (h)", min_value=0, max_value=24 * 30, value=maintenance['optimize_hours'])
+            vacuum_hours = cols[2].number_input("Vacuum every (h)", min_value=0, max_value=24 * 30, value=maintenance['vacuum_hours'])
+            backup_keep = cols[3].number_input("Backups kept", min_value=1, max_value=365, value=maintenance['backup_keep'])
+            if st.form_submit_button("💾 Save Schedule"):
+                save_app_settings({
+                    'maintenance_backup_hours': int(backup_hours),
+                    'maintenance_optimize_hours': int(optimize_hours),
+                    'maintenance_vacuum_hours': int(vacuum_hours),
+                    'backup_keep': int(backup_keep),
+                })
+                st.success("Maintenance schedule saved (0 h turns a task off)")
+
+        cols = st.columns(3)
+        if cols[0].button("💽 Back Up Now", use_container_width=True):
+            backup_progress = st.progress(0.0)
+            try:
+                result = backup_database(progress=lambda remaining, total: backup_progress.progress(1 - remaining / total if total else 1.0))
+                st.success(f"Backed up {result['pages']:,} pages to `{result['path']}` in {result['seconds']}s")
+            except Exception as e:
+                st.error(f"Backup failed: {e}")
+            backup_progress.empty()
+        full_analyze = cols[1].checkbox("Full ANALYZE", help="Re-scan every table rather than only those with stale statistics")
+        if cols[1].button("📈 Optimize Now", use_container_width=True):
+            result = optimize_database(full=full_analyze)
+            st.success(f"{result['mode'].upper()} finished in {result['seconds']}s")
+        if cols[2].button("🧹 Vacuum Now", use_container_width=True):
+            result = incremental_vacuum()
+            if result['enabled']:
+                st.success(f"Returned {result['freed_pages']:,} free page(s) to the filesystem")
+            else:
+                st.warning("Incremental vacuum is not enabled on this database yet")
+        if db_stats['auto_vacuum'] != 'incremental':
+            st.warning(
+                "This database was created without incremental vacuum, so space freed by log deletions and archiving "
+                "is reused but never returned to the filesystem. Enabling it runs one full VACUUM, which blocks "
+                "sends and log writes until it finishes; run it outside the send window."
+            )
+            if st.button("Enable Incremental Vacuum (full VACUUM)"):
+                try:
+                    result = enable_incremental_vacuum()
+                    st.success(f"VACUUM finished in {result['seconds']}s")
+                except Exception as e:
+                    st.error(f"VACUUM failed: {e}")
+
+        if st.button("🔍 Analyse Table Space"):
+            table_space = get_table_space()
+            if table_space.empty:
+                st.info("This SQLite build has no dbstat table")
+            else:
+                st.caption("Unused bytes sit inside allocated pages, for example after deletes; VACUUM reclaims them.")
+                st.dataframe(table_space, use_container_width=True, hide_index=True)
+
+        maintenance_worker = st.session_state.get('maintenance_worker')
+        maintenance_running = bool(maintenance_worker and maintenance_worker['thread'].is_alive())
+        auto_maintenance = st.checkbox("🔧 Run maintenance on schedule in the background", value=maintenance_running)
+        if auto_maintenance and not maintenance_running:
+            maintenance_stop = threading.Event()
+            maintenance_status = {}
+            maintenance_thread = threading.Thread(
+                target=run_maintenance_worker,
+                args=(maintenance_stop, maintenance_status),
+                daemon=True,
+                name="maintenance-worker"
+            )
+            maintenance_thread.start()
+            st.session_state['maintenance_worker'] = {'thread': maintenance_thread, 'stop': maintenance_stop, 'status': maintenance_status}
+            maintenance_running = True
+        elif not auto_maintenance and maintenance_running:
+            maintenance_worker['stop'].set()
+            maintenance_running = False
+        if maintenance_running:
+            maintenance_status = st.session_state['maintenance_worker']['status']
+            st.caption(f"Last check: {maintenance_status.get('last_run', '—')}")
+            if maintenance_status.get('last_error'):
+                st.caption(f"⚠️ {maintenance_status['last_error']}")
+
+        backups_df = get_backups()
+        if not backups_df.empty:
+            st.dataframe(backups_df, use_container_width=True, hide_index=True)
+
     # Error logs section
     st.markdown("### 🚨 Error Analysis")
 
@@ -2258,13 +2097,13 @@ elif st.session_state.current_page == 'email_logs':
         st.markdown('</div>', unsafe_allow_html=True)
 
         # Error download
-        csv_data = filtered_errors.to_csv(index=False).encode('utf-8')
-        st.download_button(
-            label="📥 Download Error Logs (CSV)",
-            data=csv_data,
-            file_name=f"email_error_logs_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv",
-            use_container_width=True
+        render_export_buttons(
+            'email_error_logs',
+            {
+                'uif_ref': None if uif_filter_err == "All" else uif_filter_err,
+                'stage': None if stage_filter == "All" else stage_filter,
+            },
+            "Download Error Logs", "email_error_logs", "export_errors"
         )
         st.markdown('</div>', unsafe_allow_html=True)
     else:
@@ -2402,13 +2241,9 @@ elif st.session_state.current_page == 'completed_companies':
             col1, col2 = st.columns(2)
 
             with col1:
-                csv_data = completed_filtered.to_csv(index=False).encode('utf-8')
-                st.download_button(
-                    label="📥 Download Completed Companies (CSV)",
-                    data=csv_data,
-                    file_name=f"completed_companies_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                    mime="text/csv",
-                    use_container_width=True
+                render_export_buttons(
+                    'completed_companies', {'search': search_completed.strip() or None},
+                    "Download Completed Companies", "completed_companies", "export_completed"
                 )
 
             with col2:
@@ -2469,25 +2304,9 @@ elif st.session_state.current_page == 'email_templates':
 
     def _load_template_row(key: str):
         try:
-            with sqlite3.connect(DATABASE_FILE) as conn:
-                df = pd.read_sql_query(
-                    f"SELECT subject, body FROM email_templates WHERE template_key = '{key}'",
-                    conn
-                )
-                if not df.empty:
-                    return df.iloc[0]['subject'] or '', df.iloc[0]['body'] or ''
+            return get_template_row(key)
         except Exception:
-            pass
-        return '', ''
-
-    def _save_template_row(key: str, subject: str, body: str):
-        with sqlite3.connect(DATABASE_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO email_templates (template_key, subject, body) VALUES (?, ?, ?) ON CONFLICT(template_key) DO UPDATE SET subject=excluded.subject, body=excluded.body",
-                (key, subject, body)
-            )
-            conn.commit()
+            return '', ''
 
     template_keys = [
         ("initial", "📧 Initial Email"),
@@ -2533,7 +2352,7 @@ elif st.session_state.current_page == 'email_templates':
 
     if save_clicked:
         try:
-            _save_template_row(selected_tpl_key, new_subject, new_body)
+            save_template_row(selected_tpl_key, new_subject, new_body)
             st.success(f"✅ Template '{selected_tpl_label}' saved successfully!")
         except Exception as e:
             st.error(f"❌ Failed to save template: {e}")
@@ -2625,50 +2444,19 @@ elif st.session_state.current_page == 'unreachable_companies':
             help="Limit number of results displayed"
         )
 
+    search_term = st.text_input(
+        "🔍 Search by UIF Reference, Trade Name, or Email",
+        help="Type to search for specific companies"
+    )
+
     st.markdown('</div>', unsafe_allow_html=True)
 
-    # Get unreachable companies data
-    if filter_type == "All Issues":
-        unreachable_df = get_unreachable_companies()
-    elif filter_type == "Bounced Emails Only":
-        unreachable_df = get_bounced_companies()
-        if not unreachable_df.empty:
-            unreachable_df = unreachable_df.rename(columns={
-                'bounce_count': 'total_issues',
-                'last_bounce_date': 'last_issue_date',
-                'bounced_subjects': 'failed_subjects'
-            })
-            unreachable_df['failure_count'] = 0
-            unreachable_df['failed_subjects'] = ''
-    elif filter_type == "Failed Emails Only":
-        unreachable_df = get_failed_companies()
-        if not unreachable_df.empty:
-            unreachable_df = unreachable_df.rename(columns={
-                'failure_count': 'total_issues',
-                'last_failure_date': 'last_issue_date',
-                'failed_subjects': 'bounced_subjects'
-            })
-            unreachable_df['bounce_count'] = 0
-            unreachable_df['bounced_subjects'] = ''
-    else:  # Both Bounced & Failed
-        unreachable_df = get_unreachable_companies()
+    # Filter, search, sort and Top-N all run against the delivery-health table
+    count_limit = None if show_count == "All" else int(show_count.split()[1])
+    issue_summary = get_delivery_health_summary(filter_type, search_term or None)
+    unreachable_df = get_delivery_health(filter_type, sort_by, count_limit, search_term or None)
 
     if not unreachable_df.empty:
-        # Apply sorting
-        if sort_by == "Last Issue Date":
-            unreachable_df = unreachable_df.sort_values('last_issue_date', ascending=False)
-        elif sort_by == "Total Issues":
-            unreachable_df = unreachable_df.sort_values('total_issues', ascending=False)
-        elif sort_by == "Company Name":
-            unreachable_df = unreachable_df.sort_values('TRADE_NAME', ascending=True)
-        elif sort_by == "UIF Reference":
-            unreachable_df = unreachable_df.sort_values('UIF_REFERENCE', ascending=True)
-
-        # Apply count limit
-        if show_count != "All":
-            count_limit = int(show_count.split()[1])
-            unreachable_df = unreachable_df.head(count_limit)
-
         # Summary metrics
         st.markdown("### 📊 Issue Summary")
 
@@ -2677,53 +2465,35 @@ elif st.session_state.current_page == 'unreachable_companies':
         with col1:
             st.markdown(f"""
             <div class="metric-card">
-                <div class="metric-value">{len(unreachable_df)}</div>
+                <div class="metric-value">{issue_summary['companies']}</div>
                 <div class="metric-label">🚫 Unreachable</div>
             </div>
             """, unsafe_allow_html=True)
 
         with col2:
-            total_bounces = unreachable_df['bounce_count'].sum() if 'bounce_count' in unreachable_df.columns else 0
             st.markdown(f"""
             <div class="metric-card">
-                <div class="metric-value">{total_bounces}</div>
+                <div class="metric-value">{issue_summary['bounces']}</div>
                 <div class="metric-label">📤 Bounces</div>
             </div>
             """, unsafe_allow_html=True)
 
         with col3:
-            total_failures = unreachable_df['failure_count'].sum() if 'failure_count' in unreachable_df.columns else 0
             st.markdown(f"""
             <div class="metric-card">
-                <div class="metric-value">{total_failures}</div>
+                <div class="metric-value">{issue_summary['failures']}</div>
                 <div class="metric-label">❌ Failures</div>
             </div>
             """, unsafe_allow_html=True)
 
         with col4:
-            total_issues = unreachable_df['total_issues'].sum()
             st.markdown(f"""
             <div class="metric-card">
-                <div class="metric-value">{total_issues}</div>
+                <div class="metric-value">{issue_summary['total_issues']}</div>
                 <div class="metric-label">📋 Total Issues</div>
             </div>
             """, unsafe_allow_html=True)
 
-        # Search functionality
-        st.markdown("### 🔍 Search Companies")
-        search_term = st.text_input(
-            "Search by UIF Reference, Trade Name, or Email",
-            help="Type to search for specific companies"
-        )
-
-        if search_term:
-            search_mask = (
-                unreachable_df['UIF_REFERENCE'].str.contains(search_term, case=False, na=False) |
-                unreachable_df['TRADE_NAME'].str.contains(search_term, case=False, na=False) |
-                unreachable_df['EMAIL_ADDRESS'].str.contains(search_term, case=False, na=False)
-            )
-            unreachable_df = unreachable_df[search_mask]
-
         # Display the data
         st.markdown("### 📋 Companies with Delivery Issues")
         st.markdown('<div class="modern-table">', unsafe_allow_html=True)
@@ -2732,8 +2502,9 @@ elif st.session_state.current_page == 'unreachable_companies':
         display_df = unreachable_df.copy()
 
         # Format dates
-        if 'last_issue_date' in display_df.columns:
-            display_df['last_issue_date'] = pd.to_datetime(display_df['last_issue_date']).dt.strftime('%Y-%m-%d %H:%M')
+        for date_col in ('last_issue_date', 'last_success_date'):
+            if date_col in display_df.columns:
+                display_df[date_col] = pd.to_datetime(display_df[date_col], errors='coerce').dt.strftime('%Y-%m-%d %H:%M')
 
         # Truncate long text fields
         if 'bounced_subjects' in display_df.columns:
@@ -2756,7 +2527,8 @@ elif st.session_state.current_page == 'unreachable_companies':
                 "total_issues": st.column_config.NumberColumn("Total Issues", help="Total number of delivery problems"),
                 "bounce_count": st.column_config.NumberColumn("Bounces", help="Number of bounced emails"),
                 "failure_count": st.column_config.NumberColumn("Failures", help="Number of failed emails"),
-                "last_issue_date": st.column_config.DatetimeColumn("Last Issue", help="Date of most recent issue")
+                "last_issue_date": st.column_config.DatetimeColumn("Last Issue", help="Date of most recent issue"),
+                "last_success_date": st.column_config.DatetimeColumn("Last Success", help="Date of most recent successful send")
             }
         )
         st.markdown('</div>', unsafe_allow_html=True)
@@ -2766,18 +2538,11 @@ elif st.session_state.current_page == 'unreachable_companies':
         col1, col2, col3 = st.columns(3)
 
         with col1:
-            if st.button("📥 Export to CSV", use_container_width=True):
-                csv_data = export_unreachable_companies()
-                if csv_data:
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv_data,
-                        file_name=f"unreachable_companies_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                        mime="text/csv",
-                        use_container_width=True
-                    )
-                else:
-                    st.error("No data to export")
+            render_export_buttons(
+                'unreachable',
+                {'issue_type': filter_type, 'sort_by': sort_by, 'limit': count_limit, 'search': search_term or None},
+                "Export Shown Companies", "unreachable_companies", "export_unreachable"
+            )
 
         with col2:
             if st.button("🔄 Refresh Data", use_container_width=True):
@@ -2789,7 +2554,10 @@ elif st.session_state.current_page == 'unreachable_companies':
                 st.markdown("#### 📈 Detailed Statistics")
                 st.info(f"**Filter Applied:** {filter_type}")
                 st.info(f"**Sort Order:** {sort_by}")
-                st.info(f"**Results Shown:** {len(unreachable_df)} companies")
+                st.info(f"**Results Shown:** {len(unreachable_df)} of {issue_summary['companies']} companies")
+
+    elif search_term or filter_type != "All Issues":
+        st.info("No companies match the current filter or search.")
 
     else:
         st.success("🎉 Excellent! No unreachable companies found!")
@@ -2798,14 +2566,14 @@ elif st.session_state.current_page == 'unreachable_companies':
         st.markdown("### 📊 Overall Email Performance")
 
         try:
-            with sqlite3.connect(DATABASE_FILE) as conn:
+            with connect() as conn:
                 stats_query = """
                     SELECT
-                        COUNT(CASE WHEN status = 'Sent' THEN 1 END) as successful_sends,
-                        COUNT(CASE WHEN status = 'Bounced' THEN 1 END) as bounces,
-                        COUNT(CASE WHEN status = 'Failed' THEN 1 END) as failures,
-                        COUNT(*) as total_attempts
-                    FROM email_logs
+                        COALESCE(SUM(CASE WHEN status = 'Sent' THEN count END), 0) as successful_sends,
+                        COALESCE(SUM(CASE WHEN status = 'Bounced' THEN count END), 0) as bounces,
+                        COALESCE(SUM(CASE WHEN status = 'Failed' THEN count END), 0) as failures,
+                        COALESCE(SUM(count), 0) as total_attempts
+                    FROM email_log_daily
                 """
                 stats_df = pd.read_sql_query(stats_query, conn)
                 if not stats_df.empty:
@@ -2848,6 +2616,24 @@ elif st.session_state.current_page == 'unreachable_companies':
         except Exception as e:
             st.error(f"Error retrieving email statistics: {e}")
 
+    # Suppression list management
+    st.markdown("### ⛔ Suppressed Recipients")
+    suppressed_df = get_suppressed_recipients()
+    if not suppressed_df.empty:
+        st.caption("Addresses that hard-bounced or were refused at RCPT are skipped on every send until removed here.")
+        st.dataframe(suppressed_df, use_container_width=True, hide_index=True)
+        with st.form("unsuppress_form"):
+            unsuppress_choice = st.selectbox("Remove an address from the suppression list", suppressed_df['email'].tolist())
+            if st.form_submit_button("♻️ Unsuppress"):
+                ok, msg = unsuppress_recipient(unsuppress_choice)
+                if ok:
+                    st.success(f"✅ {unsuppress_choice}: {msg}")
+                    st.rerun()
+                else:
+                    st.error(f"❌ {msg}")
+    else:
+        st.info("No suppressed recipients.")
+
     st.markdown('</div>', unsafe_allow_html=True)
 
 # Modern Footer
@@ -2897,3 +2683,7 @@ if os.path.exists(csv_path):
     except Exception as e:
         st.sidebar.error(f"Error pre-loading Book1.csv: {e}")
 
+if 'page_profile' in st.session_state:
+    profile_summary = stop_profile(st.session_state.pop('page_profile'), label=f"render-{st.session_state.current_page}")
+    st.session_state['profile_last'] = profile_summary['label']
+
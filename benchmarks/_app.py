@@ -0,0 +1,23 @@
+"""Load the app's core module (sending, data access, templates) for benchmarking.
+
+core.py has no UI dependencies but resolves its database and attachment
+paths relative to the current directory, so the benchmarks import it inside
+a scratch working directory.
+"""
+import importlib
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(REPO_ROOT, 'app.py')
+
+
+def load_app(workdir):
+    """Return the core module with cwd switched to `workdir` and the schema created."""
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    module = importlib.import_module('core')
+    module.init_db()
+    return module
@@ -0,0 +1,222 @@
+"""Database and page-query benchmark at 10k/100k/1M-row scale.
+
+Seeds a scratch compliance_emails.db with synthetic companies, extra
+recipients, send history, email logs and error logs, then times every page
+helper and each page's full data-loading path (the helpers a page calls on a
+plain render, in order). Timings are the median of ``--repeat`` runs; peak
+Python memory per call is measured in a separate tracemalloc pass so it does
+not skew the timings.
+
+    python benchmarks/bench_db.py --scale 100k --output db-100k.json
+    python benchmarks/bench_db.py --scale 100k --baseline db-100k.json
+
+With ``--baseline`` the run fails (exit 1) when any helper or page is slower,
+or allocates more, than the baseline by more than ``--max-regression`` (plus a
+small absolute slack so sub-millisecond noise never trips it).
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from _app import load_app
+from results import environment, peak_rss_mb, write_results
+from seed import seed_companies, seed_logs, seed_send_history
+
+SCALES = {
+    '10k': {'companies': 1000, 'logs': 10000, 'errors': 1000},
+    '100k': {'companies': 10000, 'logs': 100000, 'errors': 10000},
+    '1m': {'companies': 100000, 'logs': 1000000, 'errors': 100000},
+}
+
+
+def _window(days):
+    today = datetime.now().date()
+    return today - timedelta(days=days), today
+
+
+# Individual helpers, called the way the pages call them
+HELPERS = {
+    'get_companies_data': lambda app, ref: app.get_companies_data(),
+    'get_company_emails': lambda app, ref: app.get_company_emails(ref),
+    'resolve_company_recipients': lambda app, ref: app.resolve_company_recipients([ref]),
+    'get_email_stats': lambda app, ref: app.get_email_stats(),
+    'get_email_stats_30d': lambda app, ref: app.get_email_stats(*_window(30)),
+    'get_daily_status_counts_30d': lambda app, ref: app.get_daily_status_counts(*_window(30)),
+    'get_company_summary': lambda app, ref: app.get_company_summary(),
+    'get_email_logs_all': lambda app, ref: app.get_email_logs(),
+    'get_email_logs_30d': lambda app, ref: app.get_email_logs(start=_window(30)[0]),
+    'get_email_logs_company': lambda app, ref: app.get_email_logs(uif_ref=ref),
+    'get_error_logs': lambda app, ref: app.get_error_logs(),
+    'get_error_logs_company': lambda app, ref: app.get_error_logs(uif_ref=ref),
+    'get_unreachable_companies': lambda app, ref: app.get_unreachable_companies(),
+    'get_delivery_health_top50': lambda app, ref: app.get_delivery_health(limit=50),
+    'get_delivery_health_summary': lambda app, ref: app.get_delivery_health_summary(),
+    'get_due_companies': lambda app, ref: app.get_due_companies(),
+    'count_due_companies': lambda app, ref: app.count_due_companies(),
+    'get_reply_events': lambda app, ref: app.get_reply_events(limit=100),
+    'get_email_deliveries': lambda app, ref: app.get_email_deliveries(),
+}
+
+# What each page loads on a default render (the sidebar runs on every page)
+PAGES = {
+    'sidebar': ('get_schedule_settings', 'count_due_companies', 'get_retry_queue', 'get_stale_claims'),
+    'dashboard': ('get_email_stats', 'get_company_summary'),
+    'send_emails': ('get_companies_data', 'get_due_companies', 'get_campaigns'),
+    'email_logs': (
+        'get_email_stats_30d', 'get_company_summary', 'get_daily_status_counts_30d', 'get_email_logs_all',
+        'get_email_deliveries', 'get_error_logs', 'get_log_archives', 'get_retention_settings'
+    ),
+    'completed_companies': ('get_companies_data',),
+    'unreachable_companies': ('get_delivery_health_summary', 'get_delivery_health_top50', 'get_suppressed_recipients'),
+    'company_management': ('get_companies_data', 'get_company_emails', 'get_reply_events'),
+}
+
+
+def _call(app, name, ref):
+    helper = HELPERS.get(name)
+    return helper(app, ref) if helper else getattr(app, name)()
+
+
+def _measure(func, repeat):
+    """Median and min wall time in ms over `repeat` calls, then peak traced allocation in MiB for one more."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+    rows = len(result) if hasattr(result, '__len__') and not isinstance(result, (dict, str)) else None
+    del result
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'median_ms': round(statistics.median(samples), 3),
+        'min_ms': round(min(samples), 3),
+        'peak_mb': round(peak / (1024 * 1024), 3),
+        'rows': rows,
+    }
+
+
+def seed(app, companies, logs, errors, recipients):
+    started = time.perf_counter()
+    refs = seed_companies(app.DATABASE_FILE, companies, recipients, completed_ratio=0.2)
+    seed_send_history(app.DATABASE_FILE)
+    seed_logs(app, refs, logs, errors)
+    return refs, round(time.perf_counter() - started, 3)
+
+
+def run(companies, logs, errors, recipients, repeat, workdir, only=None):
+    app = load_app(workdir)
+    refs, seed_s = seed(app, companies, logs, errors, recipients)
+    sample_ref = refs[len(refs) // 2]
+
+    helpers = {}
+    for name in HELPERS:
+        if only and name not in only:
+            continue
+        helpers[name] = _measure(lambda: _call(app, name, sample_ref), repeat)
+
+    pages = {}
+    for page, names in PAGES.items():
+        if only and page not in only:
+            continue
+        pages[page] = _measure(lambda: [_call(app, name, sample_ref) for name in names], repeat)
+        del pages[page]['rows']
+
+    return {
+        'benchmark': 'db_scale',
+        'params': {
+            'companies': companies,
+            'logs': logs,
+            'errors': errors,
+            'recipients_per_company': recipients,
+            'repeat': repeat,
+        },
+        'seed_s': seed_s,
+        'db_size_mb': round(os.path.getsize(app.DATABASE_FILE) / (1024 * 1024), 1),
+        'helpers': helpers,
+        'pages': pages,
+        'peak_rss_mb': peak_rss_mb(),
+        'environment': environment(),
+    }
+
+
+def check_regressions(results, baseline, max_regression, slack_ms, slack_mb):
+    """Compare against a previous result file; returns a list of human-readable failures."""
+    failures = []
+    for section in ('helpers', 'pages'):
+        for name, current in results.get(section, {}).items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous:
+                continue
+            limit_ms = previous['median_ms'] * max_regression + slack_ms
+            if current['median_ms'] > limit_ms:
+                failures.append(f"{section}.{name}: {current['median_ms']} ms > {limit_ms:.3f} ms (baseline {previous['median_ms']} ms)")
+            limit_mb = previous['peak_mb'] * max_regression + slack_mb
+            if current['peak_mb'] > limit_mb:
+                failures.append(f"{section}.{name}: {current['peak_mb']} MiB > {limit_mb:.3f} MiB (baseline {previous['peak_mb']} MiB)")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k', help='row-count preset')
+    parser.add_argument('--companies', type=int, help='override the preset company count')
+    parser.add_argument('--logs', type=int, help='override the preset email log row count (e.g. 5000000)')
+    parser.add_argument('--errors', type=int, help='override the preset error log row count')
+    parser.add_argument('--recipients', type=int, default=2, help='addresses per company (primary + extras)')
+    parser.add_argument('--repeat', type=int, default=5, help='timed calls per helper/page; the median is reported')
+    parser.add_argument('--only', nargs='+', help='limit the run to these helper and/or page names')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--baseline', help='previous JSON result to check for regressions against')
+    parser.add_argument('--max-regression', type=float, default=1.5, help='allowed ratio over the baseline (default 1.5)')
+    parser.add_argument('--slack-ms', type=float, default=5.0, help='absolute time slack added to each limit')
+    parser.add_argument('--slack-mb', type=float, default=1.0, help='absolute memory slack added to each limit')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch working directory')
+    args = parser.parse_args(argv)
+    preset = SCALES[args.scale]
+    output = os.path.abspath(args.output) if args.output else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    original_cwd = os.getcwd()
+
+    workdir = tempfile.mkdtemp(prefix='bench_db_')
+    try:
+        results = run(
+            args.companies or preset['companies'],
+            args.logs if args.logs is not None else preset['logs'],
+            args.errors if args.errors is not None else preset['errors'],
+            args.recipients, args.repeat, workdir, set(args.only or ())
+        )
+        results['params']['scale'] = args.scale
+        results['workdir'] = workdir if args.keep else None
+        failures = []
+        if baseline_path:
+            with open(baseline_path, encoding='utf-8') as handle:
+                baseline = json.load(handle)
+            failures = check_regressions(results, baseline, args.max_regression, args.slack_ms, args.slack_mb)
+            results['regressions'] = failures
+        write_results(results, output)
+    finally:
+        os.chdir(original_cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if failures:
+        print(f"{len(failures)} regression(s) against {baseline_path}:", file=sys.stderr)
+        for failure in failures:
+            print(f"  {failure}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""End-to-end send throughput benchmark.
+
+Seeds a scratch compliance_emails.db with synthetic companies, starts the
+local SMTP/IMAP stand-ins and sends them as a campaign (the path every
+selection over INLINE_SEND_LIMIT takes) through the real
+``run_campaign_chunk`` -> ``send_email_detailed`` ->
+``append_email_to_sent_folder`` path with the inter-send throttle disabled. Prints (and optionally writes) JSON with
+messages/sec, per-stage latency percentiles, bytes sent and peak RSS.
+
+    python benchmarks/bench_send.py --companies 200 --recipients 2 --summary-kb 64 --output send.json
+"""
+import argparse
+import imaplib
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from _app import load_app
+from results import StageTimer, environment, peak_rss_mb, write_results
+from seed import copy_attachments, seed_companies, seed_summary_files
+from stand_ins import StandIns
+
+# App functions timed as stages of the send path
+APP_STAGES = {
+    'send_email_detailed': 'message_total',
+    'append_email_to_sent_folder': 'imap_append',
+    'get_email_template': 'template_render',
+    'resolve_company_recipients': 'recipient_resolution',
+    'claim_send': 'ledger_claim',
+    'record_send_outcome': 'bookkeeping',
+    'flush_log_buffer': 'log_flush',
+}
+SMTP_STAGES = {
+    'connect': 'smtp_connect',
+    'starttls': 'smtp_starttls',
+    'login': 'smtp_login',
+    'sendmail': 'smtp_sendmail',
+}
+
+
+def instrument(app, timer):
+    """Wrap app functions and smtplib.SMTP methods so each stage is timed. Returns an undo callable."""
+    originals = []
+    message_started = threading.local()
+
+    for name, stage in APP_STAGES.items():
+        original = getattr(app, name)
+        originals.append((app, name, original))
+        setattr(app, name, timer.wrap(stage, original))
+
+    # Composition time: from entering send_email_detailed until the SMTP connection opens
+    timed_send = app.send_email_detailed
+
+    def send_with_mark(*args, **kwargs):
+        message_started.value = time.perf_counter()
+        return timed_send(*args, **kwargs)
+    app.send_email_detailed = send_with_mark
+
+    for method, stage in SMTP_STAGES.items():
+        original = getattr(smtplib.SMTP, method)
+        originals.append((smtplib.SMTP, method, original))
+        timed = timer.wrap(stage, original)
+        if method == 'connect':
+            def connect(self, *args, _timed=timed, **kwargs):
+                started = getattr(message_started, 'value', None)
+                if started is not None:
+                    timer.record('message_compose', (time.perf_counter() - started) * 1000)
+                    message_started.value = None
+                return _timed(self, *args, **kwargs)
+            timed = connect
+        setattr(smtplib.SMTP, method, timed)
+
+    original_imap_init = imaplib.IMAP4_SSL.__init__
+    originals.append((imaplib.IMAP4_SSL, '__init__', original_imap_init))
+    imaplib.IMAP4_SSL.__init__ = timer.wrap('imap_connect', original_imap_init)
+
+    def undo():
+        for owner, name, original in reversed(originals):
+            setattr(owner, name, original)
+    return undo
+
+
+def run(companies, recipients, summary_kb, attach_pdfs, workdir):
+    app = load_app(workdir)
+    refs = set(seed_companies(app.DATABASE_FILE, companies, recipients))
+    seed_summary_files(sorted(refs), summary_kb)
+    if attach_pdfs:
+        copy_attachments()
+
+    timer = StageTimer()
+    with StandIns() as stand_ins:
+        stand_ins.point_app_at(app)
+        campaign_id = app.create_campaign(f"bench {datetime.now():%Y%m%d%H%M%S}", sorted(refs))
+        undo = instrument(app, timer)
+        started = time.perf_counter()
+        try:
+            while True:
+                chunk = app.run_campaign_chunk(campaign_id, 'bench-password', interval=0)
+                if not chunk['remaining'] or chunk['circuit_open']:
+                    break
+        finally:
+            undo()
+        elapsed = time.perf_counter() - started
+        smtp = stand_ins.smtp_stats.snapshot()
+        imap = stand_ins.imap_stats.snapshot()
+
+    messages = smtp.get('messages', 0)
+    return {
+        'benchmark': 'send_throughput',
+        'params': {
+            'companies': companies,
+            'recipients_per_company': recipients,
+            'summary_kb': summary_kb,
+            'attach_pdfs': attach_pdfs,
+            'throttle_seconds': 0,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'messages': messages,
+        'messages_per_sec': round(messages / elapsed, 3) if elapsed else None,
+        'messages_per_min': round(messages / elapsed * 60, 1) if elapsed else None,
+        'recipients_accepted': smtp.get('recipients', 0),
+        'bytes_sent': smtp.get('bytes', 0),
+        'imap_appends': imap.get('appends', 0),
+        'imap_bytes': imap.get('append_bytes', 0),
+        'stages': timer.report(),
+        'peak_rss_mb': peak_rss_mb(),
+        'environment': environment(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--companies', type=int, default=100)
+    parser.add_argument('--recipients', type=int, default=1, help='addresses per company (primary + extras)')
+    parser.add_argument('--summary-kb', type=int, default=32, help='size of the per-company summary attachment; 0 for none')
+    parser.add_argument('--no-pdfs', action='store_true', help='skip the two static PDF attachments')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the scratch working directory')
+    args = parser.parse_args(argv)
+    # The run chdirs into the scratch directory, so pin the output path first
+    output = os.path.abspath(args.output) if args.output else None
+    original_cwd = os.getcwd()
+
+    workdir = tempfile.mkdtemp(prefix='bench_send_')
+    try:
+        results = run(args.companies, args.recipients, args.summary_kb, not args.no_pdfs, workdir)
+        results['workdir'] = workdir if args.keep else None
+        write_results(results, output)
+    finally:
+        os.chdir(original_cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Cold-start benchmark: core import time and first/warm page render times.
+
+Each measurement runs in a fresh interpreter so module caches start cold:
+
+- ``core`` import time (plus its heaviest imports, from ``python -X importtime``);
+- the first render of each page through Streamlit's AppTest (the production
+  script, run on a seeded scratch database), then a warm rerun, and which
+  heavy UI libraries the page ended up loading (Streamlit's test harness
+  already imports plotly and PIL itself, so those only show up when the
+  page script is the first to need them).
+
+    python benchmarks/bench_startup.py --pages dashboard email_logs --output startup.json
+
+The navigation menu is a custom component that AppTest cannot click, so the
+child process patches ``streamlit_option_menu.option_menu`` to pick the page.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from _app import APP_FILE, REPO_ROOT, load_app
+from results import environment, write_results
+from seed import seed_companies, seed_logs
+
+PAGES = {
+    'dashboard': "🏠 Dashboard",
+    'company_management': "🏢 Company Management",
+    'send_emails': "✉️ Send Emails",
+    'email_logs': "📊 Email Analytics",
+    'completed_companies': "✅ Completed Companies",
+    'email_templates': "📝 Email Templates",
+    'unreachable_companies': "🚫 Unreachable Companies",
+}
+HEAVY_MODULES = ('plotly', 'PIL', 'streamlit_extras', 'streamlit_option_menu', 'pyarrow', 'openpyxl')
+
+
+def measure_core_import(repeat):
+    """Median wall time of `import core` in fresh interpreters, plus the heaviest imports of one run."""
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', 'import time; t = time.perf_counter(); import core; print((time.perf_counter() - t) * 1000)'],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        samples.append(float(output.strip()))
+    trace = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import core'], cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    ).stderr
+    direct = []
+    for line in trace.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        # Nesting is shown as two extra spaces per level; level 1 holds core's own imports
+        depth = (len(package) - len(package.lstrip()) - 1) // 2
+        if depth == 1 and cumulative.strip().isdigit():
+            direct.append((package.strip(), int(cumulative) / 1000))
+    direct.sort(key=lambda item: item[1], reverse=True)
+    return {
+        'median_ms': round(statistics.median(samples), 1),
+        'min_ms': round(min(samples), 1),
+        'heaviest_imports_ms': {name: round(ms, 1) for name, ms in direct[:8]},
+    }
+
+
+def render_child(page, workdir):
+    """Runs in a fresh interpreter: render `page` twice with AppTest and print the timings as JSON."""
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import streamlit_option_menu
+    from streamlit.testing.v1 import AppTest
+
+    streamlit_option_menu.option_menu = lambda *args, **kwargs: PAGES[page]
+    preloaded = {name for name in HEAVY_MODULES if name in sys.modules}
+    app_test = AppTest.from_file(APP_FILE, default_timeout=120)
+    started = time.perf_counter()
+    app_test.run()
+    first_ms = (time.perf_counter() - started) * 1000
+    loaded = sorted(name for name in HEAVY_MODULES if name in sys.modules and name not in preloaded)
+    started = time.perf_counter()
+    app_test.run()
+    warm_ms = (time.perf_counter() - started) * 1000
+    print(json.dumps({
+        'first_render_ms': round(first_ms, 1),
+        'warm_render_ms': round(warm_ms, 1),
+        'exceptions': [str(exception.value) for exception in app_test.exception],
+        'ui_modules_loaded': loaded,
+    }))
+
+
+def prepare_workdir(workdir, companies, logs):
+    """Seeded scratch database plus the static files the page script reads."""
+    app = load_app(workdir)
+    refs = seed_companies(app.DATABASE_FILE, companies, 2, completed_ratio=0.2)
+    seed_logs(app, refs, logs, errors=logs // 10)
+    os.makedirs('static', exist_ok=True)
+    for name in (os.path.join('static', 'styles.css'), 'GD logo.png'):
+        if os.path.exists(os.path.join(REPO_ROOT, name)):
+            shutil.copy(os.path.join(REPO_ROOT, name), name)
+    if not os.path.exists(os.path.join('static', 'styles.css')):
+        open(os.path.join('static', 'styles.css'), 'w').close()
+
+
+def run(pages, companies, logs, repeat, workdir):
+    prepare_workdir(workdir, companies, logs)
+    results = {'benchmark': 'startup', 'params': {'companies': companies, 'logs': logs, 'repeat': repeat}}
+    results['core_import'] = measure_core_import(repeat)
+    results['pages'] = {}
+    for page in pages:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', page, workdir],
+                capture_output=True, text=True, check=True
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        results['pages'][page] = {
+            'first_render_ms': round(statistics.median(r['first_render_ms'] for r in runs), 1),
+            'warm_render_ms': round(statistics.median(r['warm_render_ms'] for r in runs), 1),
+            'ui_modules_loaded': runs[-1]['ui_modules_loaded'],
+            'exceptions': runs[-1]['exceptions'],
+        }
+    results['environment'] = environment()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pages', nargs='+', choices=sorted(PAGES), default=sorted(PAGES))
+    parser.add_argument('--companies', type=int, default=1000)
+    parser.add_argument('--logs', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh-process runs per measurement; the median is reported')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    parser.add_argument('--child', nargs=2, metavar=('PAGE', 'WORKDIR'), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        render_child(*args.child)
+        return
+    output = os.path.abspath(args.output) if args.output else None
+    original_cwd = os.getcwd()
+
+    workdir = tempfile.mkdtemp(prefix='bench_startup_')
+    try:
+        write_results(run(args.pages, args.companies, args.logs, args.repeat, workdir), output)
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
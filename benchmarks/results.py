@@ -0,0 +1,104 @@
+"""Timing helpers and machine-readable result output shared by the benchmarks."""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None when empty)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def summarize(samples_ms):
+    return {
+        'count': len(samples_ms),
+        'mean_ms': round(sum(samples_ms) / len(samples_ms), 3) if samples_ms else None,
+        'p50_ms': _round(percentile(samples_ms, 50)),
+        'p95_ms': _round(percentile(samples_ms, 95)),
+        'p99_ms': _round(percentile(samples_ms, 99)),
+        'max_ms': _round(max(samples_ms) if samples_ms else None),
+    }
+
+
+def _round(value):
+    return round(value, 3) if value is not None else None
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (None where unsupported)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class StageTimer:
+    """Collects per-stage latency samples in milliseconds."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def record(self, stage, elapsed_ms):
+        self.samples.setdefault(stage, []).append(elapsed_ms)
+
+    @contextmanager
+    def time(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - started) * 1000)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            with self.time(stage):
+                return func(*args, **kwargs)
+        timed.__wrapped__ = func
+        return timed
+
+    def report(self):
+        return {stage: summarize(values) for stage, values in self.samples.items()}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def environment():
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_revision': _git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def write_results(results, output=None):
+    """Print results as JSON, and also write them to `output` when given."""
+    text = json.dumps(results, indent=2, default=str)
+    if output:
+        with open(output, 'w', encoding='utf-8') as handle:
+            handle.write(text + '\n')
+    print(text)
@@ -0,0 +1,109 @@
+"""Synthetic data for benchmarks: companies, extra recipients, send history, logs and summary files."""
+import os
+import random
+import shutil
+import sqlite3
+from datetime import datetime, timedelta
+
+from _app import REPO_ROOT
+
+SUMMARY_FOLDER = "PHASE 4 - Employer Claims Summaries"
+ATTACHMENTS = (
+    "Ditheto Accountants - Appointment Letter and Audit Notification.pdf",
+    "Letter of demand _UIF TERS Audit_250729_150955.pdf",
+)
+LOG_STATUSES = ('Sent',) * 8 + ('Bounced', 'Failed')
+LOG_SUBJECTS = tuple(f"UIF TERS Audit - Follow-up {n}" for n in range(1, 13))
+
+
+def uif_reference(i):
+    return f"{i:07d}/{i % 10}"
+
+
+def seed_companies(database_file, count, recipients_per_company=1, completed_ratio=0.0, seed=7):
+    """Insert `count` companies, each with `recipients_per_company` addresses (primary + extras)."""
+    rng = random.Random(seed)
+    companies = []
+    extras = []
+    for i in range(1, count + 1):
+        ref = uif_reference(i)
+        completed = 1 if rng.random() < completed_ratio else 0
+        companies.append((ref, f"Bench Trading {i} (Pty) Ltd", f"c{i}@bench.invalid", f"0{rng.randint(100000000, 999999999)}", completed))
+        extras.extend((ref, f"c{i}.extra{n}@bench.invalid") for n in range(1, recipients_per_company))
+    with sqlite3.connect(database_file) as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, PHONE, completed) VALUES (?, ?, ?, ?, ?)",
+            companies
+        )
+        conn.executemany("INSERT OR IGNORE INTO company_emails (UIF_REFERENCE, EMAIL) VALUES (?, ?)", extras)
+        conn.commit()
+    return [c[0] for c in companies]
+
+
+def seed_send_history(database_file, days=60, seed=7):
+    """Give every company a send count, last send and next due date so the due-queue queries have work to do."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    with sqlite3.connect(database_file) as conn:
+        refs = [row[0] for row in conn.execute("SELECT UIF_REFERENCE FROM companies")]
+        updates = []
+        for ref in refs:
+            last_sent = now - timedelta(seconds=rng.randrange(days * 86400))
+            next_due = last_sent + timedelta(days=rng.randint(1, 14))
+            updates.append((rng.randint(0, 12), last_sent.strftime('%Y-%m-%d %H:%M:%S'), next_due.strftime('%Y-%m-%d %H:%M:%S'), ref))
+        conn.executemany("UPDATE companies SET emails_sent = ?, last_sent = ?, next_due_at = ? WHERE UIF_REFERENCE = ?", updates)
+        conn.commit()
+
+
+def seed_logs(app, refs, rows, errors=0, days=365, batch=50000, seed=11):
+    """Bulk-insert `rows` log entries (and `errors` error rows) spread over the last `days` days.
+
+    Writes go through the app's own insert helpers so the rollup and
+    delivery-health triggers fire exactly as they do in production.
+    """
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=days)
+    span = days * 86400
+    with sqlite3.connect(app.DATABASE_FILE) as conn:
+        written = 0
+        while written < rows:
+            chunk = []
+            for _ in range(min(batch, rows - written)):
+                moment = start + timedelta(seconds=rng.randrange(span))
+                stamp = moment.strftime('%Y-%m-%d %H:%M:%S')
+                chunk.append((rng.choice(refs), stamp, stamp[:10], rng.choice(LOG_SUBJECTS), rng.choice(LOG_STATUSES)))
+            app._insert_log_rows(conn, chunk)
+            conn.commit()
+            written += len(chunk)
+        error_rows = []
+        for i in range(errors):
+            moment = start + timedelta(seconds=rng.randrange(span))
+            error_rows.append((
+                None, rng.choice(refs), f"c{i}@bench.invalid", 'SMTP Send', moment.strftime('%Y-%m-%d %H:%M:%S'),
+                'SMTPServerDisconnected', 'Connection unexpectedly closed',
+                f"Traceback (most recent call last):\n  File \"app.py\", line {rng.randint(1, 40)}\nSMTPServerDisconnected"
+            ))
+        for offset in range(0, len(error_rows), batch):
+            app._insert_error_rows(conn, error_rows[offset:offset + batch])
+        conn.commit()
+
+
+def seed_summary_files(refs, size_kb):
+    """One .xlsx-named summary per company so the send path attaches it (content is random bytes)."""
+    if size_kb <= 0:
+        return
+    os.makedirs(SUMMARY_FOLDER, exist_ok=True)
+    payload = os.urandom(size_kb * 1024)
+    for ref in refs:
+        clean = ref.replace('/', '_')
+        with open(os.path.join(SUMMARY_FOLDER, f"{clean} Claims Summary.xlsx"), 'wb') as handle:
+            handle.write(payload)
+
+
+def copy_attachments():
+    """Copy the real PDF attachments from the repo so message sizes match production."""
+    for name in ATTACHMENTS:
+        source = os.path.join(REPO_ROOT, name)
+        if os.path.exists(source):
+            shutil.copy(source, name)
+
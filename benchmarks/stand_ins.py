@@ -0,0 +1,216 @@
+"""Local SMTP (STARTTLS) and IMAP (implicit TLS) stand-ins for benchmarks.
+
+They implement just enough of each protocol for the app's send path:
+EHLO/STARTTLS/AUTH PLAIN/MAIL/RCPT/DATA for SMTP and
+CAPABILITY/LOGIN/LIST/SELECT/EXAMINE/APPEND/LOGOUT for IMAP. Messages are
+counted, not stored. Recipients whose local part starts with ``refuse`` get
+a 550 at RCPT so bounce handling can be exercised.
+"""
+import os
+import re
+import socket
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+
+
+def make_tls_context(workdir=None):
+    """Server-side TLS context with a throwaway self-signed certificate (needs the openssl CLI)."""
+    workdir = workdir or tempfile.mkdtemp(prefix='bench_tls_')
+    cert = os.path.join(workdir, 'cert.pem')
+    key = os.path.join(workdir, 'key.pem')
+    if not os.path.exists(cert):
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+             '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+            check=True, capture_output=True
+        )
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+class _Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.values[key] = self.values.get(key, 0) + value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, tls_context, stats):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.tls_context = tls_context
+        self.stats = stats
+
+    def get_request(self):
+        # Small TLS records plus Nagle/delayed ACK would add ~40 ms stalls that a real relay does not have
+        connection, address = super().get_request()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, text):
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def _start_tls(self):
+        self.connection = self.server.tls_context.wrap_socket(self.connection, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb')
+
+    def handle(self):
+        self._reply('220 localhost ESMTP bench')
+        tls = False
+        recipients = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.split(b' ', 1)[0].strip().upper()
+            if verb in (b'EHLO', b'HELO'):
+                lines = ['250-localhost', '250-SIZE 52428800', '250-8BITMIME']
+                lines.append('250 AUTH PLAIN' if tls else '250 STARTTLS')
+                self.wfile.write(('\r\n'.join(lines) + '\r\n').encode('ascii'))
+                self.wfile.flush()
+            elif verb == b'STARTTLS':
+                self._reply('220 Ready to start TLS')
+                self._start_tls()
+                tls = True
+            elif verb == b'AUTH':
+                self._reply('235 Authentication successful')
+            elif verb == b'MAIL':
+                recipients = 0
+                self._reply('250 OK')
+            elif verb == b'RCPT':
+                address = line.decode('ascii', 'replace')
+                if re.search(r'<refuse', address, re.IGNORECASE):
+                    self.server.stats.add(refused=1)
+                    self._reply('550 5.1.1 User unknown')
+                else:
+                    recipients += 1
+                    self._reply('250 OK')
+            elif verb == b'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk == b'.\r\n':
+                        break
+                    size += len(chunk)
+                self.server.stats.add(messages=1, bytes=size, recipients=recipients)
+                self._reply('250 OK queued')
+            elif verb in (b'RSET', b'NOOP'):
+                self._reply('250 OK')
+            elif verb == b'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+
+    def _send(self, text):
+        self.wfile.write(text.encode('utf-8') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self._send('* OK bench IMAP4rev1 ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.decode('utf-8', 'replace').rstrip('\r\n').split(' ', 2)
+            if len(parts) < 2:
+                continue
+            tag, command = parts[0], parts[1].upper()
+            args = parts[2] if len(parts) > 2 else ''
+            if command == 'CAPABILITY':
+                self._send('* CAPABILITY IMAP4rev1 AUTH=PLAIN')
+                self._send(f'{tag} OK CAPABILITY completed')
+            elif command == 'LOGIN':
+                self._send(f'{tag} OK LOGIN completed')
+            elif command == 'LIST':
+                self._send('* LIST (\\HasNoChildren) "/" "INBOX"')
+                self._send('* LIST (\\HasNoChildren \\Sent) "/" "Sent"')
+                self._send(f'{tag} OK LIST completed')
+            elif command in ('SELECT', 'EXAMINE'):
+                mode = 'READ-ONLY' if command == 'EXAMINE' else 'READ-WRITE'
+                self._send('* 0 EXISTS')
+                self._send(f'{tag} OK [{mode}] {command} completed')
+            elif command == 'APPEND':
+                match = re.search(r'\{(\d+)\}$', args)
+                size = int(match.group(1)) if match else 0
+                self._send('+ Ready for literal data')
+                remaining = size
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 65536))
+                    if not chunk:
+                        return
+                    remaining -= len(chunk)
+                self.rfile.readline()
+                self.server.stats.add(appends=1, append_bytes=size)
+                self._send(f'{tag} OK APPEND completed')
+            elif command == 'LOGOUT':
+                self._send('* BYE logging out')
+                self._send(f'{tag} OK LOGOUT completed')
+                return
+            else:
+                self._send(f'{tag} OK {command} completed')
+
+
+class StandIns:
+    """Start both stand-ins on ephemeral localhost ports; use as a context manager."""
+
+    def __init__(self, tls_context=None):
+        self.tls_context = tls_context or make_tls_context()
+        self.smtp_stats = _Stats()
+        self.imap_stats = _Stats()
+        self.smtp = _Server(_SMTPHandler, self.tls_context, self.smtp_stats)
+        self.imap = _Server(_IMAPHandler, self.tls_context, self.imap_stats)
+        self._threads = []
+
+    @property
+    def smtp_port(self):
+        return self.smtp.server_address[1]
+
+    @property
+    def imap_port(self):
+        return self.imap.server_address[1]
+
+    def __enter__(self):
+        for server in (self.smtp, self.imap):
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def __exit__(self, *exc):
+        for server in (self.smtp, self.imap):
+            server.shutdown()
+            server.server_close()
+        return False
+
+    def point_app_at(self, app):
+        """Route the loaded app module's SMTP/IMAP traffic to the stand-ins."""
+        app.SMTP_SERVER = app.IMAP_SERVER = '127.0.0.1'
+        app.SMTP_PORT = self.smtp_port
+        app.IMAP_PORT = self.imap_port
@@ -0,0 +1,329 @@
+"""Headless runner for campaigns, follow-up rounds, imports, inbox scans, exports and maintenance.
+
+Works straight against compliance_emails.db through core.py without importing
+Streamlit, so sends can run from cron or a systemd timer instead of an open
+browser tab. Run it from the app directory: the database, summaries and PDF
+attachments are resolved relative to the working directory.
+
+    export EMAIL_AUTOMATOR_SMTP_PASSWORD=...
+    python cli.py follow-ups
+    python cli.py campaign create "March reminders" --refs-file refs.txt --run
+    python cli.py --json campaign run 12
+    python cli.py export email_logs --output logs.csv
+    python cli.py maintenance          # backup/optimize/vacuum, whichever is due
+
+Progress goes to stdout, one line per event (JSON lines with --json); log
+messages go to stderr. Exit codes: 0 done, 1 some sends or the command
+failed, 2 usage or configuration error, 3 stopped by the circuit breaker,
+130 interrupted (SIGINT/SIGTERM stop after the message in flight).
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import threading
+from datetime import datetime
+
+import core
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_CIRCUIT_OPEN = 3
+EXIT_INTERRUPTED = 130
+
+PASSWORD_ENV = 'EMAIL_AUTOMATOR_SMTP_PASSWORD'
+EXPORT_KINDS = ('email_logs', 'email_error_logs', 'completed_companies', 'unreachable')
+
+_json_output = False
+_stop_event = threading.Event()
+
+
+class UsageError(Exception):
+    """Bad arguments or missing configuration; exits with EXIT_USAGE."""
+
+
+def emit(event, **fields):
+    """Write one progress event to stdout."""
+    if _json_output:
+        print(json.dumps({'event': event, 'time': datetime.now().isoformat(timespec='seconds'), **fields}, default=str), flush=True)
+    else:
+        details = ' '.join(f"{key}={value}" for key, value in fields.items())
+        print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {event} {details}".rstrip(), flush=True)
+
+
+def _cli_notifier(level, message):
+    # Dry-run previews are whole HTML bodies; keep them out of the progress stream unless --verbose
+    levels = {'error': logging.ERROR, 'warning': logging.WARNING, 'code': logging.DEBUG}
+    core.logger.log(levels.get(level, logging.INFO), message)
+
+
+def _request_stop(signum, frame):
+    if not _stop_event.is_set():
+        core.logger.warning("Received %s; stopping after the message in flight", signal.Signals(signum).name)
+    _stop_event.set()
+
+
+def smtp_password(args):
+    """Password from --password-file or the environment; never from the command line, where `ps` would show it."""
+    if args.password_file:
+        with open(args.password_file, encoding='utf-8') as handle:
+            password = handle.read().strip()
+    else:
+        password = os.environ.get(PASSWORD_ENV, '')
+    if not password:
+        raise UsageError(f"SMTP password required: set {PASSWORD_ENV} or pass --password-file")
+    return password
+
+
+def _send_exit_code(summary):
+    if _stop_event.is_set():
+        return EXIT_INTERRUPTED
+    if summary.get('circuit_open'):
+        return EXIT_CIRCUIT_OPEN
+    return EXIT_FAILED if summary.get('failed') else EXIT_OK
+
+
+def _read_refs(args):
+    refs = list(args.refs or [])
+    if args.refs_file:
+        with open(args.refs_file, encoding='utf-8') as handle:
+            refs.extend(line.strip() for line in handle if line.strip() and not line.startswith('#'))
+    if args.due:
+        refs.extend(core.get_due_companies(args.limit)['UIF_REFERENCE'].tolist())
+    return refs
+
+
+def cmd_import(args):
+    df, sheet = core.read_company_file(args.file, args.sheet)
+    result = core.import_companies(df)
+    if result['missing']:
+        emit('import_failed', file=args.file, missing=','.join(result['missing']))
+        return EXIT_FAILED
+    emit('imported', file=args.file, sheet=sheet, imported=result['imported'], skipped=result['skipped'])
+    return EXIT_OK
+
+
+def cmd_campaign_create(args):
+    if args.email_type not in core.EMAIL_TYPE_OPTIONS:
+        raise UsageError(f"--email-type must be one of: {', '.join(core.EMAIL_TYPE_OPTIONS)}")
+    refs = _read_refs(args)
+    if not refs:
+        emit('campaign_empty', name=args.name)
+        return EXIT_OK
+    campaign_id = core.create_campaign(args.name, refs, args.email_type, args.dry_run)
+    emit('campaign_created', campaign_id=campaign_id, name=args.name, companies=len(set(refs)), dry_run=args.dry_run)
+    if not args.run:
+        return EXIT_OK
+    args.campaign_id = campaign_id
+    return cmd_campaign_run(args)
+
+
+def cmd_campaign_run(args):
+    campaigns = core.get_campaigns(limit=1000)
+    match = campaigns[campaigns['campaign_id'] == args.campaign_id]
+    if match.empty:
+        raise UsageError(f"No campaign {args.campaign_id}")
+    campaign = match.iloc[0]
+    if campaign['status'] in ('completed', 'cancelled'):
+        emit('campaign_finished', campaign_id=args.campaign_id, status=campaign['status'])
+        return EXIT_OK
+    password = '' if campaign['dry_run'] else smtp_password(args)
+    totals = {'sent': 0, 'deferred': 0, 'failed': 0, 'skipped': 0}
+
+    def on_chunk(summary):
+        for key in totals:
+            totals[key] += summary[key]
+        progress = core.get_campaign_progress(args.campaign_id)
+        emit('campaign_progress', campaign_id=args.campaign_id, done=progress['done'], total=progress['total'],
+             eta_seconds=progress['eta_seconds'], in_flight=summary['in_flight'], **{key: summary[key] for key in totals})
+
+    emit('campaign_started', campaign_id=args.campaign_id, name=campaign['name'], dry_run=bool(campaign['dry_run']))
+    status = core.run_campaign(
+        args.campaign_id, password, _stop_event, chunk_size=args.chunk_size, interval=args.interval, on_chunk=on_chunk
+    )
+    last_chunk = status.get('last_chunk') or {}
+    if status['last_error']:
+        event = 'campaign_failed'
+    else:
+        event = 'campaign_paused' if last_chunk.get('remaining') else 'campaign_done'
+    emit(event, campaign_id=args.campaign_id, remaining=last_chunk.get('remaining'),
+         circuit_open=last_chunk.get('circuit_open', False), error=status['last_error'], **totals)
+    if status['last_error']:
+        return EXIT_FAILED
+    return _send_exit_code({**totals, 'circuit_open': last_chunk.get('circuit_open')})
+
+
+def cmd_campaign_list(args):
+    for campaign in core.get_campaigns(args.limit).to_dict('records'):
+        emit('campaign', **{key: campaign[key] for key in ('campaign_id', 'name', 'status', 'total', 'dry_run', 'created_at', 'updated_at')})
+    return EXIT_OK
+
+
+def cmd_campaign_status(args):
+    progress = core.get_campaign_progress(args.campaign_id)
+    if not progress['total']:
+        raise UsageError(f"No campaign {args.campaign_id}")
+    emit('campaign_status', campaign_id=args.campaign_id, done=progress['done'], total=progress['total'],
+         eta_seconds=progress['eta_seconds'], **progress['counts'])
+    return EXIT_OK
+
+
+def cmd_follow_ups(args):
+    password = smtp_password(args)
+    summary = core.process_due_follow_ups(password, limit=args.limit, interval=args.interval, stop_event=_stop_event)
+    emit('follow_ups', **summary)
+    return _send_exit_code(summary)
+
+
+def cmd_enrol(args):
+    refs = None if args.all_new else _read_refs(args)
+    if refs is not None and not refs:
+        raise UsageError("Give --refs, --refs-file or --all-new")
+    emit('enrolled', enrolled=core.enrol_companies(refs))
+    return EXIT_OK
+
+
+def cmd_retries(args):
+    password = smtp_password(args)
+    summary = core.process_due_retries(password, limit=args.limit, interval=args.interval, stop_event=_stop_event)
+    emit('retries', **summary)
+    return _send_exit_code(summary)
+
+
+def cmd_scan_inbox(args):
+    password = smtp_password(args)
+    summary = core.scan_inbox_for_replies(password, action=args.action, since_days=args.since_days)
+    emit('inbox_scanned', **{key: len(value) if isinstance(value, list) else value for key, value in summary.items()})
+    return EXIT_OK
+
+
+def cmd_export(args):
+    if args.format == 'xlsx' and not core._xlsx_available():
+        raise UsageError("Excel export needs openpyxl (pip install openpyxl)")
+    filters = {key: value for key, value in (('uif_ref', args.uif), ('status', args.status), ('start', args.start)) if value}
+    path = core.build_export(args.kind, filters, args.format)
+    output = args.output or f"{args.kind}_{datetime.now():%Y%m%d}.{args.format}"
+    shutil.copyfile(path, output)
+    emit('exported', kind=args.kind, output=output, bytes=os.path.getsize(output))
+    return EXIT_OK
+
+
+def cmd_maintenance(args):
+    results = core.run_maintenance(force=args.force, tasks=args.tasks)
+    for task, result in results.items():
+        emit(task, **result)
+    stats = core.get_database_stats()
+    emit('database', **{key: stats[key] for key in ('file_bytes', 'wal_bytes', 'page_count', 'freelist_count', 'auto_vacuum')})
+    return EXIT_OK
+
+
+def _add_interval(command):
+    command.add_argument('--interval', type=float, default=core.SEND_INTERVAL_SECONDS, help='seconds between sends')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--json', action='store_true', help='write progress as JSON lines')
+    parser.add_argument('--db', help=f'database file (default {core.DATABASE_FILE})')
+    parser.add_argument('--password-file', help=f'read the SMTP password from this file instead of ${PASSWORD_ENV}')
+    parser.add_argument('-v', '--verbose', action='store_true', help='debug logging on stderr')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('import', help='import or update companies from an Excel or CSV file')
+    command.add_argument('file')
+    command.add_argument('--sheet', help='worksheet name (default: first sheet)')
+    command.set_defaults(handler=cmd_import)
+
+    campaign = commands.add_parser('campaign', help='create, run and inspect campaigns').add_subparsers(dest='action', required=True)
+    command = campaign.add_parser('create', help='create a campaign for a list of companies')
+    command.add_argument('name')
+    command.add_argument('--refs', nargs='+', metavar='UIF_REF')
+    command.add_argument('--refs-file', help='file with one UIF reference per line')
+    command.add_argument('--due', action='store_true', help='add the companies whose follow-up is due')
+    command.add_argument('--limit', type=int, default=core.DUE_BATCH_SIZE, help='cap for --due')
+    command.add_argument('--email-type', default=core.EMAIL_TYPE_OPTIONS[0])
+    command.add_argument('--dry-run', action='store_true', help='render and log previews without sending')
+    command.add_argument('--run', action='store_true', help='run the campaign straight away')
+    command.add_argument('--chunk-size', type=int, default=core.CAMPAIGN_CHUNK_SIZE)
+    _add_interval(command)
+    command.set_defaults(handler=cmd_campaign_create)
+    command = campaign.add_parser('run', help='send the pending items of a campaign')
+    command.add_argument('campaign_id', type=int)
+    command.add_argument('--chunk-size', type=int, default=core.CAMPAIGN_CHUNK_SIZE)
+    _add_interval(command)
+    command.set_defaults(handler=cmd_campaign_run)
+    command = campaign.add_parser('list', help='recent campaigns')
+    command.add_argument('--limit', type=int, default=20)
+    command.set_defaults(handler=cmd_campaign_list)
+    command = campaign.add_parser('status', help='progress of one campaign')
+    command.add_argument('campaign_id', type=int)
+    command.set_defaults(handler=cmd_campaign_status)
+
+    command = commands.add_parser('follow-ups', help='send one round of due follow-ups (inside the send window)')
+    command.add_argument('--limit', type=int, default=core.DUE_BATCH_SIZE)
+    _add_interval(command)
+    command.set_defaults(handler=cmd_follow_ups)
+
+    command = commands.add_parser('enrol', help='put never-emailed companies on the follow-up schedule, due now')
+    command.add_argument('--refs', nargs='+', metavar='UIF_REF')
+    command.add_argument('--refs-file', help='file with one UIF reference per line')
+    command.add_argument('--all-new', action='store_true', help='every open company that has never been emailed')
+    command.set_defaults(handler=cmd_enrol, due=False)
+
+    command = commands.add_parser('retries', help='send queued retries whose backoff has elapsed')
+    command.add_argument('--limit', type=int, default=50)
+    _add_interval(command)
+    command.set_defaults(handler=cmd_retries)
+
+    command = commands.add_parser('scan-inbox', help='match new replies and bounce reports in INBOX')
+    command.add_argument('--action', choices=('pause', 'complete'), default='pause', help='what a reply does to the company')
+    command.add_argument('--since-days', type=int, default=core.REPLY_LOOKBACK_DAYS, help='lookback on the first scan')
+    command.set_defaults(handler=cmd_scan_inbox)
+
+    command = commands.add_parser('maintenance', help='run the backup, optimize and incremental vacuum tasks that are due')
+    command.add_argument('--force', action='store_true', help='run the tasks even if they are not due')
+    command.add_argument('--tasks', nargs='+', choices=('backup', 'optimize', 'vacuum'), default=('backup', 'optimize', 'vacuum'))
+    command.set_defaults(handler=cmd_maintenance)
+
+    command = commands.add_parser('export', help='write an export file')
+    command.add_argument('kind', choices=EXPORT_KINDS)
+    command.add_argument('--format', choices=('csv', 'xlsx'), default='csv')
+    command.add_argument('--output', help='destination (default <kind>_<date>.<format>)')
+    command.add_argument('--uif', help='only this company (email_logs, email_error_logs)')
+    command.add_argument('--status', help='only this status (email_logs)')
+    command.add_argument('--start', help='only logs from this date, YYYY-MM-DD (email_logs)')
+    command.set_defaults(handler=cmd_export)
+    return parser
+
+
+def main(argv=None):
+    global _json_output
+    args = build_parser().parse_args(argv)
+    _json_output = args.json
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.db:
+        core.DATABASE_FILE = args.db
+    core.set_notifier(_cli_notifier)
+    signal.signal(signal.SIGINT, _request_stop)
+    signal.signal(signal.SIGTERM, _request_stop)
+    try:
+        core.init_db()
+        return args.handler(args)
+    except UsageError as e:
+        core.logger.error(str(e))
+        return EXIT_USAGE
+    except Exception as e:
+        core.logger.exception("%s failed", args.command)
+        emit('error', command=args.command, error=f"{type(e).__name__}: {e}")
+        return EXIT_FAILED
+    finally:
+        core.flush_log_buffer()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,4477 @@
+"""Sending, data-access and template logic for the UIF TERS compliance email automator.
+
+This module has no UI dependencies: app.py renders the Streamlit pages on top
+of it, and workers, scripts and benchmarks can import it directly. Paths such
+as DATABASE_FILE are relative to the current working directory.
+"""
+import os
+import sqlite3
+import pandas as pd
+from datetime import datetime
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.image import MIMEImage
+from email.mime.application import MIMEApplication
+from email.utils import make_msgid, formatdate
+import time
+import imaplib
+import traceback
+import hashlib
+import csv
+import tempfile
+import importlib.util
+import re
+import ast
+import random
+import uuid
+import socket
+import base64
+import threading
+import functools
+import http.server
+import cProfile
+import pstats
+import io
+import sys
+import json
+import logging
+import atexit
+import contextlib
+from collections import deque
+import email
+from email.utils import parseaddr, getaddresses
+from datetime import timedelta, timezone
+
+# The public API app.py star-imports: everything core defines, none of the modules it imports
+__all__ = [
+    'DATABASE_FILE', 'DATABASE_BUSY_TIMEOUT_SECONDS', 'DATABASE_POOL_SIZE', 'LOG_ARCHIVE_DIR', 'EXPORT_DIR',
+    'EXPORT_CHUNK_ROWS', 'LOG_RETENTION_MONTHS', 'SMTP_SERVER', 'IMAP_SERVER', 'SMTP_PORT', 'IMAP_PORT', 'SENDER_EMAIL',
+    'SENDER_DOMAIN', 'REPLY_LOOKBACK_DAYS', 'REPLY_IDLE_TIMEOUT', 'REPLY_POLL_INTERVAL', 'IMAP_REPLY_TIMEOUT',
+    'REPLY_FETCH_CHUNK', 'SEND_INTERVAL_SECONDS', 'RETRY_MAX_ATTEMPTS', 'RETRY_BASE_DELAY_SECONDS', 'RETRY_MAX_DELAY_SECONDS',
+    'LOG_BUFFER_MAX_ROWS', 'LOG_BUFFER_MAX_AGE_SECONDS', 'LOG_DEAD_LETTER_FILE', 'SEND_METRIC_STAGES',
+    'CAMPAIGN_CHUNK_SIZE', 'INLINE_SEND_LIMIT', 'LEASE_TTL_SECONDS', 'LEASE_HEARTBEAT_SECONDS', 'EMAIL_TYPE_OPTIONS',
+    'CIRCUIT_CONSECUTIVE_FAILURES', 'CIRCUIT_ERROR_RATE', 'CIRCUIT_WINDOW_SIZE', 'CIRCUIT_PROBE_INTERVAL_SECONDS',
+    'CIRCUIT_MAX_PAUSE_SECONDS', 'METRICS_HOST', 'METRICS_PORT', 'METRICS_FILE', 'METRICS_FILE_INTERVAL_SECONDS',
+    'METRICS_LATENCY_BUCKETS', 'PROFILE_DIR', 'PROFILE_KEEP', 'PROFILE_SAMPLE_INTERVAL_SECONDS', 'PROFILE_TOP_N',
+    'PROFILE_MODES', 'BACKUP_DIR', 'BACKUP_KEEP', 'BACKUP_PAGES_PER_STEP', 'BACKUP_STEP_PAUSE_SECONDS',
+    'BACKUP_MAX_RESTARTS', 'MAINTENANCE_BACKUP_HOURS', 'MAINTENANCE_OPTIMIZE_HOURS', 'MAINTENANCE_VACUUM_HOURS',
+    'INCREMENTAL_VACUUM_PAGES', 'SAST', 'FOLLOW_UP_CADENCE_BUSINESS_DAYS', 'SEND_WINDOW_START_HOUR',
+    'SEND_WINDOW_END_HOUR', 'DUE_BATCH_SIZE', 'logger', 'set_notifier', 'notify', 'connect', 'init_db',
+    'LOG_STATUS_SEED', 'EMAIL_LOG_VIEW_SQL', 'ERROR_LOG_VIEW_SQL', 'LOG_BUFFER', 'METRICS', 'inc_metric',
+    'observe_latency', 'begin_send_metrics', 'record_stage', 'timed_stage', 'finish_send_metrics', 'flush_log_buffer',
+    'log_send_error', 'get_companies_data', 'get_company_emails', 'resolve_company_recipients', 'is_hard_bounce',
+    'suppress_recipients', 'unsuppress_recipient', 'get_suppressed_recipients', 'add_additional_email',
+    'remove_additional_email', 'add_additional_emails_bulk', 'remove_additional_emails_bulk', 'validate_email_list',
+    'update_final_email_template', 'DELIVERY_ISSUE_FILTERS', 'DELIVERY_HEALTH_SORTS', 'get_delivery_health',
+    'get_delivery_health_summary', 'get_bounced_companies', 'get_failed_companies', 'get_unreachable_companies',
+    'get_data_version', 'build_export', 'export_bytes', 'export_unreachable_companies', 'log_email', 'get_email_logs',
+    'get_error_logs', 'upsert_company', 'IMPORT_COLUMN_ALIASES', 'IMPORT_REQUIRED_COLUMNS', 'read_company_file',
+    'import_companies', 'append_signature', 'append_email_to_sent_folder', 'record_email_deliveries',
+    'record_send_outcome', 'reconcile_email_counters', 'ARCHIVE_TABLES', 'get_retention_settings',
+    'archive_closed_months', 'get_log_archives', 'read_archived_logs', 'get_maintenance_settings', 'get_database_stats',
+    'get_table_space', 'backup_database', 'get_backups', 'optimize_database', 'incremental_vacuum',
+    'enable_incremental_vacuum', 'run_maintenance', 'run_maintenance_worker', 'get_email_deliveries',
+    'classify_smtp_error', 'is_provider_error', 'new_circuit_breaker', 'circuit_record', 'circuit_wait_for_recovery',
+    'send_email', 'send_email_detailed', 'send_test_email', 'test_smtp_connection', 'get_template_row',
+    'save_template_row', 'get_email_template', 'get_daily_email_count', 'get_email_stats', 'get_daily_status_counts',
+    'get_company_summary', 'get_send_stage_latency', 'get_send_throughput', 'render_metrics', 'write_metrics_file',
+    'run_metrics_file_writer', 'start_metrics_exporter', 'start_profile', 'stop_profile', 'get_profile_captures',
+    'claim_send', 'manual_batch_key', 'get_stale_claims', 'release_stale_claims', 'new_lease_holder',
+    'acquire_company_leases', 'renew_company_leases', 'release_company_leases', 'get_company_leases', 'company_leases',
+    'schedule_retry', 'get_retry_queue', 'process_due_retries', 'run_retry_worker', 'get_app_settings',
+    'save_app_settings', 'get_schedule_settings', 'now_sast', 'add_business_days', 'next_due_after',
+    'is_within_send_window', 'set_next_due', 'get_due_companies', 'enrol_companies', 'count_unenrolled_companies',
+    'count_due_companies', 'process_due_follow_ups', 'run_follow_up_scheduler', 'email_step_for_type',
+    'create_campaign', 'get_campaigns', 'set_campaign_status', 'get_campaign_progress', 'run_campaign_chunk',
+    'run_campaign', 'get_company_states', 'match_reply_to_companies', 'apply_reply_matches', 'get_reply_events',
+    'parse_bounce_report', 'apply_bounce_reports', 'scan_inbox_for_replies', 'watch_inbox_for_replies'
+]
+
+DATABASE_FILE = 'compliance_emails.db'
+DATABASE_BUSY_TIMEOUT_SECONDS = 30  # how long a writer waits for another process's write lock
+DATABASE_POOL_SIZE = 4  # idle connections kept per thread
+LOG_ARCHIVE_DIR = 'log_archive'
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), 'compliance_exports')
+EXPORT_CHUNK_ROWS = 5000
+LOG_RETENTION_MONTHS = 6  # full months kept in the database besides the current one
+SMTP_SERVER = "mail.dithetoaccountants.co.za"
+IMAP_SERVER = "mail.dithetoaccountants.co.za"
+SMTP_PORT = 587
+IMAP_PORT = 993
+SENDER_EMAIL = "gamu@dithetoaccountants.co.za"
+SENDER_DOMAIN = SENDER_EMAIL.split('@')[-1]
+
+# Reply detection
+REPLY_LOOKBACK_DAYS = 14
+REPLY_IDLE_TIMEOUT = 29 * 60  # RFC 2177: re-issue IDLE at least every 29 minutes
+REPLY_POLL_INTERVAL = 300
+IMAP_REPLY_TIMEOUT = 30  # seconds to wait for the server to answer IDLE or DONE
+REPLY_FETCH_CHUNK = 200
+
+# Sending
+SEND_INTERVAL_SECONDS = 15  # spacing between sends to avoid provider flags
+
+# Transient-failure retries
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY_SECONDS = 120
+RETRY_MAX_DELAY_SECONDS = 2 * 60 * 60
+
+# Write-behind log buffer: flushed in one transaction on whichever threshold is hit first
+LOG_BUFFER_MAX_ROWS = 50
+LOG_BUFFER_MAX_AGE_SECONDS = 5.0
+LOG_DEAD_LETTER_FILE = 'log_dead_letters.jsonl'  # buffered rows the database rejected, kept for manual repair
+
+# Per-message send-path timings, one send_metrics column ("<stage>_ms") per stage
+SEND_METRIC_STAGES = ('template', 'attachments', 'mime_encode', 'smtp_connect', 'smtp_auth', 'smtp_data', 'imap_append', 'db_write')
+
+# Campaigns: large selections run as persisted, resumable chunks
+CAMPAIGN_CHUNK_SIZE = 25
+INLINE_SEND_LIMIT = 30  # larger selections become campaigns instead of a blocking inline loop
+
+# Company leases: a batch holds its companies so other sessions skip them and show them as in flight
+LEASE_TTL_SECONDS = 120  # leases of a crashed holder lapse after this long
+LEASE_HEARTBEAT_SECONDS = 30
+EMAIL_TYPE_OPTIONS = [
+    "Auto (Based on current count)",
+    "Initial Email (Override count)",
+    "Follow-up #1", "Follow-up #2", "Follow-up #3",
+    "Follow-up #4", "Follow-up #5", "Follow-up #6",
+    "Follow-up #7", "Follow-up #8", "Follow-up #9 (Final)"
+]
+
+# Circuit breaker around the SMTP transport
+CIRCUIT_CONSECUTIVE_FAILURES = 3
+CIRCUIT_ERROR_RATE = 0.5
+CIRCUIT_WINDOW_SIZE = 10
+CIRCUIT_PROBE_INTERVAL_SECONDS = 30
+CIRCUIT_MAX_PAUSE_SECONDS = 10 * 60
+
+# Metrics exporter: OpenMetrics/Prometheus text over HTTP and/or a periodically rewritten file
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9464  # None disables the HTTP endpoint
+METRICS_FILE = None  # e.g. a node_exporter textfile-collector path
+METRICS_FILE_INTERVAL_SECONDS = 15
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+
+# On-demand profiling captures
+PROFILE_DIR = 'profiles'
+PROFILE_KEEP = 20  # newest captures kept on disk
+PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILE_TOP_N = 15
+PROFILE_MODES = {"Deterministic (cProfile)": 'deterministic', "Sampling (low overhead)": 'sampling'}
+
+# Database maintenance (defaults; operators can override the schedule in app_settings)
+BACKUP_DIR = 'backups'
+BACKUP_KEEP = 14  # newest backups kept on disk
+BACKUP_PAGES_PER_STEP = 256  # pages copied per backup step; writers get the database between steps
+BACKUP_STEP_PAUSE_SECONDS = 0.005
+BACKUP_MAX_RESTARTS = 3  # then copy in one step: under WAL a single read snapshot does not block writers either
+MAINTENANCE_BACKUP_HOURS = 24
+MAINTENANCE_OPTIMIZE_HOURS = 24
+MAINTENANCE_VACUUM_HOURS = 24
+INCREMENTAL_VACUUM_PAGES = 5000  # pages returned to the filesystem per vacuum pass
+
+# Follow-up scheduling (defaults; operators can override them in app_settings)
+SAST = timezone(timedelta(hours=2), 'SAST')  # South Africa has no DST
+FOLLOW_UP_CADENCE_BUSINESS_DAYS = 5
+SEND_WINDOW_START_HOUR = 8
+SEND_WINDOW_END_HOUR = 16
+DUE_BATCH_SIZE = 30
+
+logger = logging.getLogger('email_automator')
+
+def _log_notifier(level, message):
+    logger.log({'error': logging.ERROR, 'warning': logging.WARNING}.get(level, logging.INFO), message)
+
+_notifier = _log_notifier
+
+def set_notifier(notifier):
+    """Route user-facing messages from this module to `notifier(level, message)`.
+
+    Levels are 'info', 'warning', 'error' and 'code'. The Streamlit app
+    installs one that renders them on the page; without one they go to the
+    'email_automator' logger.
+    """
+    global _notifier
+    _notifier = notifier or _log_notifier
+
+def notify(level, message):
+    _notifier(level, message)
+
+_DB_POOL = threading.local()
+
+def _open_connection(path):
+    conn = sqlite3.connect(path, timeout=DATABASE_BUSY_TIMEOUT_SECONDS)
+    # Only takes effect on a brand-new file (or after a full VACUUM); freed pages can then be returned incrementally
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets the UI, the CLI and worker processes read while one of them writes; NORMAL sync is durable under WAL
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError:
+        pass  # another process is mid-transaction on a rollback-journal database; switch on a later connection
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@contextlib.contextmanager
+def connect():
+    """Check out a connection to DATABASE_FILE for one transaction.
+
+    Connections are reused per thread (opening one and parsing the schema
+    costs more than most of the queries run on it). Nested calls get their
+    own connection, so each `with connect() as conn:` block commits or rolls
+    back exactly as a fresh sqlite3 connection would.
+    """
+    pools = getattr(_DB_POOL, 'pools', None)
+    if pools is None:
+        pools = _DB_POOL.pools = {}
+    path = os.path.abspath(DATABASE_FILE)
+    idle = pools.setdefault(path, [])
+    conn = idle.pop() if idle else _open_connection(path)
+    try:
+        with conn:
+            yield conn
+    except BaseException:
+        conn.close()
+        raise
+    if conn.in_transaction or len(idle) >= DATABASE_POOL_SIZE:
+        conn.close()
+    else:
+        idle.append(conn)
+
+def init_db():
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS companies (
+                UIF_REFERENCE TEXT PRIMARY KEY,
+                TRADE_NAME TEXT,
+                EMAIL_ADDRESS TEXT,
+                PHONE TEXT,
+                emails_sent INTEGER DEFAULT 0,
+                last_sent TEXT,
+                completed INTEGER DEFAULT 0,
+                paused INTEGER DEFAULT 0,
+                next_due_at TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_templates (
+                template_key TEXT PRIMARY KEY,
+                subject TEXT,
+                body TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS company_emails (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                UIF_REFERENCE TEXT,
+                EMAIL TEXT,
+                UNIQUE(UIF_REFERENCE, EMAIL)
+            )
+        ''')
+        logs_migrated = _init_compact_logs(conn)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reply_events (
+                reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT UNIQUE,
+                UIF_REFERENCE TEXT,
+                sender TEXT,
+                subject TEXT,
+                matched_by TEXT,
+                action TEXT,
+                received TEXT,
+                timestamp TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_reply_events_uif ON reply_events (UIF_REFERENCE)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS reply_watch_state (
+                mailbox TEXT PRIMARY KEY,
+                uidvalidity INTEGER,
+                last_uid INTEGER,
+                last_checked TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_company_emails_email ON company_emails (EMAIL COLLATE NOCASE)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_deliveries (
+                delivery_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT,
+                UIF_REFERENCE TEXT,
+                recipient TEXT,
+                smtp_code INTEGER,
+                smtp_response TEXT,
+                status TEXT,
+                size_bytes INTEGER,
+                latency_ms REAL,
+                timestamp TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_message_id ON email_deliveries (message_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_recipient ON email_deliveries (recipient)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_deliveries_uif ON email_deliveries (UIF_REFERENCE)")
+        stage_columns = ",\n".join(f"                {stage}_ms REAL" for stage in SEND_METRIC_STAGES)
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS send_metrics (
+                metric_id INTEGER PRIMARY KEY,
+                message_id TEXT,
+                UIF_REFERENCE TEXT,
+                ts INTEGER NOT NULL,
+                status TEXT,
+                recipients INTEGER,
+                size_bytes INTEGER,
+{stage_columns},
+                total_ms REAL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_send_metrics_ts ON send_metrics (ts)")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'suppressed_recipients'")
+        suppression_is_new = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS suppressed_recipients (
+                email TEXT PRIMARY KEY,
+                reason TEXT,
+                source TEXT,
+                UIF_REFERENCE TEXT,
+                smtp_code INTEGER,
+                hits INTEGER DEFAULT 1,
+                first_seen TEXT,
+                last_seen TEXT
+            )
+        ''')
+        # Migration: ensure completed column exists
+        cursor.execute("PRAGMA table_info(companies)")
+        cols = [row[1] for row in cursor.fetchall()]
+        if 'completed' not in cols:
+            cursor.execute("ALTER TABLE companies ADD COLUMN completed INTEGER DEFAULT 0")
+        if 'PHONE' not in cols:
+            cursor.execute("ALTER TABLE companies ADD COLUMN PHONE TEXT")
+        if 'paused' not in cols:
+            cursor.execute("ALTER TABLE companies ADD COLUMN paused INTEGER DEFAULT 0")
+        if 'next_due_at' not in cols:
+            cursor.execute("ALTER TABLE companies ADD COLUMN next_due_at TEXT")
+            _backfill_next_due(conn)
+        # Partial index: only open companies are ever due, so completed/paused rows stay out of it
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_companies_due ON companies (next_due_at) WHERE completed = 0 AND paused = 0"
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
+        # Seed default email templates if missing
+        try:
+            defaults = {
+                'initial': {
+                    'subject': 'Initial Request for Documentation – UIF TERS Compliance Audit',
+                    'body': (
+                        """
+                        <!DOCTYPE html>
+                        <html>
+                          <head>
+                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                          </head>
+                          <body>
+                            <p>Good day,</p>
+                            <p>I trust this email finds you well.</p>
+                            <p>My name is Gamu, and I am an Auditor at Ditheto Accountants. We are conducting a compliance review on behalf of the Unemployment Insurance Fund (UIF), regarding the COVID-19 TERS funds disbursed to <strong>{TRADE_NAME}</strong> with UIF Ref Number: <strong>{UIF_REFERENCE}</strong>.</p>
+                            <p>The following documents are required to complete the audit:</p>
+                            <ul>
+                              <li>Bank statements showing receipt of the TERS funds</li>
+                              <li>Proof of payments made to employees</li>
+                              <li>Payroll records or payslips for January to December 2020</li>
+                              <li>2021 IRP5 certificates</li>
+                              <li>EMP501s/201s for the 2020/2021 financial year</li>
+                            </ul>
+                            <p>We fully understand that administrative delays can occur. However, these documents are essential to finalising the audit in line with UIF compliance procedures. Without them, the file remains incomplete and may be subject to further administrative steps.</p>
+                            <p>Kindly forward the requested documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> at your earliest convenience.</p>
+                            <p>Your cooperation in resolving this matter is greatly appreciated.</p>
+                            <p>Kind regards,<br>
+                              <strong>Gamu Dambanjera</strong></p>
+                            <div class="moz-signature"> <img src='cid:signature'></div>
+                          </body>
+                        </html>
+                        """
+                    )
+                },
+                'followup': {
+                    'subject': 'Follow-up: Urgent Action Required – UIF TERS Compliance Audit',
+                    'body': (
+                        """
+                        <!DOCTYPE html>
+                        <html>
+                          <head>
+                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                          </head>
+                          <body>
+                            <p>Dear {TRADE_NAME},</p>
+                            <p>This is a reminder that the requested documentation for the COVID-19 TERS audit is still outstanding. This is an urgent matter that requires your immediate attention.</p>
+                            <p>Failure to provide the necessary documents may result in non-compliance with UIF regulations, which could lead to further administrative actions.</p>
+                            <p>Please submit the required documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> without delay.</p>
+                            <p>Kind regards,<br>
+                              <strong>Gamu Dambanjera</strong></p>
+                            <div class="moz-signature"> <img src='cid:signature'></div>
+                          </body>
+                        </html>
+                        """
+                    )
+                },
+                'final': {
+                    'subject': 'Final Notice: Non-Compliance with UIF TERS Audit Requirements',
+                    'body': (
+                        """
+                        <!DOCTYPE html>
+                        <html>
+                          <head>
+                            <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                          </head>
+                          <body>
+                            <p>Good day,</p>
+                            <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
+                            <p>Despite multiple attempts to obtain the required documentation, including:</p>
+                            <ol>
+                              <li>Initial audit notification</li>
+                              <li>Detailed information request</li>
+                              <li>Follow-up communication</li>
+                            </ol>
+                            <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
+                            <ul>
+                              <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
+                              <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
+                            </ul>
+                            <h3>NOTICE OF ESCALATION</h3>
+                            <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
+                            <ol>
+                              <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
+                              <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
+                              <li>Potential criminal charges for non-compliance and fraud</li>
+                            </ol>
+                            <h3>REQUIRED IMMEDIATE ACTION</h3>
+                            <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
+                            <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
+                            <p>Kind regards,<br>
+                              <strong>Gamu Dambanjera</strong></p>
+                            <div class="moz-signature"> <img src='cid:signature'></div>
+                          </body>
+                        </html>
+                        """
+                    )
+                }
+            }
+            for k, v in defaults.items():
+                cursor.execute(
+                    "INSERT OR IGNORE INTO email_templates (template_key, subject, body) VALUES (?, ?, ?)",
+                    (k, v['subject'], v['body'])
+                )
+        except Exception:
+            pass
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_retry_queue (
+                retry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                UIF_REFERENCE TEXT,
+                step INTEGER,
+                recipients TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TEXT,
+                last_error TEXT,
+                status TEXT DEFAULT 'pending',
+                created_at TEXT,
+                updated_at TEXT
+            )
+        ''')
+        cursor.execute("PRAGMA table_info(email_retry_queue)")
+        if 'campaign' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute("ALTER TABLE email_retry_queue ADD COLUMN campaign TEXT DEFAULT ''")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_retry_due ON email_retry_queue (status, next_attempt_at)")
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_retry_pending ON email_retry_queue (UIF_REFERENCE, step) WHERE status = 'pending'"
+        )
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS campaigns (
+                campaign_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                email_type TEXT,
+                dry_run INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'pending',
+                total INTEGER DEFAULT 0,
+                last_error TEXT,
+                created_at TEXT,
+                started_at TEXT,
+                finished_at TEXT,
+                updated_at TEXT
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS campaign_items (
+                item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                campaign_id INTEGER,
+                UIF_REFERENCE TEXT,
+                status TEXT DEFAULT 'pending',
+                step INTEGER,
+                detail TEXT,
+                attempted_at TEXT,
+                UNIQUE(campaign_id, UIF_REFERENCE),
+                FOREIGN KEY (campaign_id) REFERENCES campaigns(campaign_id)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_campaign_items_status ON campaign_items (campaign_id, status, item_id)")
+        # Exactly-once ledger: one row per (company, escalation step, campaign key)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS send_ledger (
+                ledger_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                UIF_REFERENCE TEXT NOT NULL,
+                step INTEGER NOT NULL,
+                campaign TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL,
+                message_id TEXT,
+                claimed_at TEXT,
+                finished_at TEXT,
+                UNIQUE(UIF_REFERENCE, step, campaign)
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_ledger_status ON send_ledger (status, claimed_at)")
+        # Cross-session leases on companies a batch is about to send to (epoch-second timestamps)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS company_leases (
+                UIF_REFERENCE TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                label TEXT,
+                acquired_at REAL NOT NULL,
+                heartbeat_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_company_leases_holder ON company_leases (holder)")
+        # KPI rollups, maintained by triggers so dashboards read a handful of rows
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'email_log_daily'")
+        rollup_is_new = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS email_log_daily (
+                date TEXT NOT NULL,
+                status TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (date, status)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_log_daily_status ON email_log_daily (status, date)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS company_state_summary (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total INTEGER NOT NULL DEFAULT 0,
+                completed INTEGER NOT NULL DEFAULT 0,
+                paused INTEGER NOT NULL DEFAULT 0,
+                active INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'company_delivery_health'")
+        health_is_new = cursor.fetchone() is None
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS company_delivery_health (
+                UIF_REFERENCE TEXT PRIMARY KEY,
+                bounce_count INTEGER NOT NULL DEFAULT 0,
+                failure_count INTEGER NOT NULL DEFAULT 0,
+                total_issues INTEGER NOT NULL DEFAULT 0,
+                last_bounce_date TEXT,
+                last_failure_date TEXT,
+                last_issue_date TEXT,
+                last_success_date TEXT,
+                bounced_subjects TEXT,
+                failed_subjects TEXT
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_health_last_issue ON company_delivery_health (last_issue_date DESC) WHERE total_issues > 0")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_health_total_issues ON company_delivery_health (total_issues DESC, last_issue_date DESC) WHERE total_issues > 0")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_health_bounced ON company_delivery_health (last_bounce_date DESC) WHERE bounce_count > 0")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_health_failed ON company_delivery_health (last_failure_date DESC) WHERE failure_count > 0")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_companies_trade_name ON companies (TRADE_NAME)")
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS log_archives (
+                archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                month TEXT NOT NULL,
+                path TEXT NOT NULL UNIQUE,
+                format TEXT NOT NULL,
+                row_count INTEGER NOT NULL,
+                size_bytes INTEGER,
+                created_at TEXT NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_log_archives_month ON log_archives (table_name, month)")
+        # Per-company 'Sent' totals of archived months, so counter reconciliation survives archiving
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_sent_counts (
+                UIF_REFERENCE TEXT PRIMARY KEY,
+                sent_count INTEGER NOT NULL DEFAULT 0,
+                last_sent TEXT
+            )
+        ''')
+        if rollup_is_new:
+            _backfill_rollups(conn)
+        if health_is_new:
+            _backfill_delivery_health(conn)
+        # Rollups are history: archiving or deleting log rows does not reduce them.
+        # Status ids 1/2/3 are the seeded Sent/Bounced/Failed rows of log_statuses.
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_log_entries_rollup_insert AFTER INSERT ON email_log_entries
+            BEGIN
+                INSERT INTO email_log_daily (date, status, count)
+                VALUES (
+                    date(NEW.ts, 'unixepoch'),
+                    COALESCE((SELECT status FROM log_statuses WHERE status_id = NEW.status_id), ''),
+                    1
+                )
+                ON CONFLICT(date, status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_log_entries_rollup_update AFTER UPDATE OF status_id, ts ON email_log_entries
+            WHEN OLD.status_id IS NOT NEW.status_id OR date(OLD.ts, 'unixepoch') IS NOT date(NEW.ts, 'unixepoch')
+            BEGIN
+                UPDATE email_log_daily SET count = count - 1
+                WHERE date = date(OLD.ts, 'unixepoch')
+                  AND status = COALESCE((SELECT status FROM log_statuses WHERE status_id = OLD.status_id), '');
+                INSERT INTO email_log_daily (date, status, count)
+                VALUES (
+                    date(NEW.ts, 'unixepoch'),
+                    COALESCE((SELECT status FROM log_statuses WHERE status_id = NEW.status_id), ''),
+                    1
+                )
+                ON CONFLICT(date, status) DO UPDATE SET count = count + 1;
+            END
+        ''')
+        # Like the rollup, health counts keep archived history; only new log rows move them
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_log_entries_health AFTER INSERT ON email_log_entries
+            WHEN NEW.status_id IN (1, 2, 3) AND NEW.UIF_REFERENCE IS NOT NULL
+            BEGIN
+                INSERT INTO company_delivery_health (UIF_REFERENCE) VALUES (NEW.UIF_REFERENCE)
+                ON CONFLICT(UIF_REFERENCE) DO NOTHING;
+                UPDATE company_delivery_health SET
+                    bounce_count = bounce_count + (NEW.status_id = 2),
+                    failure_count = failure_count + (NEW.status_id = 3),
+                    total_issues = total_issues + (NEW.status_id IN (2, 3)),
+                    last_bounce_date = CASE WHEN NEW.status_id = 2
+                        THEN MAX(COALESCE(last_bounce_date, ''), datetime(NEW.ts, 'unixepoch')) ELSE last_bounce_date END,
+                    last_failure_date = CASE WHEN NEW.status_id = 3
+                        THEN MAX(COALESCE(last_failure_date, ''), datetime(NEW.ts, 'unixepoch')) ELSE last_failure_date END,
+                    last_issue_date = CASE WHEN NEW.status_id IN (2, 3)
+                        THEN MAX(COALESCE(last_issue_date, ''), datetime(NEW.ts, 'unixepoch')) ELSE last_issue_date END,
+                    last_success_date = CASE WHEN NEW.status_id = 1
+                        THEN MAX(COALESCE(last_success_date, ''), datetime(NEW.ts, 'unixepoch')) ELSE last_success_date END,
+                    bounced_subjects = CASE
+                        WHEN NEW.status_id = 2 AND NEW.subject_id IS NOT NULL
+                             AND instr(',' || COALESCE(bounced_subjects, '') || ',',
+                                       ',' || (SELECT subject FROM log_subjects WHERE subject_id = NEW.subject_id) || ',') = 0
+                        THEN substr((SELECT subject FROM log_subjects WHERE subject_id = NEW.subject_id)
+                                    || COALESCE(',' || bounced_subjects, ''), 1, 300)
+                        ELSE bounced_subjects END,
+                    failed_subjects = CASE
+                        WHEN NEW.status_id = 3 AND NEW.subject_id IS NOT NULL
+                             AND instr(',' || COALESCE(failed_subjects, '') || ',',
+                                       ',' || (SELECT subject FROM log_subjects WHERE subject_id = NEW.subject_id) || ',') = 0
+                        THEN substr((SELECT subject FROM log_subjects WHERE subject_id = NEW.subject_id)
+                                    || COALESCE(',' || failed_subjects, ''), 1, 300)
+                        ELSE failed_subjects END
+                WHERE UIF_REFERENCE = NEW.UIF_REFERENCE;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_companies_summary_insert AFTER INSERT ON companies
+            BEGIN
+                UPDATE company_state_summary SET
+                    total = total + 1,
+                    completed = completed + (COALESCE(NEW.completed, 0) = 1),
+                    paused = paused + (COALESCE(NEW.paused, 0) = 1),
+                    active = active + (COALESCE(NEW.completed, 0) != 1 AND COALESCE(NEW.paused, 0) != 1)
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_companies_summary_delete AFTER DELETE ON companies
+            BEGIN
+                UPDATE company_state_summary SET
+                    total = total - 1,
+                    completed = completed - (COALESCE(OLD.completed, 0) = 1),
+                    paused = paused - (COALESCE(OLD.paused, 0) = 1),
+                    active = active - (COALESCE(OLD.completed, 0) != 1 AND COALESCE(OLD.paused, 0) != 1)
+                WHERE id = 1;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_companies_summary_update AFTER UPDATE OF completed, paused ON companies
+            BEGIN
+                UPDATE company_state_summary SET
+                    completed = completed + (COALESCE(NEW.completed, 0) = 1) - (COALESCE(OLD.completed, 0) = 1),
+                    paused = paused + (COALESCE(NEW.paused, 0) = 1) - (COALESCE(OLD.paused, 0) = 1),
+                    active = active
+                        + (COALESCE(NEW.completed, 0) != 1 AND COALESCE(NEW.paused, 0) != 1)
+                        - (COALESCE(OLD.completed, 0) != 1 AND COALESCE(OLD.paused, 0) != 1)
+                WHERE id = 1;
+            END
+        ''')
+        # Add test company
+        cursor.execute('''
+            INSERT OR IGNORE INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS) VALUES (?, ?, ?)
+        ''', ('TEST123456', 'Test Company', 'nicknungu@gmail.com'))
+        if suppression_is_new:
+            _backfill_suppressions(conn)
+        conn.commit()
+    if logs_migrated:
+        # Hand the space freed by the old TEXT tables back to the filesystem
+        with connect() as conn:
+            conn.execute("VACUUM")
+
+LOG_STATUS_SEED = ((1, 'Sent'), (2, 'Bounced'), (3, 'Failed'), (4, 'Deferred'))
+
+EMAIL_LOG_VIEW_SQL = """
+    SELECT e.log_id, e.UIF_REFERENCE,
+           datetime(e.ts, 'unixepoch') AS timestamp, date(e.ts, 'unixepoch') AS date,
+           sj.subject, st.status
+    FROM email_log_entries e
+    LEFT JOIN log_subjects sj ON sj.subject_id = e.subject_id
+    LEFT JOIN log_statuses st ON st.status_id = e.status_id
+"""
+
+ERROR_LOG_VIEW_SQL = """
+    SELECT e.error_id, e.UIF_REFERENCE, e.recipient, e.stage,
+           datetime(e.ts, 'unixepoch') AS timestamp, e.error_type, e.error_message, t.traceback
+    FROM email_error_entries e
+    LEFT JOIN error_tracebacks t ON t.fingerprint = e.fingerprint
+"""
+
+def _init_compact_logs(conn):
+    """Create the compact log tables and the email_logs/email_error_logs compatibility views.
+
+    Timestamps are stored as integer seconds of the app's naive local wall-clock time,
+    so the views render exactly what was written (to the second). Returns True when
+    existing TEXT tables were migrated.
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS log_statuses (status_id INTEGER PRIMARY KEY, status TEXT NOT NULL UNIQUE)")
+    cursor.execute("CREATE TABLE IF NOT EXISTS log_subjects (subject_id INTEGER PRIMARY KEY, subject TEXT NOT NULL UNIQUE)")
+    cursor.executemany("INSERT OR IGNORE INTO log_statuses (status_id, status) VALUES (?, ?)", LOG_STATUS_SEED)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_log_entries (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            UIF_REFERENCE TEXT,
+            ts INTEGER NOT NULL,
+            status_id INTEGER REFERENCES log_statuses(status_id),
+            subject_id INTEGER REFERENCES log_subjects(subject_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS error_tracebacks (
+            fingerprint TEXT PRIMARY KEY,
+            traceback TEXT,
+            occurrences INTEGER NOT NULL DEFAULT 0,
+            first_seen INTEGER,
+            last_seen INTEGER
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_error_entries (
+            error_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            UIF_REFERENCE TEXT,
+            recipient TEXT,
+            stage TEXT,
+            ts INTEGER NOT NULL,
+            error_type TEXT,
+            error_message TEXT,
+            fingerprint TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_log_entries_ts ON email_log_entries (ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_log_entries_uif_status ON email_log_entries (UIF_REFERENCE, status_id, ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_error_entries_ts ON email_error_entries (ts)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_error_entries_uif ON email_error_entries (UIF_REFERENCE, error_id)")
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('email_logs', 'email_error_logs')")
+    legacy = {row[0] for row in cursor.fetchall()}
+    if 'email_logs' in legacy:
+        cursor.execute("INSERT OR IGNORE INTO log_statuses (status) SELECT DISTINCT status FROM email_logs WHERE status IS NOT NULL")
+        cursor.execute("INSERT OR IGNORE INTO log_subjects (subject) SELECT DISTINCT subject FROM email_logs WHERE subject IS NOT NULL")
+        cursor.execute('''
+            INSERT INTO email_log_entries (log_id, UIF_REFERENCE, ts, status_id, subject_id)
+            SELECT l.log_id, l.UIF_REFERENCE,
+                   COALESCE(CAST(strftime('%s', substr(COALESCE(l.timestamp, l.date), 1, 19)) AS INTEGER), 0),
+                   st.status_id, sj.subject_id
+            FROM email_logs l
+            LEFT JOIN log_statuses st ON st.status = l.status
+            LEFT JOIN log_subjects sj ON sj.subject = l.subject
+            ORDER BY l.log_id
+        ''')
+        cursor.execute("DROP TABLE email_logs")
+    if 'email_error_logs' in legacy:
+        rows = cursor.execute(
+            "SELECT error_id, UIF_REFERENCE, recipient, stage, timestamp, error_type, error_message, traceback "
+            "FROM email_error_logs ORDER BY error_id"
+        ).fetchall()
+        _insert_error_rows(conn, rows)
+        cursor.execute("DROP TABLE email_error_logs")
+
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS email_logs AS {EMAIL_LOG_VIEW_SQL}")
+    cursor.execute(f"CREATE VIEW IF NOT EXISTS email_error_logs AS {ERROR_LOG_VIEW_SQL}")
+    # Older writers keep inserting into email_logs; the view maps text onto the dictionaries
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_email_logs_view_insert INSTEAD OF INSERT ON email_logs
+        BEGIN
+            INSERT OR IGNORE INTO log_statuses (status) SELECT NEW.status WHERE NEW.status IS NOT NULL;
+            INSERT OR IGNORE INTO log_subjects (subject) SELECT NEW.subject WHERE NEW.subject IS NOT NULL;
+            INSERT INTO email_log_entries (log_id, UIF_REFERENCE, ts, status_id, subject_id)
+            VALUES (
+                NEW.log_id, NEW.UIF_REFERENCE,
+                COALESCE(CAST(strftime('%s', substr(COALESCE(NEW.timestamp, NEW.date), 1, 19)) AS INTEGER),
+                         CAST(strftime('%s', 'now', 'localtime') AS INTEGER)),
+                (SELECT status_id FROM log_statuses WHERE status = NEW.status),
+                (SELECT subject_id FROM log_subjects WHERE subject = NEW.subject)
+            );
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_email_logs_view_delete INSTEAD OF DELETE ON email_logs
+        BEGIN
+            DELETE FROM email_log_entries WHERE log_id = OLD.log_id;
+        END
+    ''')
+    return bool(legacy)
+
+def _traceback_fingerprint(text):
+    return hashlib.sha1(text.encode('utf-8', 'replace')).hexdigest()[:16] if text else None
+
+def _insert_error_rows(conn, rows):
+    """Write error rows (error_id, uif, recipient, stage, timestamp, type, message, traceback), storing each distinct traceback once."""
+    tracebacks = {}
+    entries = []
+    for error_id, uif_reference, recipient, stage, timestamp, error_type, message, tb_text in rows:
+        fingerprint = _traceback_fingerprint(tb_text)
+        if fingerprint:
+            seen = tracebacks.setdefault(fingerprint, [tb_text, 0, timestamp, timestamp])
+            seen[1] += 1
+            seen[3] = timestamp
+        entries.append((error_id, uif_reference, recipient, stage, timestamp, error_type, message, fingerprint))
+    conn.executemany(
+        "INSERT INTO error_tracebacks (fingerprint, traceback, occurrences, first_seen, last_seen) "
+        "VALUES (?, ?, ?, CAST(strftime('%s', substr(?, 1, 19)) AS INTEGER), CAST(strftime('%s', substr(?, 1, 19)) AS INTEGER)) "
+        "ON CONFLICT(fingerprint) DO UPDATE SET occurrences = occurrences + excluded.occurrences, last_seen = excluded.last_seen",
+        [(fp, text, n, first, last) for fp, (text, n, first, last) in tracebacks.items()]
+    )
+    conn.executemany(
+        "INSERT INTO email_error_entries (error_id, UIF_REFERENCE, recipient, stage, ts, error_type, error_message, fingerprint) "
+        "VALUES (?, ?, ?, ?, COALESCE(CAST(strftime('%s', substr(?, 1, 19)) AS INTEGER), 0), ?, ?, ?)",
+        entries
+    )
+
+def _insert_log_rows(conn, rows):
+    """Write (uif, timestamp, date, subject, status) rows straight into email_log_entries."""
+    if not rows:
+        return
+    conn.executemany("INSERT OR IGNORE INTO log_statuses (status) VALUES (?)", {(r[4],) for r in rows if r[4] is not None})
+    conn.executemany("INSERT OR IGNORE INTO log_subjects (subject) VALUES (?)", {(r[3],) for r in rows if r[3] is not None})
+    statuses = dict(conn.execute("SELECT status, status_id FROM log_statuses"))
+    subjects = {}
+    for subject in {r[3] for r in rows if r[3] is not None}:
+        subjects[subject] = conn.execute("SELECT subject_id FROM log_subjects WHERE subject = ?", (subject,)).fetchone()[0]
+    conn.executemany(
+        "INSERT INTO email_log_entries (UIF_REFERENCE, ts, status_id, subject_id) "
+        "VALUES (?, COALESCE(CAST(strftime('%s', substr(?, 1, 19)) AS INTEGER), CAST(strftime('%s', 'now', 'localtime') AS INTEGER)), ?, ?)",
+        [(uif, timestamp or date, statuses.get(status), subjects.get(subject)) for uif, timestamp, date, subject, status in rows]
+    )
+
+def _log_epoch(value):
+    """Wall-clock epoch seconds for a date/datetime/string, matching email_log_entries.ts."""
+    return int(pd.Timestamp(value).timestamp())
+
+_BUFFER_KINDS = ('logs', 'errors', 'deliveries', 'suppressions', 'sent_updates', 'due_updates', 'ledger_updates', 'metrics')
+
+def _get_log_buffer():
+    """One process-wide write-behind buffer, shared by every rerun and worker thread and flushed at exit.
+
+    buffer['groups'] holds one {kind: rows} dict per `_buffer_rows` call.
+    """
+    buffer = {'groups': [], 'rows': 0}
+    buffer.update({'lock': threading.Lock(), 'flush_lock': threading.Lock(), 'oldest': None, 'last_error': None, 'dead_letters': 0})
+    atexit.register(lambda: flush_log_buffer(buffer))
+    return buffer
+
+LOG_BUFFER = _get_log_buffer()
+
+def _get_metrics_registry():
+    """Process-wide counters and latency histograms for the metrics exporter; they restart from zero with the process."""
+    return {
+        'lock': threading.Lock(),
+        'counters': {},
+        'histograms': {},
+        'breakers': deque(maxlen=50),
+        'last_send': None,
+    }
+
+METRICS = _get_metrics_registry()
+
+def inc_metric(name, amount=1, **labels):
+    with METRICS['lock']:
+        key = (name, tuple(sorted(labels.items())))
+        METRICS['counters'][key] = METRICS['counters'].get(key, 0) + amount
+
+def observe_latency(stage, seconds):
+    """Add one observation to the `stage` latency histogram."""
+    with METRICS['lock']:
+        histogram = METRICS['histograms'].setdefault(stage, {'buckets': [0] * len(METRICS_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0})
+        for i, bound in enumerate(METRICS_LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+_SEND_METRICS = threading.local()
+
+def begin_send_metrics():
+    """Start timing one message on this thread; stages timed until `finish_send_metrics` belong to it."""
+    _SEND_METRICS.current = {'started': time.perf_counter(), 'stages': {}}
+    _SEND_METRICS.active = None
+
+def record_stage(stage, started):
+    """Add the time since `started` (a perf_counter value) to `stage` of the message being timed, if any."""
+    current = getattr(_SEND_METRICS, 'current', None)
+    if current is not None:
+        current['stages'][stage] = current['stages'].get(stage, 0.0) + (time.perf_counter() - started) * 1000
+
+def timed_stage(stage):
+    """Decorator: time calls as `stage`. Calls nested inside another timed stage count only towards the outer one."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(_SEND_METRICS, 'current', None) is None or getattr(_SEND_METRICS, 'active', None):
+                return func(*args, **kwargs)
+            _SEND_METRICS.active = stage
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _SEND_METRICS.active = None
+                record_stage(stage, started)
+        return wrapper
+    return decorator
+
+def finish_send_metrics(uif_reference, status, result=None):
+    """Close the message being timed on this thread and queue its send_metrics row."""
+    current = getattr(_SEND_METRICS, 'current', None)
+    _SEND_METRICS.current = None
+    if current is None:
+        return
+    result = result or {}
+    delivery = result.get('delivery') or {}
+    stages = current['stages']
+    total_ms = (time.perf_counter() - current['started']) * 1000
+    for stage, elapsed_ms in stages.items():
+        observe_latency(stage, elapsed_ms / 1000)
+    observe_latency('total', total_ms / 1000)
+    inc_metric('messages', status=status)
+    inc_metric('message_bytes', delivery.get('size_bytes') or 0)
+    METRICS['last_send'] = time.time()
+    _buffer_rows(metrics=[(
+        result.get('message_id'), uif_reference, _log_epoch(datetime.now()), status,
+        len(delivery.get('results') or ()), delivery.get('size_bytes'),
+        *(round(stages[stage], 3) if stage in stages else None for stage in SEND_METRIC_STAGES),
+        round(total_ms, 3)
+    )])
+
+@timed_stage('db_write')
+def _buffer_rows(**rows):
+    """Queue rows by kind; flush once the buffer is big or old enough.
+
+    Rows queued in one call always land in the same flush transaction.
+    """
+    group = {kind: list(kind_rows) for kind, kind_rows in rows.items() if kind_rows}
+    with LOG_BUFFER['lock']:
+        LOG_BUFFER['groups'].append(group)
+        LOG_BUFFER['rows'] += _group_row_count(group)
+        if LOG_BUFFER['oldest'] is None:
+            LOG_BUFFER['oldest'] = time.monotonic()
+        flush_due = (
+            LOG_BUFFER['rows'] >= LOG_BUFFER_MAX_ROWS
+            or time.monotonic() - LOG_BUFFER['oldest'] >= LOG_BUFFER_MAX_AGE_SECONDS
+        )
+    if flush_due:
+        flush_log_buffer()
+
+def _group_row_count(group):
+    return sum(len(kind_rows) for kind_rows in group.values())
+
+def _write_buffered_rows(conn, groups):
+    """Write buffered groups on `conn`, one executemany per kind; the caller commits.
+
+    Kinds with no rows are skipped, so a group only touches the tables it has rows for.
+    """
+    batch = {kind: [row for group in groups for row in group.get(kind, ())] for kind in _BUFFER_KINDS}
+    _insert_log_rows(conn, batch['logs'])
+    if batch['errors']:
+        _insert_error_rows(conn, [(None,) + row[:6] + (_format_stack(row[6]),) for row in batch['errors']])
+    statements = (
+        ('deliveries',
+         "INSERT INTO email_deliveries (message_id, UIF_REFERENCE, recipient, smtp_code, smtp_response, status, size_bytes, latency_ms, timestamp) "
+         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"),
+        ('sent_updates',
+         "UPDATE companies SET emails_sent = COALESCE(emails_sent, 0) + 1, last_sent = ?, next_due_at = ? WHERE UIF_REFERENCE = ?"),
+        ('due_updates', "UPDATE companies SET next_due_at = ? WHERE UIF_REFERENCE = ?"),
+        ('ledger_updates',
+         "UPDATE send_ledger SET status = ?, message_id = COALESCE(?, message_id), finished_at = ? "
+         "WHERE UIF_REFERENCE = ? AND step = ? AND campaign = ?"),
+        ('metrics',
+         f"INSERT INTO send_metrics (message_id, UIF_REFERENCE, ts, status, recipients, size_bytes, "
+         f"{', '.join(f'{stage}_ms' for stage in SEND_METRIC_STAGES)}, total_ms) "
+         f"VALUES ({', '.join('?' * (len(SEND_METRIC_STAGES) + 7))})"),
+    )
+    _suppress_in_conn(conn, batch['suppressions'], 'rcpt-refused')
+    for kind, sql in statements:
+        if batch[kind]:
+            conn.executemany(sql, batch[kind])
+
+def _is_busy_error(error):
+    """True for SQLITE_BUSY/SQLITE_LOCKED, the only OperationalErrors a later flush can get past."""
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return (code & 0xff) in (5, 6)  # SQLITE_BUSY, SQLITE_LOCKED (extended codes keep them in the low byte)
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def _requeue_rows(buffer, groups):
+    """Put unwritten groups back at the front of the buffer for the next flush."""
+    with buffer['lock']:
+        buffer['groups'] = groups + buffer['groups']
+        buffer['rows'] += sum(_group_row_count(group) for group in groups)
+        if groups:
+            buffer['oldest'] = buffer['oldest'] or time.monotonic()
+
+def _dead_letter(buffer, group, error):
+    """Set aside a group the database rejects, whole: log it and append it to LOG_DEAD_LETTER_FILE."""
+    buffer['dead_letters'] += 1
+    if group.get('errors'):
+        group = dict(group, errors=[row[:6] + (_format_stack(row[6]),) for row in group['errors']])
+    logger.error("Dropped buffered rows %r: %s: %s", group, type(error).__name__, error)
+    try:
+        with open(LOG_DEAD_LETTER_FILE, 'a', encoding='utf-8') as handle:
+            handle.write(json.dumps({
+                'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'rows': group,
+                'error': f"{type(error).__name__}: {error}",
+            }, default=str) + "\n")
+    except OSError as e:
+        logger.error("Could not write %s: %s", LOG_DEAD_LETTER_FILE, e)
+
+def _flush_groups_individually(buffer, groups):
+    """Fallback after a batch fails on bad data: one transaction per queued group.
+
+    A group is everything one `_buffer_rows` call queued (say, a send's log,
+    counter and ledger rows), so it is written, requeued or dead-lettered
+    together and a poison row cannot split it or take other groups with it.
+    """
+    written = 0
+    requeue = []
+    for group in groups:
+        try:
+            with connect() as conn:
+                _write_buffered_rows(conn, [group])
+                conn.commit()
+            written += _group_row_count(group)
+        except Exception as e:
+            if isinstance(e, sqlite3.OperationalError) and _is_busy_error(e):
+                requeue.append(group)
+            else:
+                _dead_letter(buffer, group, e)
+    _requeue_rows(buffer, requeue)
+    return written
+
+def flush_log_buffer(buffer=None):
+    """Write all buffered rows with executemany in one transaction. Returns the number of rows written.
+
+    If the database is busy or locked the rows go back to the front of the
+    buffer for the next flush. Any other error (bad data, a missing table)
+    falls back to one transaction per `_buffer_rows` group: good groups are
+    written, a group that still fails is dead-lettered whole and busy groups
+    are requeued. Either way the error is kept in buffer['last_error'].
+    """
+    buffer = buffer if buffer is not None else LOG_BUFFER
+    with buffer['flush_lock']:
+        with buffer['lock']:
+            groups = buffer['groups']
+            written = buffer['rows']
+            buffer['groups'] = []
+            buffer['rows'] = 0
+            buffer['oldest'] = None
+        if not written:
+            return 0
+        try:
+            with connect() as conn:
+                _write_buffered_rows(conn, groups)
+                conn.commit()
+            buffer['last_error'] = None
+            return written
+        except Exception as e:
+            buffer['last_error'] = f"{type(e).__name__}: {e}"
+            if isinstance(e, sqlite3.OperationalError) and _is_busy_error(e):
+                _requeue_rows(buffer, groups)
+                return 0
+            return _flush_groups_individually(buffer, groups)
+
+def _format_stack(stack):
+    if isinstance(stack, traceback.StackSummary):
+        return "Traceback (most recent call last):\n" + "".join(stack.format())
+    return stack or ''
+
+def _backfill_rollups(conn):
+    """Seed the daily log rollup and the company summary from existing rows."""
+    conn.execute(
+        "INSERT INTO email_log_daily (date, status, count) "
+        "SELECT COALESCE(date, substr(timestamp, 1, 10)), COALESCE(status, ''), COUNT(*) FROM email_logs "
+        "WHERE COALESCE(date, timestamp) IS NOT NULL GROUP BY 1, 2"
+    )
+    conn.execute(
+        "INSERT OR REPLACE INTO company_state_summary (id, total, completed, paused, active) "
+        "SELECT 1, COUNT(*), "
+        "COALESCE(SUM(COALESCE(completed, 0) = 1), 0), "
+        "COALESCE(SUM(COALESCE(paused, 0) = 1), 0), "
+        "COALESCE(SUM(COALESCE(completed, 0) != 1 AND COALESCE(paused, 0) != 1), 0) "
+        "FROM companies"
+    )
+
+def log_send_error(stage, uif_ref, recipient, exc: Exception):
+    # Capture the stack without reading source lines; it is formatted when the buffer is flushed
+    stack = traceback.StackSummary.extract(traceback.walk_tb(exc.__traceback__), lookup_lines=False)
+    if isinstance(recipient, (list, tuple, set)):
+        recipient = ", ".join(recipient)
+    _buffer_rows(errors=[(
+        uif_ref or '',
+        recipient or '',
+        stage,
+        datetime.now().isoformat(),
+        type(exc).__name__,
+        str(exc),
+        stack
+    )])
+
+def get_companies_data():
+    with connect() as conn:
+        df = pd.read_sql_query("SELECT * FROM companies", conn)
+    return df
+
+def get_company_emails(uif_ref, include_suppressed=False):
+    """Return a deduplicated list of all recipient emails for a company.
+    Includes the primary `companies.EMAIL_ADDRESS` and any in `company_emails`.
+    Suppressed (hard-bounced) addresses are left out unless `include_suppressed` is set.
+    """
+    resolved = resolve_company_recipients([uif_ref]).get(uif_ref)
+    if not resolved:
+        return []
+    if include_suppressed:
+        return resolved['all']
+    return resolved['recipients']
+
+def resolve_company_recipients(uif_refs):
+    """Resolve recipients for many companies with a handful of queries.
+
+    Returns {UIF_REFERENCE: {'all': [...], 'recipients': [...], 'suppressed': [...]}}
+    where `recipients` excludes addresses on the suppression list. Database
+    errors propagate: without the suppression check nobody may be emailed.
+    """
+    refs = list(dict.fromkeys(r for r in uif_refs if r))
+    emails_by_ref = {r: [] for r in refs}
+    with connect() as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(refs), 500):
+            chunk = refs[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            # Primary email from companies table
+            cursor.execute(
+                f"SELECT UIF_REFERENCE, EMAIL_ADDRESS FROM companies WHERE UIF_REFERENCE IN ({placeholders})",
+                chunk
+            )
+            for uif, addr in cursor.fetchall():
+                if addr and addr.strip():
+                    emails_by_ref[uif].insert(0, addr.strip())
+            # Additional emails
+            cursor.execute(
+                f"SELECT UIF_REFERENCE, EMAIL FROM company_emails WHERE UIF_REFERENCE IN ({placeholders}) ORDER BY id",
+                chunk
+            )
+            for uif, addr in cursor.fetchall():
+                if addr and addr.strip():
+                    emails_by_ref[uif].append(addr.strip())
+        all_addresses = {e.lower() for emails in emails_by_ref.values() for e in emails}
+        suppressed = _suppressed_subset(conn, all_addresses)
+    resolved = {}
+    for uif, emails in emails_by_ref.items():
+        # Deduplicate while preserving order
+        seen = set()
+        deduped = []
+        for e in emails:
+            if e and e.lower() not in seen:
+                seen.add(e.lower())
+                deduped.append(e)
+        resolved[uif] = {
+            'all': deduped,
+            'recipients': [e for e in deduped if e.lower() not in suppressed],
+            'suppressed': [e for e in deduped if e.lower() in suppressed],
+        }
+    return resolved
+
+def _suppressed_subset(conn, addresses):
+    """Return the lowercased addresses from `addresses` that are on the suppression list."""
+    addresses = list(addresses)
+    found = set()
+    for start in range(0, len(addresses), 500):
+        chunk = addresses[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT email FROM suppressed_recipients WHERE email IN ({placeholders})",
+            chunk
+        ).fetchall()
+        found.update(r[0] for r in rows)
+    return found
+
+def is_hard_bounce(smtp_code, response=''):
+    """True for permanent (5xx) recipient failures, excluding 5.7.x policy rejections."""
+    try:
+        code = int(smtp_code)
+    except (TypeError, ValueError):
+        return False
+    if not 500 <= code < 600:
+        return False
+    enhanced = re.search(r'\b([245])\.(\d{1,3})\.(\d{1,3})\b', str(response or ''))
+    return not (enhanced and enhanced.group(1) == '5' and enhanced.group(2) == '7')
+
+def _suppress_in_conn(conn, entries, source):
+    """Upsert (email, reason, uif_ref, smtp_code) entries into the suppression list on an open connection."""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [
+        ((addr or '').strip().lower(), reason, source, uif_ref, code, now, now)
+        for addr, reason, uif_ref, code in entries
+        if addr and '@' in addr
+    ]
+    if rows:
+        conn.executemany(
+            "INSERT INTO suppressed_recipients (email, reason, source, UIF_REFERENCE, smtp_code, hits, first_seen, last_seen) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?, ?) "
+            "ON CONFLICT(email) DO UPDATE SET hits = hits + 1, reason = excluded.reason, source = excluded.source, "
+            "smtp_code = excluded.smtp_code, last_seen = excluded.last_seen",
+            rows
+        )
+    return len(rows)
+
+def suppress_recipients(entries, source='manual'):
+    """Add (email, reason, uif_ref, smtp_code) entries to the suppression list. Returns count."""
+    with connect() as conn:
+        count = _suppress_in_conn(conn, entries, source)
+        conn.commit()
+    return count
+
+def unsuppress_recipient(email_address):
+    """Remove an address from the suppression list so it is mailed again."""
+    if not email_address:
+        return False, "Missing email"
+    try:
+        with connect() as conn:
+            conn.execute("DELETE FROM suppressed_recipients WHERE email = ?", (email_address.strip().lower(),))
+            conn.commit()
+        return True, "Email removed from suppression list"
+    except Exception as e:
+        return False, str(e)
+
+def get_suppressed_recipients():
+    with connect() as conn:
+        return pd.read_sql_query("SELECT * FROM suppressed_recipients ORDER BY last_seen DESC", conn)
+
+def _backfill_suppressions(conn):
+    """Seed the suppression list from refused recipients already in the delivery and error logs."""
+    entries = []
+    for recipient, code, response, uif in conn.execute(
+        "SELECT recipient, smtp_code, smtp_response, UIF_REFERENCE FROM email_deliveries WHERE status = 'Refused'"
+    ).fetchall():
+        if is_hard_bounce(code, response):
+            entries.append((recipient, response, uif, code))
+    for uif, message in conn.execute(
+        "SELECT UIF_REFERENCE, error_message FROM email_error_logs WHERE error_type = 'SMTPRecipientsRefused'"
+    ).fetchall():
+        try:
+            refused = ast.literal_eval(message or '')
+        except Exception:
+            continue
+        if not isinstance(refused, dict):
+            continue
+        for recipient, detail in refused.items():
+            code, response = (detail + (None, None))[:2] if isinstance(detail, tuple) else (None, None)
+            if isinstance(response, bytes):
+                response = response.decode('utf-8', errors='replace')
+            if is_hard_bounce(code, response):
+                entries.append((recipient, response, uif, code))
+    return _suppress_in_conn(conn, entries, 'history')
+
+def add_additional_email(uif_ref, address):
+    """Add an additional email for a company (no-op if duplicate)."""
+    if not uif_ref or not address:
+        return False, "Missing UIF reference or email"
+    address = address.strip()
+    try:
+        with connect() as conn:
+            cursor = conn.cursor()
+            # Do not add if matches primary (case-insensitive)
+            cursor.execute("SELECT EMAIL_ADDRESS FROM companies WHERE UIF_REFERENCE = ?", (uif_ref,))
+            row = cursor.fetchone()
+            if row and row[0] and row[0].strip().lower() == address.lower():
+                return False, "Email matches the primary address"
+            cursor.execute(
+                "INSERT OR IGNORE INTO company_emails (UIF_REFERENCE, EMAIL) VALUES (?, ?)",
+                (uif_ref, address)
+            )
+            conn.commit()
+        return True, "Email added"
+    except Exception as e:
+        return False, str(e)
+
+def remove_additional_email(uif_ref, address):
+    """Remove an additional email for a company."""
+    if not uif_ref or not address:
+        return False, "Missing UIF reference or email"
+    try:
+        with connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM company_emails WHERE UIF_REFERENCE = ? AND EMAIL = ?",
+                (uif_ref, address)
+            )
+            conn.commit()
+        return True, "Email removed"
+    except Exception as e:
+        return False, str(e)
+
+def _parse_email_candidates(raw_text: str):
+    """Parse a raw string of emails separated by commas, semicolons, or whitespace into unique emails."""
+    if not raw_text:
+        return []
+    separators = [',', ';', '\n', '\t']
+    text = raw_text.strip().replace('\r', ' ')
+    for sep in separators:
+        text = text.replace(sep, ' ')
+    parts = [p.strip() for p in text.split(' ') if p and p.strip()]
+    # Deduplicate preserving order; basic sanity filter
+    seen = set()
+    result = []
+    for p in parts:
+        candidate = p.strip()
+        if candidate and candidate.lower() not in seen:
+            seen.add(candidate.lower())
+            result.append(candidate)
+    return result
+
+def add_additional_emails_bulk(uif_ref: str, raw_text: str):
+    """Add multiple additional emails from a pasted list. Returns summary dict."""
+    emails = _parse_email_candidates(raw_text)
+    added = []
+    skipped_duplicates = []
+    skipped_invalid = []
+    for e in emails:
+        # Basic validation
+        lower = e.lower()
+        if '@' not in lower or '.' not in lower.split('@')[-1]:
+            skipped_invalid.append(e)
+            continue
+        ok, msg = add_additional_email(uif_ref, e)
+        if ok:
+            added.append(e)
+        else:
+            # If duplicate or matches primary, treat as duplicate skip
+            skipped_duplicates.append(e)
+    return {
+        'added': added,
+        'skipped_duplicates': skipped_duplicates,
+        'skipped_invalid': skipped_invalid
+    }
+
+def remove_additional_emails_bulk(uif_ref: str, emails_to_remove: list):
+    """Remove multiple additional emails. Returns summary dict."""
+    removed = []
+    failed = []
+    for address in emails_to_remove:
+        ok, msg = remove_additional_email(uif_ref, address)
+        if ok:
+            removed.append(address)
+        else:
+            failed.append({'email': address, 'error': msg})
+    return {
+        'removed': removed,
+        'failed': failed
+    }
+
+def validate_email_list(emails: list):
+    """Validate a list of emails and return validation results."""
+    valid = []
+    invalid = []
+    for address in emails:
+        address = address.strip()
+        if '@' in address and '.' in address.split('@')[-1] and len(address) > 5:
+            valid.append(address)
+        else:
+            invalid.append(address)
+    return valid, invalid
+
+def update_final_email_template():
+    """Update the final email template in the database with the new content."""
+    new_final_template = {
+        'subject': 'Final Notice: Non-Compliance with UIF TERS Audit Requirements',
+        'body': '''<!DOCTYPE html>
+<html>
+  <head>
+    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+  </head>
+  <body>
+    <p>Good day,</p>
+    <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
+    <p>Despite multiple attempts to obtain the required documentation, including:</p>
+    <ol>
+      <li>Initial audit notification</li>
+      <li>Detailed information request</li>
+      <li>Follow-up communication</li>
+    </ol>
+    <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
+    <ul>
+      <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
+      <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
+    </ul>
+    <h3>NOTICE OF ESCALATION</h3>
+    <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
+    <ol>
+      <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
+      <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
+      <li>Potential criminal charges for non-compliance and fraud</li>
+    </ol>
+    <h3>REQUIRED IMMEDIATE ACTION</h3>
+    <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
+    <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
+    <p>Kind regards,<br>
+      <strong>Gamu Dambanjera</strong></p>
+    <div class="moz-signature"> <img src='cid:signature'></div>
+  </body>
+</html>'''
+    }
+    
+    try:
+        with connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE email_templates SET subject = ?, body = ? WHERE template_key = 'final'",
+                (new_final_template['subject'], new_final_template['body'])
+            )
+            conn.commit()
+        return True, "Final email template updated successfully"
+    except Exception as e:
+        return False, f"Failed to update template: {str(e)}"
+
+DELIVERY_ISSUE_FILTERS = {
+    "All Issues": "h.total_issues > 0",
+    "Bounced Emails Only": "h.bounce_count > 0",
+    "Failed Emails Only": "h.failure_count > 0",
+    "Both Bounced & Failed": "h.bounce_count > 0 AND h.failure_count > 0",
+}
+
+DELIVERY_HEALTH_SORTS = {
+    "Last Issue Date": "last_issue_date DESC, total_issues DESC",
+    "Total Issues": "total_issues DESC, last_issue_date DESC",
+    "Company Name": "c.TRADE_NAME ASC",
+    "UIF Reference": "h.UIF_REFERENCE ASC",
+}
+
+def _backfill_delivery_health(conn):
+    """Seed company_delivery_health from existing email_logs rows."""
+    conn.execute("""
+        INSERT OR REPLACE INTO company_delivery_health (
+            UIF_REFERENCE, bounce_count, failure_count, total_issues,
+            last_bounce_date, last_failure_date, last_issue_date, last_success_date,
+            bounced_subjects, failed_subjects
+        )
+        SELECT UIF_REFERENCE,
+               SUM(status = 'Bounced'), SUM(status = 'Failed'), SUM(status IN ('Bounced', 'Failed')),
+               MAX(CASE WHEN status = 'Bounced' THEN timestamp END),
+               MAX(CASE WHEN status = 'Failed' THEN timestamp END),
+               MAX(CASE WHEN status IN ('Bounced', 'Failed') THEN timestamp END),
+               MAX(CASE WHEN status = 'Sent' THEN timestamp END),
+               substr(GROUP_CONCAT(DISTINCT CASE WHEN status = 'Bounced' THEN subject END), 1, 300),
+               substr(GROUP_CONCAT(DISTINCT CASE WHEN status = 'Failed' THEN subject END), 1, 300)
+        FROM email_logs
+        WHERE status IN ('Bounced', 'Failed', 'Sent') AND UIF_REFERENCE IS NOT NULL
+        GROUP BY UIF_REFERENCE
+    """)
+
+def _like_escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _delivery_health_where(issue_type, search):
+    """WHERE clause and parameters shared by the health list and its summary."""
+    clauses = [DELIVERY_ISSUE_FILTERS.get(issue_type, DELIVERY_ISSUE_FILTERS["All Issues"])]
+    params = []
+    if search:
+        pattern = '%' + _like_escape(search) + '%'
+        clauses.append(
+            "(h.UIF_REFERENCE LIKE ? ESCAPE '\\' OR c.TRADE_NAME LIKE ? ESCAPE '\\' OR c.EMAIL_ADDRESS LIKE ? ESCAPE '\\')"
+        )
+        params.extend([pattern] * 3)
+    return " AND ".join(clauses), params
+
+def _delivery_health_query(issue_type="All Issues", sort_by="Last Issue Date", limit=None, search=None):
+    """SQL and parameters for a delivery-health listing (shared by the page and exports)."""
+    # Single-kind filters report that kind's numbers as the issue totals
+    if issue_type == "Bounced Emails Only":
+        columns = """h.bounce_count, 0 AS failure_count, h.bounce_count AS total_issues,
+                     h.last_bounce_date AS last_issue_date, h.bounced_subjects, '' AS failed_subjects"""
+    elif issue_type == "Failed Emails Only":
+        columns = """0 AS bounce_count, h.failure_count, h.failure_count AS total_issues,
+                     h.last_failure_date AS last_issue_date, '' AS bounced_subjects, h.failed_subjects"""
+    else:
+        columns = """h.bounce_count, h.failure_count, h.total_issues,
+                     h.last_issue_date, h.bounced_subjects, h.failed_subjects"""
+    where, params = _delivery_health_where(issue_type, search)
+    order = DELIVERY_HEALTH_SORTS.get(sort_by, DELIVERY_HEALTH_SORTS["Last Issue Date"])
+    query = f"""
+        SELECT h.UIF_REFERENCE, c.TRADE_NAME, c.EMAIL_ADDRESS, c.PHONE,
+               {columns}, h.last_success_date
+        FROM company_delivery_health h
+        INNER JOIN companies c ON c.UIF_REFERENCE = h.UIF_REFERENCE
+        WHERE {where}
+        ORDER BY {order}
+    """
+    if limit:
+        query += " LIMIT ?"
+        params.append(int(limit))
+    return query, params
+
+def get_delivery_health(issue_type="All Issues", sort_by="Last Issue Date", limit=None, search=None):
+    """Companies with delivery issues from the materialised health table; filter, sort, search and Top-N run in SQL."""
+    query, params = _delivery_health_query(issue_type, sort_by, limit, search)
+    try:
+        with connect() as conn:
+            return pd.read_sql_query(query, conn, params=params)
+    except Exception as e:
+        notify('error', f"Error retrieving delivery health: {e}")
+        return pd.DataFrame()
+
+def get_delivery_health_summary(issue_type="All Issues", search=None):
+    """Company/bounce/failure totals for a delivery-health filter (ignores Top-N)."""
+    where, params = _delivery_health_where(issue_type, search)
+    if issue_type == "Bounced Emails Only":
+        issues = "h.bounce_count"
+    elif issue_type == "Failed Emails Only":
+        issues = "h.failure_count"
+    else:
+        issues = "h.total_issues"
+    summary = {'companies': 0, 'bounces': 0, 'failures': 0, 'total_issues': 0}
+    try:
+        with connect() as conn:
+            row = conn.execute(f"""
+                SELECT COUNT(*),
+                       COALESCE(SUM(CASE WHEN ? = 'Failed Emails Only' THEN 0 ELSE h.bounce_count END), 0),
+                       COALESCE(SUM(CASE WHEN ? = 'Bounced Emails Only' THEN 0 ELSE h.failure_count END), 0),
+                       COALESCE(SUM({issues}), 0)
+                FROM company_delivery_health h
+                INNER JOIN companies c ON c.UIF_REFERENCE = h.UIF_REFERENCE
+                WHERE {where}
+            """, [issue_type, issue_type] + params).fetchone()
+        summary.update(zip(('companies', 'bounces', 'failures', 'total_issues'), row))
+    except Exception as e:
+        notify('error', f"Error retrieving delivery health summary: {e}")
+    return summary
+
+def get_bounced_companies():
+    """Get all companies with bounced emails along with their details."""
+    df = get_delivery_health("Bounced Emails Only")
+    if df.empty:
+        return df
+    return df[['UIF_REFERENCE', 'TRADE_NAME', 'EMAIL_ADDRESS', 'PHONE', 'bounce_count', 'last_issue_date', 'bounced_subjects']] \
+        .rename(columns={'last_issue_date': 'last_bounce_date'})
+
+def get_failed_companies():
+    """Get all companies with failed emails along with their details."""
+    df = get_delivery_health("Failed Emails Only")
+    if df.empty:
+        return df
+    return df[['UIF_REFERENCE', 'TRADE_NAME', 'EMAIL_ADDRESS', 'PHONE', 'failure_count', 'last_issue_date', 'failed_subjects']] \
+        .rename(columns={'last_issue_date': 'last_failure_date'})
+
+def get_unreachable_companies():
+    """Get comprehensive list of all unreachable companies (bounced + failed)."""
+    return get_delivery_health("All Issues")
+
+def get_data_version():
+    """Cheap version stamp of the database; changes with every committed write.
+
+    Under WAL a commit only appends to the -wal file until a checkpoint copies
+    it back, so both files are stamped: a commit grows or rewrites the WAL and
+    a checkpoint rewrites the main file.
+    """
+    stamps = []
+    for path in (DATABASE_FILE, f"{DATABASE_FILE}-wal"):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps.append('0')
+            continue
+        stamps.append(f"{stat.st_mtime_ns}-{stat.st_size}")
+    return ":".join(stamps)
+
+def _xlsx_available():
+    return importlib.util.find_spec('openpyxl') is not None
+
+def _export_source(kind, filters):
+    """(query, params, archived DataFrame or None) behind an export kind."""
+    filters = filters or {}
+    if kind == 'email_logs':
+        clauses, params = [], []
+        if filters.get('uif_ref'):
+            clauses.append("e.UIF_REFERENCE = ?")
+            params.append(filters['uif_ref'])
+        if filters.get('status'):
+            clauses.append("st.status = ?")
+            params.append(filters['status'])
+        if filters.get('start'):
+            clauses.append("e.ts >= ?")
+            params.append(_log_epoch(filters['start']))
+        query = EMAIL_LOG_VIEW_SQL + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY e.log_id"
+        archived = read_archived_logs('email_logs', filters.get('start'), None, filters.get('uif_ref'))
+        if not archived.empty and filters.get('status'):
+            archived = archived[archived['status'] == filters['status']]
+        return query, params, archived
+    if kind == 'email_error_logs':
+        clauses, params = [], []
+        if filters.get('uif_ref'):
+            clauses.append("e.UIF_REFERENCE = ?")
+            params.append(filters['uif_ref'])
+        if filters.get('stage'):
+            clauses.append("e.stage = ?")
+            params.append(filters['stage'])
+        query = ERROR_LOG_VIEW_SQL + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY e.error_id DESC"
+        archived = read_archived_logs('email_error_logs', uif_ref=filters.get('uif_ref'))
+        if not archived.empty:
+            if filters.get('stage'):
+                archived = archived[archived['stage'] == filters['stage']]
+            archived = archived.sort_values('error_id', ascending=False)
+        return query, params, archived
+    if kind == 'completed_companies':
+        query, params = "SELECT * FROM companies WHERE completed = 1", []
+        if filters.get('search'):
+            pattern = _like_escape(filters['search'].strip()) + '%'
+            query += " AND (UIF_REFERENCE LIKE ? ESCAPE '\\' OR TRADE_NAME LIKE ? ESCAPE '\\')"
+            params.extend([pattern, pattern])
+        return query, params, None
+    if kind == 'unreachable':
+        query, params = _delivery_health_query(
+            filters.get('issue_type', "All Issues"), filters.get('sort_by', "Last Issue Date"),
+            filters.get('limit'), filters.get('search')
+        )
+        return query, params, None
+    raise ValueError(f"Unknown export: {kind}")
+
+def _iter_export_rows(kind, filters):
+    """Yield the header, then row chunks, straight from a SQL cursor (archived rows go first for logs)."""
+    query, params, archived = _export_source(kind, filters)
+    with connect() as conn:
+        cursor = conn.execute(query, params)
+        columns = [d[0] for d in cursor.description]
+        yield columns
+        if archived is not None and not archived.empty and kind == 'email_logs':
+            yield archived.reindex(columns=columns).itertuples(index=False, name=None)
+        while True:
+            chunk = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not chunk:
+                break
+            yield chunk
+        if archived is not None and not archived.empty and kind != 'email_logs':
+            yield archived.reindex(columns=columns).itertuples(index=False, name=None)
+
+def build_export(kind, filters=None, fmt='csv'):
+    """Write an export to a temp file on demand and return its path.
+
+    Files are keyed by export kind, filters, format and data version, so repeat downloads
+    of unchanged data reuse the file; older versions of the same export are removed.
+    """
+    filter_key = hashlib.sha1(repr(sorted((filters or {}).items())).encode()).hexdigest()[:12]
+    version_key = hashlib.sha1(get_data_version().encode()).hexdigest()[:12]
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    prefix = f"{kind}-{filter_key}-{fmt}-"
+    path = os.path.join(EXPORT_DIR, f"{prefix}{version_key}.{fmt}")
+    if os.path.exists(path):
+        return path
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    rows = _iter_export_rows(kind, filters)
+    columns = next(rows)
+    if fmt == 'xlsx':
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet(kind[:31])
+        sheet.append(columns)
+        for chunk in rows:
+            for row in chunk:
+                sheet.append(list(row))
+        workbook.save(tmp_path)
+    else:
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as handle:
+            writer = csv.writer(handle)
+            writer.writerow(columns)
+            for chunk in rows:
+                writer.writerows(chunk)
+    os.replace(tmp_path, path)
+    for name in os.listdir(EXPORT_DIR):
+        if name.startswith(prefix) and os.path.join(EXPORT_DIR, name) != path and not name.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(EXPORT_DIR, name))
+            except OSError:
+                pass
+    return path
+
+def export_bytes(kind, filters=None, fmt='csv'):
+    with open(build_export(kind, filters, fmt), 'rb') as handle:
+        return handle.read()
+
+def export_unreachable_companies():
+    """Export unreachable companies to CSV format."""
+    try:
+        csv_data = export_bytes('unreachable')
+        # Header only means there is nothing to export
+        return csv_data if csv_data.count(b'\n') > 1 else None
+    except Exception as e:
+        notify('error', f"Error exporting unreachable companies: {e}")
+        return None
+
+def log_email(uif_reference, subject, status):
+    """Log email activity to the database (write-behind; see `flush_log_buffer`)"""
+    now = datetime.now()
+    _buffer_rows(logs=[(uif_reference, now.strftime('%Y-%m-%d %H:%M:%S'), now.strftime('%Y-%m-%d'), subject, status)])
+
+def get_email_logs(uif_ref=None, start=None, end=None, include_archive=True):
+    """Email log rows; start/end (inclusive/exclusive) range-scan the epoch index.
+
+    Archived partitions overlapping the range are merged in unless include_archive is False.
+    """
+    clauses, params = [], []
+    if uif_ref:
+        clauses.append("e.UIF_REFERENCE = ?")
+        params.append(uif_ref)
+    if start is not None:
+        clauses.append("e.ts >= ?")
+        params.append(_log_epoch(start))
+    if end is not None:
+        clauses.append("e.ts < ?")
+        params.append(_log_epoch(end))
+    query = EMAIL_LOG_VIEW_SQL + (" WHERE " + " AND ".join(clauses) if clauses else "") + " ORDER BY e.log_id"
+    with connect() as conn:
+        df = pd.read_sql_query(query, conn, params=params)
+    if include_archive:
+        archived = read_archived_logs('email_logs', start, end, uif_ref)
+        if not archived.empty:
+            df = pd.concat([archived, df], ignore_index=True)
+    return df
+
+def get_error_logs(uif_ref=None, include_archive=True):
+    with connect() as conn:
+        try:
+            if uif_ref:
+                df = pd.read_sql_query(
+                    "SELECT * FROM email_error_logs WHERE UIF_REFERENCE = ? ORDER BY error_id DESC",
+                    conn, params=(uif_ref,)
+                )
+            else:
+                df = pd.read_sql_query(
+                    "SELECT * FROM email_error_logs ORDER BY error_id DESC",
+                    conn
+                )
+        except Exception:
+            # Table might not exist yet
+            df = pd.DataFrame()
+    if include_archive:
+        archived = read_archived_logs('email_error_logs', uif_ref=uif_ref)
+        if not archived.empty:
+            df = pd.concat([df, archived.sort_values('error_id', ascending=False)], ignore_index=True)
+    return df
+
+# Upsert rather than REPLACE: keeps emails_sent/completed/paused and fires the summary triggers
+_UPSERT_COMPANY_SQL = (
+    "INSERT INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, PHONE) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(UIF_REFERENCE) DO UPDATE SET TRADE_NAME = excluded.TRADE_NAME, "
+    "EMAIL_ADDRESS = excluded.EMAIL_ADDRESS, PHONE = COALESCE(excluded.PHONE, PHONE)"
+)
+
+def upsert_company(uif_ref, trade_name, email_address, phone=None):
+    """Insert or update a company record."""
+    try:
+        with connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_UPSERT_COMPANY_SQL, (uif_ref, trade_name, email_address, phone))
+            conn.commit()
+        return True, "Company upserted successfully"
+    except Exception as e:
+        return False, str(e)
+
+IMPORT_COLUMN_ALIASES = {
+    "\ufeffUIF Reference": "UIF_REFERENCE",
+    "UIF Reference": "UIF_REFERENCE",
+    "UIF_REFERENCE": "UIF_REFERENCE",
+    "TRADE NAMES": "TRADE_NAME",
+    "TRADE NAME": "TRADE_NAME",
+    "TRADE_NAME": "TRADE_NAME",
+    "EMAIL_ADDRESS": "EMAIL_ADDRESS",
+    "EMAIL": "EMAIL_ADDRESS",
+    "Email": "EMAIL_ADDRESS",
+    "PHONE": "PHONE",
+    "Phone": "PHONE",
+    "CONTACT NUMBER": "PHONE",
+}
+IMPORT_REQUIRED_COLUMNS = ["UIF_REFERENCE", "TRADE_NAME", "EMAIL_ADDRESS"]
+
+def read_company_file(source, sheet_name=None):
+    """Load a company list from an Excel workbook or CSV file. Returns (DataFrame, sheet name or None)."""
+    name = getattr(source, 'name', source)
+    if str(name).lower().endswith('.csv'):
+        return pd.read_csv(source, dtype=str, keep_default_na=False), None
+    xls = pd.ExcelFile(source)
+    target_sheet = sheet_name if sheet_name and sheet_name.strip() else xls.sheet_names[0]
+    return pd.read_excel(xls, sheet_name=target_sheet), target_sheet
+
+def import_companies(df):
+    """Upsert every row of a company list in one transaction. Returns a summary dict.
+
+    Column names are trimmed and common variants mapped onto UIF_REFERENCE,
+    TRADE_NAME, EMAIL_ADDRESS and PHONE; rows without a reference or trade
+    name are skipped. `missing` lists required columns that were not found,
+    in which case nothing is imported.
+    """
+    df = df.copy()
+    df.columns = df.columns.astype(str).str.strip()
+    df.rename(columns={k: v for k, v in IMPORT_COLUMN_ALIASES.items() if k in df.columns}, inplace=True)
+    summary = {'imported': 0, 'skipped': 0, 'missing': [c for c in IMPORT_REQUIRED_COLUMNS if c not in df.columns]}
+    if summary['missing']:
+        return summary
+    has_phone = "PHONE" in df.columns
+    rows = []
+    for _, row in df.iterrows():
+        uif = str(row.get("UIF_REFERENCE", "")).strip()
+        name = str(row.get("TRADE_NAME", "")).strip()
+        address = str(row.get("EMAIL_ADDRESS", "")).strip()
+        phone = str(row.get("PHONE", "")).strip() if has_phone else None
+        if uif and name:
+            rows.append((uif, name, address, phone))
+        else:
+            summary['skipped'] += 1
+    with connect() as conn:
+        conn.executemany(_UPSERT_COMPANY_SQL, rows)
+        conn.commit()
+    summary['imported'] = len(rows)
+    return summary
+
+def append_signature(body):
+    signature_image_path = "Email Signature/asignature1.png"
+    signature = f"<br><br><img src='cid:signature'><br>"
+    return body + signature
+
+def _list_mailbox_names(mail: imaplib.IMAP4_SSL):
+    names = []
+    try:
+        typ, mailboxes = mail.list()
+        if typ == 'OK' and mailboxes:
+            for mb in mailboxes:
+                decoded = mb.decode(errors='ignore') if isinstance(mb, bytes) else str(mb)
+                # Mailbox name is typically the last quoted string; fallback to last token
+                if ' "' in decoded:
+                    name = decoded.split(' "')[-1].rstrip('"')
+                else:
+                    name = decoded.split()[-1].strip('"')
+                if name:
+                    names.append(name)
+    except Exception:
+        return names
+    return names
+
+def _find_sent_folder(mail: imaplib.IMAP4_SSL) -> str:
+    """Try to detect and select an existing Sent folder; return a usable name if selectable."""
+    try:
+        names = _list_mailbox_names(mail)
+        # Rank candidates: special-use names first, then common names
+        preferred = []
+        for nm in names:
+            lower = nm.lower()
+            if 'sent' in lower:
+                preferred.append(nm)
+        # Add common static candidates as a fallback order
+        preferred.extend([
+            'Sent', 'Sent Items', 'Sent Mail', 'INBOX.Sent'
+        ])
+        # Deduplicate preserving order
+        seen = set()
+        ordered = [x for x in preferred if not (x in seen or seen.add(x))]
+        for cand in ordered:
+            typ, _ = mail.select(cand, readonly=True)
+            if typ == 'OK':
+                try:
+                    mail.close()
+                except Exception:
+                    pass
+                return cand
+    except Exception:
+        pass
+    return ''
+
+@timed_stage('imap_append')
+def append_email_to_sent_folder(msg, smtp_password):
+    try:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+        mail.login(SENDER_EMAIL, smtp_password)
+        sent_folder = _find_sent_folder(mail)
+        # If we couldn't select an existing one, create a simple 'Sent' folder
+        if not sent_folder:
+            simple_name = 'Sent'
+            try:
+                mail.create(simple_name)
+            except Exception:
+                # If create fails, we cannot proceed safely
+                raise
+            mail.select(simple_name)
+            target_mailbox = simple_name
+        else:
+            mail.select(sent_folder)
+            target_mailbox = sent_folder
+        mail.append(target_mailbox, '(\\Seen)', imaplib.Time2Internaldate(time.localtime()), msg.as_bytes())
+        mail.logout()
+    except Exception as e:
+        notify('error', f"Failed to append email to Sent folder: {e}")
+        try:
+            recipient = msg.get('To', '')
+            uif_ref = None
+        except Exception:
+            recipient = ''
+            uif_ref = None
+        log_send_error('IMAP Append to Sent', uif_ref, recipient, e)
+
+def _delivery_results(recipient_list, refused, default_code=None, default_response='', default_status='Accepted'):
+    """Turn an smtplib refused-recipients dict into per-recipient (recipient, code, response, status) rows."""
+    results = []
+    refused_lower = {str(k).lower(): v for k, v in (refused or {}).items()}
+    for recipient in recipient_list:
+        entry = refused_lower.get(recipient.lower())
+        if entry:
+            code, response = entry
+            if isinstance(response, bytes):
+                response = response.decode('utf-8', errors='replace')
+            results.append((recipient, code, str(response), 'Refused'))
+        else:
+            results.append((recipient, default_code, default_response, default_status))
+    return results
+
+def _delivery_rows(message_id, uif_reference, results, size_bytes, latency_ms):
+    """Build `email_deliveries` rows plus suppression entries for the hard RCPT refusals among them."""
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    rows = [
+        (message_id, uif_reference, (recipient or '').strip().lower(), code, response, status,
+         size_bytes, round(latency_ms, 1), timestamp)
+        for recipient, code, response, status in results
+    ]
+    # Hard RCPT refusals go straight onto the suppression list
+    suppressions = [
+        (recipient, response, uif_reference, code)
+        for recipient, code, response, status in results
+        if status == 'Refused' and is_hard_bounce(code, response)
+    ]
+    return rows, suppressions
+
+def record_email_deliveries(message_id, uif_reference, results, size_bytes, latency_ms):
+    """Store one `email_deliveries` row per recipient of a transmitted message."""
+    if not results:
+        return
+    rows, suppressions = _delivery_rows(message_id, uif_reference, results, size_bytes, latency_ms)
+    _buffer_rows(deliveries=rows, suppressions=suppressions)
+
+def record_send_outcome(uif_reference, subject, status, result=None, step=None, campaign=None):
+    """Post-send bookkeeping, committed as one unit.
+
+    Queues the email_logs row, the per-recipient delivery rows and the ledger
+    outcome together, and for a successful send the emails_sent increment and
+    last_sent, so the counters can never drift from the logs. Every live
+    attempt also moves next_due_at one cadence forward. All of it lands in the
+    same buffer flush transaction.
+    """
+    now = datetime.now()
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    next_due_at = next_due_after(now_sast()).strftime('%Y-%m-%d %H:%M:%S')
+    delivery = (result or {}).get('delivery')
+    rows = {'logs': [(uif_reference, timestamp, now.strftime('%Y-%m-%d'), subject, status)]}
+    if delivery and delivery['results']:
+        rows['deliveries'], rows['suppressions'] = _delivery_rows(result['message_id'], uif_reference, **delivery)
+    if status == 'Sent':
+        rows['sent_updates'] = [(timestamp, next_due_at, uif_reference)]
+    else:
+        rows['due_updates'] = [(next_due_at, uif_reference)]
+    if step is not None and campaign is not None:
+        rows['ledger_updates'] = [(
+            {'Sent': 'sent', 'Deferred': 'deferred'}.get(status, 'failed'),
+            (result or {}).get('message_id'), timestamp, uif_reference, int(step), campaign
+        )]
+    _buffer_rows(**rows)
+    finish_send_metrics(uif_reference, status, result)
+
+def reconcile_email_counters(exact=False):
+    """Rebuild emails_sent and last_sent from the 'Sent' rows in email_logs (plus archived months) in one set-based UPDATE.
+
+    By default counters only move up: companies emailed before sends were
+    logged keep their higher imported count. `exact=True` makes the logs
+    authoritative. Returns the number of companies changed.
+    """
+    if exact:
+        new_count = "COALESCE(agg.sent, 0)"
+        new_last = "agg.last_sent"
+        source = "companies LEFT JOIN sent_agg agg USING (UIF_REFERENCE)"
+    else:
+        new_count = "MAX(COALESCE(companies.emails_sent, 0), agg.sent)"
+        new_last = "MAX(COALESCE(datetime(companies.last_sent), ''), agg.last_sent)"
+        source = "companies JOIN sent_agg agg USING (UIF_REFERENCE)"
+    with connect() as conn:
+        changes_before = conn.total_changes
+        conn.execute(
+            "WITH sent_rows AS ("
+            "  SELECT UIF_REFERENCE, COUNT(*) AS sent, MAX(datetime(timestamp)) AS last_sent "
+            "  FROM email_logs WHERE status = 'Sent' GROUP BY UIF_REFERENCE"
+            "  UNION ALL SELECT UIF_REFERENCE, sent_count, last_sent FROM archived_sent_counts"
+            "), sent_agg AS ("
+            "  SELECT UIF_REFERENCE, SUM(sent) AS sent, MAX(last_sent) AS last_sent FROM sent_rows GROUP BY UIF_REFERENCE"
+            "), target AS ("
+            f"  SELECT UIF_REFERENCE, {new_count} AS emails_sent, {new_last} AS last_sent FROM {source}"
+            ") "
+            "UPDATE companies SET emails_sent = target.emails_sent, last_sent = target.last_sent "
+            "FROM target WHERE target.UIF_REFERENCE = companies.UIF_REFERENCE "
+            "AND (companies.emails_sent IS NOT target.emails_sent "
+            "OR datetime(companies.last_sent) IS NOT target.last_sent)"
+        )
+        conn.commit()
+        return conn.total_changes - changes_before
+
+# Archived log tables: compatibility view -> (base table, view SQL, id column)
+ARCHIVE_TABLES = {
+    'email_logs': ('email_log_entries', EMAIL_LOG_VIEW_SQL, 'log_id'),
+    'email_error_logs': ('email_error_entries', ERROR_LOG_VIEW_SQL, 'error_id'),
+}
+
+def _parquet_available():
+    return any(importlib.util.find_spec(engine) is not None for engine in ('pyarrow', 'fastparquet'))
+
+def get_retention_settings():
+    stored = get_app_settings()
+    try:
+        months = int(stored.get('log_retention_months', LOG_RETENTION_MONTHS))
+    except (TypeError, ValueError):
+        months = LOG_RETENTION_MONTHS
+    return {'months': max(1, months)}
+
+def _month_bounds(month):
+    """Wall-clock epoch range [start, end) of a 'YYYY-MM' month."""
+    start = pd.Timestamp(f"{month}-01")
+    return _log_epoch(start), _log_epoch(start + pd.offsets.MonthBegin(1))
+
+def archive_closed_months(retention_months=None):
+    """Move log/error rows from months older than the retention window into compressed per-month files.
+
+    Each partition is written to a temp file, renamed into place, then deleted from the
+    database together with its manifest row in one transaction. Rollups and delivery
+    health are left alone, so KPIs still cover the archived periods.
+    """
+    months = max(1, int(retention_months or get_retention_settings()['months']))
+    cutoff = (pd.Timestamp(now_sast()).normalize().replace(day=1) - pd.DateOffset(months=months))
+    fmt = 'parquet' if _parquet_available() else 'csv.gz'
+    summary = {'rows': 0, 'partitions': [], 'format': fmt, 'cutoff': cutoff.strftime('%Y-%m')}
+    flush_log_buffer()
+    with connect() as conn:
+        for view, (base, view_sql, id_column) in ARCHIVE_TABLES.items():
+            closed = [row[0] for row in conn.execute(
+                f"SELECT DISTINCT strftime('%Y-%m', ts, 'unixepoch') FROM {base} WHERE ts < ? ORDER BY 1",
+                (_log_epoch(cutoff),)
+            )]
+            for month in closed:
+                start, end = _month_bounds(month)
+                df = pd.read_sql_query(f"{view_sql} WHERE e.ts >= ? AND e.ts < ? ORDER BY e.{id_column}", conn, params=(start, end))
+                if df.empty:
+                    continue
+                folder = os.path.join(LOG_ARCHIVE_DIR, view, f"month={month}")
+                os.makedirs(folder, exist_ok=True)
+                path = os.path.join(folder, f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{int(df[id_column].min())}.{fmt}")
+                tmp_path = path + '.tmp'
+                if fmt == 'parquet':
+                    df.to_parquet(tmp_path, index=False, compression='gzip')
+                else:
+                    df.to_csv(tmp_path, index=False, compression='gzip')
+                os.replace(tmp_path, path)
+                try:
+                    if view == 'email_logs':
+                        sent = df[df['status'] == 'Sent'].groupby('UIF_REFERENCE')['timestamp'].agg(['count', 'max'])
+                        conn.executemany(
+                            "INSERT INTO archived_sent_counts (UIF_REFERENCE, sent_count, last_sent) VALUES (?, ?, ?) "
+                            "ON CONFLICT(UIF_REFERENCE) DO UPDATE SET sent_count = sent_count + excluded.sent_count, "
+                            "last_sent = MAX(COALESCE(last_sent, ''), excluded.last_sent)",
+                            [(uif, int(row['count']), row['max']) for uif, row in sent.iterrows()]
+                        )
+                    conn.execute(
+                        f"DELETE FROM {base} WHERE ts >= ? AND ts < ? AND {id_column} <= ?",
+                        (start, end, int(df[id_column].max()))
+                    )
+                    conn.execute(
+                        "INSERT INTO log_archives (table_name, month, path, format, row_count, size_bytes, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (view, month, path, fmt, len(df), os.path.getsize(path), datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    os.remove(path)
+                    raise
+                summary['rows'] += len(df)
+                summary['partitions'].append((view, month, len(df)))
+        # Tracebacks are kept in the archived error rows; drop the ones nothing references any more
+        conn.execute(
+            "DELETE FROM error_tracebacks WHERE fingerprint NOT IN "
+            "(SELECT fingerprint FROM email_error_entries WHERE fingerprint IS NOT NULL)"
+        )
+        conn.commit()
+    return summary
+
+def get_log_archives():
+    with connect() as conn:
+        return pd.read_sql_query(
+            "SELECT table_name, month, format, row_count, size_bytes, created_at, path FROM log_archives ORDER BY table_name, month",
+            conn
+        )
+
+@functools.lru_cache(maxsize=64)
+def _read_archive_file(path, fmt):
+    # Partitions are immutable once written, so caching by path is safe
+    if fmt == 'parquet':
+        return pd.read_parquet(path)
+    # keep_default_na=False: subjects such as 'N/A' must stay text
+    return pd.read_csv(path, compression='gzip', dtype={'UIF_REFERENCE': str}, keep_default_na=False)
+
+def read_archived_logs(table_name, start=None, end=None, uif_ref=None):
+    """Rows from archived partitions of email_logs/email_error_logs overlapping [start, end)."""
+    clauses, params = ["table_name = ?"], [table_name]
+    if start is not None:
+        clauses.append("month >= ?")
+        params.append(pd.Timestamp(start).strftime('%Y-%m'))
+    if end is not None:
+        clauses.append("month <= ?")
+        params.append(pd.Timestamp(end).strftime('%Y-%m'))
+    with connect() as conn:
+        parts = conn.execute(
+            f"SELECT path, format FROM log_archives WHERE {' AND '.join(clauses)} ORDER BY month, archive_id", params
+        ).fetchall()
+    frames = []
+    for path, fmt in parts:
+        if not os.path.exists(path):
+            notify('warning', f"Archive partition missing: {path}")
+            continue
+        df = _read_archive_file(path, fmt)
+        stamps = pd.to_datetime(df['timestamp'], errors='coerce')
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= stamps >= pd.Timestamp(start)
+        if end is not None:
+            mask &= stamps < pd.Timestamp(end)
+        if uif_ref:
+            mask &= df['UIF_REFERENCE'].astype(str) == str(uif_ref)
+        frames.append(df[mask])
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def get_maintenance_settings():
+    """Backup/optimize/vacuum intervals in hours (0 disables a task) and backups kept."""
+    stored = get_app_settings()
+
+    def _int(key, default):
+        try:
+            return max(0, int(stored.get(key, default)))
+        except (TypeError, ValueError):
+            return default
+
+    return {
+        'backup_hours': _int('maintenance_backup_hours', MAINTENANCE_BACKUP_HOURS),
+        'optimize_hours': _int('maintenance_optimize_hours', MAINTENANCE_OPTIMIZE_HOURS),
+        'vacuum_hours': _int('maintenance_vacuum_hours', MAINTENANCE_VACUUM_HOURS),
+        'backup_keep': max(1, _int('backup_keep', BACKUP_KEEP)),
+        'last_backup': stored.get('maintenance_last_backup'),
+        'last_optimize': stored.get('maintenance_last_optimize'),
+        'last_vacuum': stored.get('maintenance_last_vacuum'),
+    }
+
+def get_database_stats():
+    """File, WAL and page figures for the status panel; `free_ratio` is the share of pages on the freelist."""
+    with connect() as conn:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    wal_path = f"{DATABASE_FILE}-wal"
+    return {
+        'file_bytes': os.path.getsize(DATABASE_FILE) if os.path.exists(DATABASE_FILE) else 0,
+        'wal_bytes': os.path.getsize(wal_path) if os.path.exists(wal_path) else 0,
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist,
+        'free_bytes': freelist * page_size,
+        'free_ratio': (freelist / page_count) if page_count else 0.0,
+        'auto_vacuum': {0: 'none', 1: 'full', 2: 'incremental'}.get(auto_vacuum, str(auto_vacuum)),
+        'journal_mode': journal_mode,
+    }
+
+def get_table_space():
+    """Per-table/index size and unused bytes inside allocated pages, from the dbstat virtual table.
+
+    Scans every page, so it is only run on request. Returns an empty frame
+    when SQLite was built without dbstat.
+    """
+    try:
+        with connect() as conn:
+            df = pd.read_sql_query(
+                "SELECT name, COUNT(*) AS pages, SUM(pgsize) AS bytes, SUM(unused) AS unused_bytes "
+                "FROM dbstat GROUP BY name ORDER BY bytes DESC", conn
+            )
+    except Exception:
+        return pd.DataFrame()
+    df['unused_pct'] = (df['unused_bytes'] / df['bytes'].where(df['bytes'] > 0) * 100).round(1)
+    return df
+
+class _BackupRestarted(Exception):
+    pass
+
+def backup_database(dest_dir=None, keep=None, pages=BACKUP_PAGES_PER_STEP, pause=BACKUP_STEP_PAUSE_SECONDS, progress=None):
+    """Copy the live database with the SQLite online backup API. Returns a summary dict.
+
+    Pages are copied `pages` at a time with a short pause between steps, so
+    sends and log flushes keep writing while the copy runs. SQLite restarts a
+    stepped copy whenever another connection writes; after
+    BACKUP_MAX_RESTARTS restarts the rest is copied in one step from a single
+    read snapshot. The copy goes to a temp name, is checked with
+    `PRAGMA quick_check` and only then renamed into place; the oldest backups
+    beyond `keep` are removed. `progress(remaining, total)` is called after
+    every step.
+    """
+    dest_dir = dest_dir or BACKUP_DIR
+    keep = keep or get_maintenance_settings()['backup_keep']
+    os.makedirs(dest_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(DATABASE_FILE))[0]
+    path = os.path.join(dest_dir, f"{stem}-{datetime.now():%Y%m%d-%H%M%S}.db")
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(dest_dir, f"{stem}-{datetime.now():%Y%m%d-%H%M%S}-{suffix}.db")
+        suffix += 1
+    tmp_path = f"{path}.tmp"
+    started = time.perf_counter()
+    steps = []
+    restarts = 0
+
+    def _step(status, remaining, total):
+        nonlocal restarts
+        if steps and remaining > steps[-1][0]:
+            restarts += 1
+            if restarts > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        steps.append((remaining, total))
+        if progress:
+            progress(remaining, total)
+        if remaining and pause:
+            time.sleep(pause)
+
+    source = sqlite3.connect(DATABASE_FILE, timeout=DATABASE_BUSY_TIMEOUT_SECONDS)
+    target = sqlite3.connect(tmp_path)
+    try:
+        try:
+            source.backup(target, pages=pages, progress=_step)
+        except _BackupRestarted:
+            source.backup(target)
+        # The copy is a standalone file: keep it in rollback-journal mode so it is one self-contained file
+        target.execute("PRAGMA journal_mode=DELETE")
+        check = target.execute("PRAGMA quick_check").fetchone()[0]
+        page_count = target.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        target.close()
+        source.close()
+    if check != 'ok':
+        os.remove(tmp_path)
+        raise RuntimeError(f"Backup failed its integrity check: {check}")
+    os.replace(tmp_path, path)
+    backups = sorted(
+        (os.path.join(dest_dir, name) for name in os.listdir(dest_dir) if name.startswith(f"{stem}-") and name.endswith('.db')),
+        key=os.path.getmtime
+    )
+    for old_path in backups[:-keep]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    finished = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    save_app_settings({'maintenance_last_backup': finished})
+    return {
+        'path': path,
+        'bytes': os.path.getsize(path),
+        'pages': page_count,
+        'steps': len(steps),
+        'restarts': restarts,
+        'seconds': round(time.perf_counter() - started, 3),
+        'finished': finished,
+    }
+
+def get_backups(dest_dir=None):
+    dest_dir = dest_dir or BACKUP_DIR
+    if not os.path.isdir(dest_dir):
+        return pd.DataFrame(columns=['file', 'size_mb', 'created'])
+    rows = []
+    paths = [os.path.join(dest_dir, name) for name in os.listdir(dest_dir) if name.endswith('.db')]
+    for path in sorted(paths, key=os.path.getmtime, reverse=True):
+        name = os.path.basename(path)
+        rows.append({
+            'file': name,
+            'size_mb': round(os.path.getsize(path) / (1024 * 1024), 2),
+            'created': datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d %H:%M:%S'),
+        })
+    return pd.DataFrame(rows, columns=['file', 'size_mb', 'created'])
+
+def optimize_database(full=False):
+    """Refresh query-planner statistics: `PRAGMA optimize` (only where stale) or a full ANALYZE."""
+    started = time.perf_counter()
+    with connect() as conn:
+        conn.execute("ANALYZE" if full else "PRAGMA optimize")
+        conn.commit()
+    finished = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    save_app_settings({'maintenance_last_optimize': finished})
+    return {'mode': 'analyze' if full else 'optimize', 'seconds': round(time.perf_counter() - started, 3), 'finished': finished}
+
+def incremental_vacuum(pages=INCREMENTAL_VACUUM_PAGES):
+    """Return up to `pages` free pages to the filesystem. Returns a summary dict.
+
+    Needs auto_vacuum=incremental (new databases get it; existing ones need
+    `enable_incremental_vacuum` once). Each pass holds the write lock only
+    for the pages it moves; the WAL is checkpointed so the file shrinks.
+    """
+    started = time.perf_counter()
+    with connect() as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return {'enabled': False, 'freed_pages': 0, 'seconds': 0.0}
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # executescript steps the pragma to completion; execute() would free a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+    finished = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    save_app_settings({'maintenance_last_vacuum': finished})
+    return {'enabled': True, 'freed_pages': before - after, 'seconds': round(time.perf_counter() - started, 3), 'finished': finished}
+
+def enable_incremental_vacuum():
+    """Switch an existing database to auto_vacuum=incremental. Runs a full VACUUM, which blocks writers while it runs."""
+    started = time.perf_counter()
+    with connect() as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    return {'enabled': mode == 2, 'seconds': round(time.perf_counter() - started, 3)}
+
+def _hours_since(timestamp):
+    if not timestamp:
+        return None
+    try:
+        return (datetime.now() - datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')).total_seconds() / 3600
+    except ValueError:
+        return None
+
+def run_maintenance(force=False, tasks=('backup', 'optimize', 'vacuum')):
+    """Run the maintenance tasks that are due (or all of `tasks` with `force`). Returns {task: result}."""
+    settings = get_maintenance_settings()
+    runners = {'backup': backup_database, 'optimize': optimize_database, 'vacuum': incremental_vacuum}
+    results = {}
+    for task in tasks:
+        interval = settings[f"{task}_hours"]
+        elapsed = _hours_since(settings[f"last_{task}"])
+        if not force and (not interval or (elapsed is not None and elapsed < interval)):
+            continue
+        results[task] = runners[task]()
+    return results
+
+def run_maintenance_worker(stop_event, status=None, poll_interval=600):
+    """Run due maintenance tasks in the background until `stop_event` is set."""
+    status = status if status is not None else {}
+    status.update({'running': True, 'last_error': None, 'last_results': {}})
+    while not stop_event.is_set():
+        try:
+            results = run_maintenance()
+            if results:
+                status['last_results'] = results
+            status['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        except Exception as e:
+            status['last_error'] = f"{type(e).__name__}: {e}"
+        stop_event.wait(poll_interval)
+    status['running'] = False
+    return status
+
+def get_email_deliveries(uif_ref=None, message_id=None, recipient=None, limit=500):
+    """Look up delivery records by company, Message-ID or recipient (all indexed)."""
+    clauses = []
+    params = []
+    if uif_ref:
+        clauses.append("UIF_REFERENCE = ?")
+        params.append(uif_ref)
+    if message_id:
+        clauses.append("message_id = ?")
+        params.append(message_id)
+    if recipient:
+        clauses.append("recipient = ?")
+        params.append(recipient.strip().lower())
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    params.append(limit)
+    with connect() as conn:
+        return pd.read_sql_query(
+            f"SELECT * FROM email_deliveries {where} ORDER BY delivery_id DESC LIMIT ?",
+            conn, params=params
+        )
+
+def classify_smtp_error(exc):
+    """Classify a send exception as 'transient' (worth retrying) or 'permanent'.
+
+    4xx replies, greylisting, timeouts and dropped connections are transient;
+    5xx replies and anything unrecognised are permanent.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [detail[0] for detail in (exc.recipients or {}).values() if isinstance(detail, tuple) and detail]
+        return 'transient' if codes and all(400 <= int(code) < 500 for code in codes) else 'permanent'
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 'transient' if 400 <= int(exc.smtp_code) < 500 else 'permanent'
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return 'transient'
+    if isinstance(exc, smtplib.SMTPException):
+        # SMTPException subclasses OSError; anything else from smtplib is a protocol/config problem
+        return 'permanent'
+    if isinstance(exc, (socket.timeout, TimeoutError, ConnectionError, OSError)):
+        return 'transient'
+    return 'permanent'
+
+def is_provider_error(exc):
+    """True when the failure is about the relay itself (connection, auth, throttling), not the recipient."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return False
+    if isinstance(exc, (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError,
+                        smtplib.SMTPServerDisconnected, smtplib.SMTPHeloError, smtplib.SMTPSenderRefused)):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        # 421 service not available, 454 temporary auth failure
+        return int(exc.smtp_code) in (421, 454)
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, OSError)
+
+def new_circuit_breaker(consecutive_failures=CIRCUIT_CONSECUTIVE_FAILURES, error_rate=CIRCUIT_ERROR_RATE,
+                        window_size=CIRCUIT_WINDOW_SIZE, probe_interval=CIRCUIT_PROBE_INTERVAL_SECONDS,
+                        max_pause=CIRCUIT_MAX_PAUSE_SECONDS):
+    """Create circuit breaker state for one sending run (tracked for the metrics exporter)."""
+    breaker = {
+        'state': 'closed',
+        'consecutive': 0,
+        'recent': deque(maxlen=window_size),
+        'consecutive_failures': consecutive_failures,
+        'error_rate': error_rate,
+        'probe_interval': probe_interval,
+        'max_pause': max_pause,
+        'opened_at': None,
+        'trips': 0,
+        'last_error': None,
+    }
+    METRICS['breakers'].append(breaker)
+    return breaker
+
+def circuit_record(breaker, ok, provider_error=False, error=None):
+    """Record a send outcome; trips the breaker on too many provider-level failures. Returns the new state."""
+    failed = (not ok) and provider_error
+    breaker['recent'].append(1 if failed else 0)
+    if failed:
+        breaker['consecutive'] += 1
+        breaker['last_error'] = error
+    elif ok:
+        breaker['consecutive'] = 0
+    window_full = len(breaker['recent']) == breaker['recent'].maxlen
+    rate = sum(breaker['recent']) / len(breaker['recent']) if breaker['recent'] else 0.0
+    if failed and (
+        breaker['state'] == 'half-open'
+        or breaker['consecutive'] >= breaker['consecutive_failures']
+        or (window_full and rate >= breaker['error_rate'])
+    ):
+        breaker['state'] = 'open'
+        breaker['opened_at'] = time.monotonic()
+        breaker['trips'] += 1
+        inc_metric('circuit_trips')
+    elif ok and breaker['state'] == 'half-open':
+        breaker['state'] = 'closed'
+        breaker['recent'].clear()
+    return breaker['state']
+
+def circuit_wait_for_recovery(breaker, smtp_password, on_probe=None, stop_event=None):
+    """Pause while the breaker is open, probing the relay with `test_smtp_connection`.
+
+    Returns True once a probe succeeds (breaker moves to half-open) or False
+    when `max_pause` elapses or `stop_event` is set.
+    """
+    deadline = (breaker['opened_at'] or time.monotonic()) + breaker['max_pause']
+    attempt = 0
+    while time.monotonic() < deadline:
+        wait = min(breaker['probe_interval'], max(0.0, deadline - time.monotonic()))
+        if stop_event is not None:
+            if stop_event.wait(wait):
+                return False
+        else:
+            time.sleep(wait)
+        attempt += 1
+        healthy, message = test_smtp_connection(smtp_password)
+        if on_probe:
+            on_probe(attempt, healthy, message, max(0, int(deadline - time.monotonic())))
+        if healthy:
+            breaker['state'] = 'half-open'
+            breaker['consecutive'] = 0
+            return True
+    return False
+
+def _wait_interval(seconds, stop_event=None):
+    """Sleep between sends; returns True when `stop_event` was set meanwhile, so loops stop promptly."""
+    if stop_event is not None:
+        return stop_event.wait(seconds)
+    time.sleep(seconds)
+    return False
+
+def send_email(recipient_email, subject, body, smtp_password, dry_run=False, uif_reference=None, emails_sent=0):
+    """Send an email; returns True on success. See `send_email_detailed` for the outcome details."""
+    return send_email_detailed(recipient_email, subject, body, smtp_password, dry_run, uif_reference, emails_sent)['ok']
+
+def send_email_detailed(recipient_email, subject, body, smtp_password, dry_run=False, uif_reference=None, emails_sent=0, record=True):
+    """Send an email and return an outcome dict.
+
+    Keys: ok, status ('Sent', 'Dry Run', 'Bounced', 'Deferred' or 'Failed'),
+    message_id, error and error_class ('transient' or 'permanent' on failure),
+    plus the per-recipient `delivery` results. With record=False nothing is
+    written; the caller passes the result to `record_send_outcome`.
+    """
+    # Support one or many recipients; normalize to list for sending, keep header readable
+    if isinstance(recipient_email, (list, tuple, set)):
+        recipient_list = [e for e in list(recipient_email) if e]
+        recipient_header = ", ".join(recipient_list)
+    else:
+        recipient_list = [recipient_email] if recipient_email else []
+        recipient_header = recipient_email
+
+    if dry_run:
+        notify('info', f"DRY RUN: Would send email to {recipient_header} with subject: {subject}")
+        notify('code', body)
+        return {'ok': True, 'status': 'Dry Run', 'message_id': None, 'error': None, 'error_class': None, 'provider_error': False}
+
+    # Header, body and attachment parts (file reads plus base64 encoding happen here)
+    stage_started = time.perf_counter()
+    msg = MIMEMultipart()
+    msg["From"] = SENDER_EMAIL
+    msg["To"] = recipient_header
+    # Do not BCC self; we'll append the message to Sent via IMAP
+    msg["Subject"] = subject
+    msg["Date"] = formatdate(localtime=True)
+    if not msg.get('Message-ID'):
+        # Tag the Message-ID with the UIF reference so replies can be matched via In-Reply-To/References
+        msg['Message-ID'] = make_msgid(idstring=_message_id_token(uif_reference), domain=SENDER_DOMAIN)
+    msg.attach(MIMEText(append_signature(body), "html"))
+    signature_image_path = "Email Signature/asignature1.png"
+    try:
+        with open(signature_image_path, 'rb') as img:
+            mime_img = MIMEImage(img.read(), _subtype="png")
+            mime_img.add_header('Content-ID', '<signature>')
+            msg.attach(mime_img)
+    except Exception as e:
+        notify('warning', f"Signature image not attached: {e}")
+
+    # Attach the PDF
+    pdf_path = "Ditheto Accountants - Appointment Letter and Audit Notification.pdf"
+    try:
+        with open(pdf_path, 'rb') as pdf_file:
+            pdf_attachment = MIMEApplication(pdf_file.read(), _subtype="pdf")
+            pdf_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(pdf_path))
+            msg.attach(pdf_attachment)
+    except Exception as e:
+        notify('warning', f"PDF not attached: {e}")
+
+    # Attach the Letter of demand PDF for 3rd email onwards (emails_sent >= 2)
+    if emails_sent >= 2:
+        demand_letter_path = "Letter of demand _UIF TERS Audit_250729_150955.pdf"
+        try:
+            with open(demand_letter_path, 'rb') as demand_file:
+                demand_attachment = MIMEApplication(demand_file.read(), _subtype="pdf")
+                demand_attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(demand_letter_path))
+                msg.attach(demand_attachment)
+                notify('info', f"Letter of demand attached for email #{emails_sent + 1}")
+        except Exception as e:
+            notify('warning', f"Letter of demand PDF not attached: {e}")
+
+    # Attach company-specific summaries using UIF reference from multiple folders (Phase 4 and Phase 3)
+    if uif_reference and uif_reference != "TEST-UIF-REF":
+        summary_folders = [
+            "PHASE 4 - Employer Claims Summaries",
+            "Phase 3 - Employer Claims Summaries",
+        ]
+        # Clean the UIF reference to match the filename format
+        clean_uif = uif_reference.replace('/', '_').replace('\\', '_')
+        attached_any = False
+        attached_paths = set()
+        for folder in summary_folders:
+            try:
+                if not os.path.isdir(folder):
+                    continue
+                summary_files = [f for f in os.listdir(folder) if clean_uif in f and f.endswith('.xlsx')]
+                for summary_filename in summary_files:
+                    summary_path = os.path.join(folder, summary_filename)
+                    if summary_path in attached_paths:
+                        continue
+                    try:
+                        with open(summary_path, 'rb') as summary_file:
+                            summary_attachment = MIMEApplication(summary_file.read(), _subtype="xlsx")
+                            summary_attachment.add_header(
+                                'Content-Disposition',
+                                'attachment',
+                                filename=summary_filename
+                            )
+                            msg.attach(summary_attachment)
+                            attached_paths.add(summary_path)
+                            attached_any = True
+                    except Exception as e:
+                        notify('error', f"Error attaching summary file '{summary_filename}' for {uif_reference}: {e}")
+            except Exception as e:
+                notify('warning', f"Could not scan folder '{folder}' for summaries: {e}")
+        if not attached_any:
+            notify('warning', f"No summary files found for UIF reference: {uif_reference}")
+    else:
+        notify('info', "Skipping summary attachment for test email")
+
+    record_stage('attachments', stage_started)
+    stage_started = time.perf_counter()
+    raw_message = msg.as_string()
+    record_stage('mime_encode', stage_started)
+    message_id = msg['Message-ID']
+    started = time.monotonic()
+    try:
+        stage_started = time.perf_counter()
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+        with server:
+            server.starttls()
+            record_stage('smtp_connect', stage_started)
+            stage_started = time.perf_counter()
+            server.login(SENDER_EMAIL, smtp_password)
+            record_stage('smtp_auth', stage_started)
+            stage_started = time.perf_counter()
+            # Use sendmail with explicit recipient list for multi-recipient reliability
+            refused = server.sendmail(SENDER_EMAIL, recipient_list, raw_message)
+            record_stage('smtp_data', stage_started)
+        delivery = {
+            'results': _delivery_results(recipient_list, refused, default_code=250, default_response='Accepted', default_status='Accepted'),
+            'size_bytes': len(raw_message),
+            'latency_ms': (time.monotonic() - started) * 1000,
+        }
+        if record:
+            record_email_deliveries(message_id, uif_reference, **delivery)
+        append_email_to_sent_folder(msg, smtp_password)
+        return {'ok': True, 'status': 'Sent', 'message_id': message_id, 'error': None, 'error_class': None, 'provider_error': False, 'delivery': delivery}
+    except smtplib.SMTPRecipientsRefused as e:
+        delivery = {
+            'results': _delivery_results(recipient_list, e.recipients, default_status='Refused'),
+            'size_bytes': len(raw_message),
+            'latency_ms': (time.monotonic() - started) * 1000,
+        }
+        if record:
+            record_email_deliveries(message_id, uif_reference, **delivery)
+        log_send_error('SMTP Send (RecipientsRefused)', uif_reference, recipient_email, e)
+        if classify_smtp_error(e) == 'transient':
+            notify('warning', f"Email to {recipient_email} temporarily refused: {e}")
+            return {'ok': False, 'status': 'Deferred', 'message_id': message_id, 'error': str(e), 'error_class': 'transient', 'provider_error': False, 'delivery': delivery}
+        notify('error', f"Email to {recipient_email} bounced: {e}")
+        if record:
+            log_email(uif_reference, subject, "Bounced")
+        return {'ok': False, 'status': 'Bounced', 'message_id': message_id, 'error': str(e), 'error_class': 'permanent', 'provider_error': False, 'delivery': delivery}
+    except Exception as e:
+        delivery = {
+            'results': _delivery_results(
+                recipient_list, {},
+                default_code=getattr(e, 'smtp_code', None),
+                default_response=str(e),
+                default_status='Failed'
+            ),
+            'size_bytes': len(raw_message),
+            'latency_ms': (time.monotonic() - started) * 1000,
+        }
+        if record:
+            record_email_deliveries(message_id, uif_reference, **delivery)
+        error_class = classify_smtp_error(e)
+        provider_error = is_provider_error(e)
+        log_send_error('SMTP Send', uif_reference, recipient_email, e)
+        # Relay-level problems are not the recipient's fault, so they are always worth retrying
+        if error_class == 'transient' or provider_error:
+            notify('warning', f"Temporary error sending email to {recipient_email}: {e}")
+            return {'ok': False, 'status': 'Deferred', 'message_id': message_id, 'error': str(e), 'error_class': 'transient', 'provider_error': provider_error, 'delivery': delivery}
+        notify('error', f"Error sending email to {recipient_email}: {e}")
+        return {'ok': False, 'status': 'Failed', 'message_id': message_id, 'error': str(e), 'error_class': error_class, 'provider_error': provider_error, 'delivery': delivery}
+
+def send_test_email(smtp_password, dry_run=False):
+    # Use the first company as an example for the test email
+    uif_reference = "TEST-UIF-REF"
+    trade_name = "Test Company"
+    emails_sent = 0  # Use initial email template
+    
+    subject, body = get_email_template(uif_reference, trade_name, emails_sent)
+    body = append_signature(body)
+    
+    return send_email("nicknungu@gmail.com", subject, body, smtp_password, dry_run, uif_reference, emails_sent)
+
+def test_smtp_connection(smtp_password):
+    try:
+        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
+            server.starttls()
+            server.login(SENDER_EMAIL, smtp_password)
+        return True, "SMTP connection successful!"
+    except Exception as e:
+        return False, f"SMTP connection failed: {e}"
+
+def get_template_row(template_key):
+    """(subject, body) saved for a template key; empty strings when none is saved."""
+    with connect() as conn:
+        row = conn.execute("SELECT subject, body FROM email_templates WHERE template_key = ?", (template_key,)).fetchone()
+    return (row[0] or '', row[1] or '') if row else ('', '')
+
+def save_template_row(template_key, subject, body):
+    with connect() as conn:
+        conn.execute(
+            "INSERT INTO email_templates (template_key, subject, body) VALUES (?, ?, ?) "
+            "ON CONFLICT(template_key) DO UPDATE SET subject=excluded.subject, body=excluded.body",
+            (template_key, subject, body)
+        )
+        conn.commit()
+
+@timed_stage('template')
+def get_email_template(uif_reference, trade_name, emails_sent):
+    # Determine template key
+    if emails_sent == 0:
+        template_key = 'initial'
+    elif 1 <= emails_sent < 10:
+        template_key = 'followup'
+    else:
+        template_key = 'final'
+
+    try:
+        subject, body = get_template_row(template_key)
+    except Exception:
+        subject = None
+        body = None
+
+    # Fallback to built-in defaults if DB missing
+    if not subject or not body:
+        if template_key == 'initial':
+            subject = "Initial Request for Documentation – UIF TERS Compliance Audit"
+            body = (
+                """
+                <!DOCTYPE html>
+                <html>
+                  <head>
+                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                  </head>
+                  <body>
+                    <p>Good day,</p>
+                    <p>I trust this email finds you well.</p>
+                    <p>My name is Gamu, and I am an Auditor at Ditheto Accountants. We are conducting a compliance review on behalf of the Unemployment Insurance Fund (UIF), regarding the COVID-19 TERS funds disbursed to <strong>{TRADE_NAME}</strong> with UIF Ref Number: <strong>{UIF_REFERENCE}</strong>.</p>
+                    <p>The following documents are required to complete the audit:</p>
+                    <ul>
+                      <li>Bank statements showing receipt of the TERS funds</li>
+                      <li>Proof of payments made to employees</li>
+                      <li>Payroll records or payslips for January to December 2020</li>
+                      <li>2021 IRP5 certificates</li>
+                      <li>EMP501s/201s for the 2020/2021 financial year</li>
+                    </ul>
+                    <p>We fully understand that administrative delays can occur. However, these documents are essential to finalising the audit in line with UIF compliance procedures. Without them, the file remains incomplete and may be subject to further administrative steps.</p>
+                    <p>Kindly forward the requested documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> at your earliest convenience.</p>
+                    <p>Your cooperation in resolving this matter is greatly appreciated.</p>
+                    <p>Kind regards,<br>
+                      <strong>Gamu Dambanjera</strong></p>
+                    <div class="moz-signature"> <img src='cid:signature'></div>
+                  </body>
+                </html>
+                """
+            )
+        elif template_key == 'followup':
+            subject = "Follow-up: Urgent Action Required – UIF TERS Compliance Audit"
+            body = (
+                """
+                <!DOCTYPE html>
+                <html>
+                  <head>
+                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                  </head>
+                  <body>
+                    <p>Dear {TRADE_NAME},</p>
+                    <p>This is a reminder that the requested documentation for the COVID-19 TERS audit is still outstanding. This is an urgent matter that requires your immediate attention.</p>
+                    <p>Failure to provide the necessary documents may result in non-compliance with UIF regulations, which could lead to further administrative actions.</p>
+                    <p>Please submit the required documents to <strong><a href="mailto:gamu@dithetoaccountants.co.za">gamu@dithetoaccountants.co.za</a></strong> without delay.</p>
+                    <p>Kind regards,<br>
+                      <strong>Gamu Dambanjera</strong></p>
+                    <div class="moz-signature"> <img src='cid:signature'></div>
+                  </body>
+                </html>
+                """
+            )
+        else:
+            subject = "Final Notice: Non-Compliance with UIF TERS Audit Requirements"
+            body = (
+                """
+                <!DOCTYPE html>
+                <html>
+                  <head>
+                    <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+                  </head>
+                  <body>
+                    <p>Good day,</p>
+                    <p>This serves as a final notice regarding your non-compliance with the UIF TERS audit requirements and the Memorandum of Agreement (MOA) signed during your TERS application.</p>
+                    <p>Despite multiple attempts to obtain the required documentation, including:</p>
+                    <ol>
+                      <li>Initial audit notification</li>
+                      <li>Detailed information request</li>
+                      <li>Follow-up communication</li>
+                    </ol>
+                    <p>You have failed to cooperate with the audit process, which constitutes a breach of the MOA, specifically:</p>
+                    <ul>
+                      <li><strong>Section 17.2:</strong> Obligation to make all accounting records accessible to UIF-authorized persons</li>
+                      <li><strong>Section 18:</strong> Requirement to maintain a proper audit trail of funds received and benefits paid to employees</li>
+                    </ul>
+                    <h3>NOTICE OF ESCALATION</h3>
+                    <p>Be advised that failure to respond to this final notice within 24 hours will result in:</p>
+                    <ol>
+                      <li>Immediate referral of this matter to the Directorate for Priority Crime Investigation (HAWKS) or Special Investigation Unit (SIU) for investigation of potential fraud</li>
+                      <li>Mandatory repayment of all TERS funds within 10 working days of referral</li>
+                      <li>Potential criminal charges for non-compliance and fraud</li>
+                    </ol>
+                    <h3>REQUIRED IMMEDIATE ACTION</h3>
+                    <p>To prevent escalation to law enforcement, provide ALL previously requested documentation within 24 hours of this notice to everyone copied on this email.</p>
+                    <p>Please note that this is your final opportunity to comply with the audit requirements before legal action is initiated.</p>
+                    <p>Kind regards,<br>
+                      <strong>Gamu Dambanjera</strong></p>
+                    <div class="moz-signature"> <img src='cid:signature'></div>
+                  </body>
+                </html>
+                """
+            )
+
+    # Replace placeholders
+    placeholder_values = {
+        'UIF_REFERENCE': uif_reference,
+        'TRADE_NAME': trade_name,
+    }
+    def replace_placeholders(text):
+        try:
+            for k, v in placeholder_values.items():
+                text = text.replace('{' + k + '}', str(v))
+            return text
+        except Exception:
+            return text
+
+    subject_final = replace_placeholders(subject)
+    body_final = replace_placeholders(body)
+    return subject_final, body_final
+
+def get_daily_email_count(date=None):
+    with connect() as conn:
+        if date is None:
+            date = datetime.now().strftime('%Y-%m-%d')
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM email_log_daily WHERE date = ? AND status = 'Sent'", (date,))
+        return cursor.fetchone()[0]
+
+def get_email_stats(start_date=None, end_date=None):
+    """KPI numbers from the daily rollup. The breakdown covers start_date..end_date (default: last 7 days)."""
+    today = datetime.now().strftime('%Y-%m-%d')
+    end_date = str(end_date or today)
+    start_date = str(start_date or (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d'))
+    with connect() as conn:
+        cursor = conn.cursor()
+        # Get today's count
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM email_log_daily WHERE date = ? AND status = 'Sent'", (today,))
+        today_count = cursor.fetchone()[0]
+
+        # Get total count
+        cursor.execute("SELECT COALESCE(SUM(count), 0) FROM email_log_daily WHERE status = 'Sent'")
+        total_count = cursor.fetchone()[0]
+
+        # Get daily breakdown for the requested range
+        cursor.execute("""
+            SELECT date, count
+            FROM email_log_daily
+            WHERE status = 'Sent' AND date BETWEEN ? AND ?
+            ORDER BY date DESC
+        """, (start_date, end_date))
+        daily_breakdown = cursor.fetchall()
+
+        return {
+            'today_count': today_count,
+            'total_count': total_count,
+            'daily_breakdown': daily_breakdown
+        }
+
+def get_daily_status_counts(start_date, end_date, statuses=None):
+    """Per-day counts by status from the rollup, as a long DataFrame (date, status, count)."""
+    params = [str(start_date), str(end_date)]
+    status_clause = ""
+    if statuses:
+        status_clause = f" AND status IN ({', '.join('?' for _ in statuses)})"
+        params.extend(statuses)
+    with connect() as conn:
+        return pd.read_sql_query(
+            f"SELECT date, status, count FROM email_log_daily WHERE date BETWEEN ? AND ?{status_clause} ORDER BY date",
+            conn, params=params
+        )
+
+def get_company_summary():
+    """Company counts by state from the trigger-maintained summary row."""
+    with connect() as conn:
+        row = conn.execute("SELECT total, completed, paused, active FROM company_state_summary WHERE id = 1").fetchone()
+    total, completed, paused, active = row or (0, 0, 0, 0)
+    return {'total': total, 'completed': completed, 'paused': paused, 'active': active}
+
+def get_send_stage_latency(start_date, end_date):
+    """p50/p95/p99 and mean latency (ms) per send stage for messages timed in the date range."""
+    columns = [f"{stage}_ms" for stage in SEND_METRIC_STAGES] + ['total_ms']
+    with connect() as conn:
+        metrics = pd.read_sql_query(
+            f"SELECT {', '.join(columns)} FROM send_metrics WHERE ts >= ? AND ts < ?",
+            conn, params=(_log_epoch(start_date), _log_epoch(end_date + timedelta(days=1)))
+        )
+    if metrics.empty:
+        return pd.DataFrame(columns=['stage', 'messages', 'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms'])
+    rows = []
+    for stage, column in zip(list(SEND_METRIC_STAGES) + ['total'], columns):
+        values = metrics[column].dropna()
+        if values.empty:
+            continue
+        quantiles = values.quantile([0.5, 0.95, 0.99])
+        rows.append({
+            'stage': stage, 'messages': len(values),
+            'p50_ms': quantiles[0.5], 'p95_ms': quantiles[0.95], 'p99_ms': quantiles[0.99], 'mean_ms': values.mean()
+        })
+    return pd.DataFrame(rows).round(1)
+
+def get_send_throughput(start_date, end_date, bucket_seconds=3600):
+    """Timed messages, bytes and median total send time per time bucket (hourly by default)."""
+    with connect() as conn:
+        throughput = pd.read_sql_query(
+            "SELECT (ts / ?) * ? AS bucket, COUNT(*) AS messages, COALESCE(SUM(size_bytes), 0) AS bytes, "
+            "AVG(total_ms) AS avg_total_ms FROM send_metrics WHERE ts >= ? AND ts < ? GROUP BY bucket ORDER BY bucket",
+            conn, params=(bucket_seconds, bucket_seconds, _log_epoch(start_date), _log_epoch(end_date + timedelta(days=1)))
+        )
+    throughput['bucket'] = pd.to_datetime(throughput['bucket'], unit='s')
+    return throughput
+
+def _metric_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + ','.join(escaped) + '}'
+
+def render_metrics(openmetrics=False):
+    """Sender and queue health in the Prometheus text format, or OpenMetrics when `openmetrics` is set.
+
+    Logged outcomes and queue depths are read from the database on every
+    call; per-message counters, stage histograms and circuit state come from
+    this process's in-memory registry.
+    """
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        # OpenMetrics names the counter family without _total; the older text format names the sample
+        family_name = f"email_automator_{name}" + ('_total' if kind == 'counter' and not openmetrics else '')
+        lines.append(f"# HELP {family_name} {help_text}")
+        lines.append(f"# TYPE {family_name} {kind}")
+        for suffix, labels, value in samples:
+            lines.append(f"email_automator_{name}{suffix}{_metric_labels(labels)} {value}")
+
+    try:
+        with connect() as conn:
+            logged = conn.execute("SELECT status, SUM(count) FROM email_log_daily GROUP BY status ORDER BY status").fetchall()
+            retry_depth = conn.execute("SELECT COUNT(*) FROM email_retry_queue WHERE status = 'pending'").fetchone()[0]
+            campaign_depth = conn.execute("SELECT COUNT(*) FROM campaign_items WHERE status = 'pending'").fetchone()[0]
+        due_depth = count_due_companies()
+        db_up = 1
+    except Exception:
+        logged, retry_depth, campaign_depth, due_depth, db_up = [], None, None, None, 0
+    db_size = sum(os.path.getsize(path) for path in (DATABASE_FILE, f"{DATABASE_FILE}-wal") if os.path.exists(path))
+
+    family('db_up', 'gauge', "1 if the database could be read for this scrape.", [('', (), db_up)])
+    family('logged_emails', 'counter', "Email log entries by status (the statuses log_email writes).",
+           [('_total', (('status', status),), total) for status, total in logged])
+    with METRICS['lock']:
+        counters = dict(METRICS['counters'])
+        histograms = {stage: dict(histogram, buckets=list(histogram['buckets'])) for stage, histogram in METRICS['histograms'].items()}
+    family('messages', 'counter', "Messages attempted by this process, by outcome.",
+           [('_total', labels, value) for (name, labels), value in sorted(counters.items()) if name == 'messages'])
+    family('message_bytes', 'counter', "Bytes of message data handed to SMTP by this process.",
+           [('_total', (), counters.get(('message_bytes', ()), 0))])
+    family('circuit_trips', 'counter', "Times a circuit breaker in this process opened.",
+           [('_total', (), counters.get(('circuit_trips', ()), 0))])
+    samples = []
+    for stage in list(SEND_METRIC_STAGES) + ['total']:
+        histogram = histograms.get(stage)
+        if not histogram:
+            continue
+        for bound, count in zip(METRICS_LATENCY_BUCKETS, histogram['buckets']):
+            samples.append(('_bucket', (('stage', stage), ('le', str(bound))), count))
+        samples.append(('_bucket', (('stage', stage), ('le', '+Inf')), histogram['count']))
+        samples.append(('_sum', (('stage', stage),), round(histogram['sum'], 6)))
+        samples.append(('_count', (('stage', stage),), histogram['count']))
+    family('send_stage_seconds', 'histogram', "Per-message send-path latency by stage.", samples)
+
+    queue_depths = [('', (('queue', queue),), depth) for queue, depth in
+                    (('retry', retry_depth), ('campaign', campaign_depth), ('due', due_depth)) if depth is not None]
+    family('queue_depth', 'gauge', "Pending retries, campaign items and companies due now.", queue_depths)
+    family('log_buffer_rows', 'gauge', "Rows waiting in the write-behind log buffer.",
+           [('', (), LOG_BUFFER['rows'])])
+    family('log_buffer_dead_letters', 'counter', "Buffered row groups rejected by the database and set aside since start.",
+           [('_total', (), LOG_BUFFER['dead_letters'])])
+    family('db_size_bytes', 'gauge', "Size of the SQLite database including its WAL.", [('', (), db_size)])
+    family('send_interval_seconds', 'gauge', "Configured pause between sends.", [('', (), SEND_INTERVAL_SECONDS)])
+    family('send_window_open', 'gauge', "1 while the scheduled send window is open.", [('', (), int(is_within_send_window()) if db_up else 0)])
+    family('circuit_open', 'gauge', "Sending runs in this process whose circuit breaker is open.",
+           [('', (), sum(1 for breaker in list(METRICS['breakers']) if breaker['state'] == 'open'))])
+    if METRICS['last_send'] is not None:
+        family('last_send_timestamp_seconds', 'gauge', "Unix time of the last message attempted by this process.",
+               [('', (), round(METRICS['last_send'], 3))])
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get('Accept', '')
+        body = render_metrics(openmetrics).encode('utf-8')
+        self.send_response(200)
+        self.send_header(
+            'Content-Type',
+            'application/openmetrics-text; version=1.0.0; charset=utf-8' if openmetrics else 'text/plain; version=0.0.4; charset=utf-8'
+        )
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def write_metrics_file(path):
+    """Atomically rewrite `path` with the current metrics (Prometheus text format, for textfile collectors)."""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as handle:
+        handle.write(render_metrics())
+    os.replace(temp_path, path)
+
+def run_metrics_file_writer(path, status, interval=METRICS_FILE_INTERVAL_SECONDS, stop_event=None):
+    """Rewrite the metrics file every `interval` seconds until `stop_event` is set."""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            write_metrics_file(path)
+            status['file_error'] = None
+        except Exception as e:
+            status['file_error'] = f"{type(e).__name__}: {e}"
+        stop_event.wait(interval)
+
+_METRICS_EXPORTER = {}
+_METRICS_EXPORTER_LOCK = threading.Lock()
+
+def start_metrics_exporter():
+    """Start the metrics endpoint and file writer once per process. Returns the (shared) status dict."""
+    with _METRICS_EXPORTER_LOCK:
+        if _METRICS_EXPORTER:
+            return _METRICS_EXPORTER
+        _METRICS_EXPORTER.update({'url': None, 'file': METRICS_FILE, 'error': None, 'file_error': None})
+    status = _METRICS_EXPORTER
+    if METRICS_PORT:
+        try:
+            server = http.server.ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), _MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True, name="metrics-exporter").start()
+            status['url'] = f"http://{METRICS_HOST}:{server.server_address[1]}/metrics"
+        except OSError as e:
+            status['error'] = f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}"
+    if METRICS_FILE:
+        threading.Thread(target=run_metrics_file_writer, args=(METRICS_FILE, status), daemon=True, name="metrics-file-writer").start()
+    return status
+
+def _sample_stacks(thread_id, stop_event, counts, interval=PROFILE_SAMPLE_INTERVAL_SECONDS):
+    """Sample the target thread's Python stack until stopped, counting collapsed (root;...;leaf) stacks."""
+    while not stop_event.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+
+def start_profile(label, mode='deterministic'):
+    """Start profiling the current thread. Returns the capture to pass to `stop_profile`.
+
+    Both modes sample the stack for the collapsed-stack file; 'deterministic'
+    also runs cProfile for exact call counts and a pstats file.
+    """
+    capture = {
+        'label': label, 'mode': mode, 'started_at': datetime.now(), 'started': time.perf_counter(),
+        'counts': {}, 'stop': threading.Event(), 'profiler': None,
+    }
+    capture['sampler'] = threading.Thread(
+        target=_sample_stacks, args=(threading.get_ident(), capture['stop'], capture['counts']),
+        daemon=True, name="profile-sampler"
+    )
+    capture['sampler'].start()
+    if mode == 'deterministic':
+        capture['profiler'] = cProfile.Profile()
+        capture['profiler'].enable()
+    return capture
+
+def stop_profile(capture, label=None):
+    """Stop a capture and save it under PROFILE_DIR (.collapsed, .pstats for cProfile runs, .json summary).
+
+    Returns the summary dict; only the newest PROFILE_KEEP captures are kept.
+    """
+    if capture['profiler'] is not None:
+        capture['profiler'].disable()
+    capture['stop'].set()
+    capture['sampler'].join(timeout=1)
+    label = label or capture['label']
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stem = f"{capture['started_at']:%Y%m%d-%H%M%S}-{re.sub(r'[^A-Za-z0-9_.-]+', '_', label)}"
+    base = os.path.join(PROFILE_DIR, stem)
+    counts = dict(capture['counts'])
+    with open(f"{base}.collapsed", 'w', encoding='utf-8') as handle:
+        for stack, count in sorted(counts.items()):
+            handle.write(f"{stack} {count}\n")
+    total_samples = sum(counts.values())
+    if capture['profiler'] is not None:
+        capture['profiler'].dump_stats(f"{base}.pstats")
+        stats = pstats.Stats(capture['profiler'], stream=io.StringIO())
+        ranked = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP_N]
+        top = [{
+            'function': name if filename == '~' else f"{name} ({os.path.basename(filename)}:{line})",
+            'calls': calls, 'self_ms': round(self_time * 1000, 1), 'cumulative_ms': round(cumulative * 1000, 1)
+        } for (filename, line, name), (_, calls, self_time, cumulative, _) in ranked]
+    else:
+        self_samples = {}
+        for stack, count in counts.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            self_samples[leaf] = self_samples.get(leaf, 0) + count
+        top = [{
+            'function': function, 'samples': count, 'self_pct': round(100 * count / total_samples, 1)
+        } for function, count in sorted(self_samples.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP_N]]
+    summary = {
+        'label': label, 'mode': capture['mode'], 'started_at': capture['started_at'].strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_ms': round((time.perf_counter() - capture['started']) * 1000, 1), 'samples': total_samples,
+        'files': [f"{base}.{ext}" for ext in ('pstats', 'collapsed') if os.path.exists(f"{base}.{ext}")],
+        'top': top,
+    }
+    with open(f"{base}.json", 'w', encoding='utf-8') as handle:
+        json.dump(summary, handle, indent=2)
+    for old in get_profile_captures(limit=None)[PROFILE_KEEP:]:
+        for path in old['files'] + [old['summary_file']]:
+            if os.path.exists(path):
+                os.remove(path)
+    return summary
+
+def _read_file_bytes(path):
+    with open(path, 'rb') as handle:
+        return handle.read()
+
+def get_profile_captures(limit=10):
+    """Saved capture summaries, newest first."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    captures = []
+    for name in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(PROFILE_DIR, name)
+        try:
+            with open(path, encoding='utf-8') as handle:
+                summary = json.load(handle)
+        except (OSError, ValueError):
+            continue
+        summary['summary_file'] = path
+        captures.append(summary)
+        if limit and len(captures) >= limit:
+            break
+    return captures
+
+def claim_send(uif_reference, step, campaign='', single_step=False):
+    """Atomically claim (company, step, campaign) before transmitting. Returns False if it is already in flight or sent.
+
+    Failed and deferred claims can be re-claimed: nothing was delivered for them.
+    With `single_step` the claim also fails while any other step for the
+    company is in flight or sent under the same campaign key, so a rerun that
+    re-reads the already incremented emails_sent cannot escalate the company.
+    """
+    guard = ""
+    params = [uif_reference, int(step), campaign or '', datetime.now().strftime('%Y-%m-%d %H:%M:%S')]
+    if single_step:
+        guard = (
+            " AND NOT EXISTS (SELECT 1 FROM send_ledger WHERE UIF_REFERENCE = ? AND campaign = ? AND step != ? "
+            "AND status IN ('in_flight', 'sent'))"
+        )
+        params += [uif_reference, campaign or '', int(step)]
+    with connect() as conn:
+        cursor = conn.execute(
+            "INSERT INTO send_ledger (UIF_REFERENCE, step, campaign, status, claimed_at) SELECT ?, ?, ?, 'in_flight', ? WHERE 1" + guard + " "
+            "ON CONFLICT(UIF_REFERENCE, step, campaign) DO UPDATE SET status = 'in_flight', claimed_at = excluded.claimed_at, finished_at = NULL "
+            "WHERE send_ledger.status IN ('failed', 'deferred')",
+            params
+        )
+        conn.commit()
+        return cursor.rowcount == 1
+
+def manual_batch_key(moment=None):
+    """Ledger key for hand-picked sends: a company gets at most one step per day from the Send Emails page."""
+    return f"manual:{(moment or datetime.now()):%Y-%m-%d}"
+
+def get_stale_claims(older_than_minutes=30):
+    """Claims stuck in flight, e.g. after a crash mid-transmit. Their delivery state is unknown."""
+    cutoff = (datetime.now() - timedelta(minutes=older_than_minutes)).strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        return pd.read_sql_query(
+            "SELECT * FROM send_ledger WHERE status = 'in_flight' AND claimed_at < ? ORDER BY claimed_at",
+            conn, params=(cutoff,)
+        )
+
+def release_stale_claims(ledger_ids):
+    """Mark stuck claims failed so they can be sent again (after checking the Sent folder)."""
+    with connect() as conn:
+        conn.executemany(
+            "UPDATE send_ledger SET status = 'failed', finished_at = ? WHERE ledger_id = ? AND status = 'in_flight'",
+            [(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), int(ledger_id)) for ledger_id in ledger_ids]
+        )
+        conn.commit()
+
+def new_lease_holder(kind='batch'):
+    """A unique lease holder id for one session, campaign runner or worker, e.g. 'ui:host:1234:9f3a1c2b'."""
+    return f"{kind}:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def acquire_company_leases(uif_refs, holder, label='', ttl=LEASE_TTL_SECONDS):
+    """Lease companies to `holder` in one transaction. Returns the set actually acquired.
+
+    A company is taken if it is unleased, its lease has expired or `holder`
+    already holds it; companies another holder leases are left out.
+    """
+    refs = list(dict.fromkeys(r for r in uif_refs if r))
+    if not refs:
+        return set()
+    now = time.time()
+    acquired = set()
+    with connect() as conn:
+        # Take the write lock up front so two sessions cannot interleave their bulk claims
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO company_leases (UIF_REFERENCE, holder, label, acquired_at, heartbeat_at, expires_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(UIF_REFERENCE) DO UPDATE SET holder = excluded.holder, label = excluded.label, "
+                "acquired_at = excluded.acquired_at, heartbeat_at = excluded.heartbeat_at, expires_at = excluded.expires_at "
+                "WHERE company_leases.expires_at < excluded.acquired_at OR company_leases.holder = excluded.holder",
+                [(uif_reference, holder, label, now, now, now + ttl) for uif_reference in refs]
+            )
+            for start in range(0, len(refs), 500):
+                chunk = refs[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                acquired.update(row[0] for row in conn.execute(
+                    f"SELECT UIF_REFERENCE FROM company_leases WHERE holder = ? AND UIF_REFERENCE IN ({placeholders})",
+                    [holder] + chunk
+                ))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return acquired
+
+def renew_company_leases(holder, ttl=LEASE_TTL_SECONDS):
+    """Heartbeat: push back the expiry of every lease `holder` still holds. Returns how many were renewed."""
+    now = time.time()
+    with connect() as conn:
+        cursor = conn.execute(
+            "UPDATE company_leases SET heartbeat_at = ?, expires_at = ? WHERE holder = ?", (now, now + ttl, holder)
+        )
+        conn.commit()
+        return cursor.rowcount
+
+def release_company_leases(holder, uif_refs=None):
+    """Drop `holder`'s leases (all of them, or just `uif_refs`)."""
+    with connect() as conn:
+        if uif_refs is None:
+            conn.execute("DELETE FROM company_leases WHERE holder = ?", (holder,))
+        else:
+            conn.executemany(
+                "DELETE FROM company_leases WHERE holder = ? AND UIF_REFERENCE = ?",
+                [(holder, uif_reference) for uif_reference in uif_refs]
+            )
+        conn.commit()
+
+def get_company_leases(exclude_holder=None):
+    """Unexpired leases as {UIF_REFERENCE: {'holder', 'label', 'acquired_at', 'expires_at'}}, optionally without `exclude_holder`'s own."""
+    with connect() as conn:
+        rows = conn.execute(
+            "SELECT UIF_REFERENCE, holder, label, acquired_at, expires_at FROM company_leases WHERE expires_at >= ? AND holder != ?",
+            (time.time(), exclude_holder or '')
+        ).fetchall()
+    return {
+        uif: {'holder': holder, 'label': label, 'acquired_at': acquired_at, 'expires_at': expires_at}
+        for uif, holder, label, acquired_at, expires_at in rows
+    }
+
+@contextlib.contextmanager
+def company_leases(uif_refs, holder=None, label='', ttl=LEASE_TTL_SECONDS):
+    """Hold leases on `uif_refs` for the duration of a batch; yields the set acquired.
+
+    A background heartbeat renews them every LEASE_HEARTBEAT_SECONDS, so long
+    batches keep them while a crashed holder's leases lapse after `ttl`. On
+    exit the write-behind buffer is flushed before the leases are released, so
+    the next holder reads up-to-date emails_sent counts.
+    """
+    holder = holder or new_lease_holder()
+    acquired = acquire_company_leases(uif_refs, holder, label, ttl)
+    stop = threading.Event()
+
+    def _heartbeat():
+        while not stop.wait(LEASE_HEARTBEAT_SECONDS):
+            try:
+                renew_company_leases(holder, ttl)
+            except Exception as e:
+                logger.warning("Lease heartbeat for %s failed: %s", holder, e)
+
+    heartbeat = threading.Thread(target=_heartbeat, name=f"lease-heartbeat-{holder}", daemon=True) if acquired else None
+    if heartbeat:
+        heartbeat.start()
+    try:
+        yield acquired
+    finally:
+        stop.set()
+        if acquired:
+            flush_log_buffer()
+            release_company_leases(holder, acquired)
+
+def _retry_delay_seconds(attempts):
+    """Jittered exponential backoff: a random delay between half and all of base * 2^(attempts-1), capped."""
+    ceiling = min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * (2 ** max(0, attempts - 1)))
+    return random.uniform(ceiling / 2, ceiling)
+
+def schedule_retry(uif_reference, step, recipients, error, attempts=1, campaign=''):
+    """Queue a transiently failed send for a later attempt. Returns the scheduled time, or None once attempts are exhausted."""
+    now = datetime.now()
+    if attempts >= RETRY_MAX_ATTEMPTS:
+        return None
+    next_attempt = now + timedelta(seconds=_retry_delay_seconds(attempts))
+    with connect() as conn:
+        conn.execute(
+            "INSERT INTO email_retry_queue (UIF_REFERENCE, step, recipients, attempts, next_attempt_at, last_error, status, created_at, updated_at, campaign) "
+            "VALUES (?, ?, ?, ?, ?, ?, 'pending', ?, ?, ?) "
+            "ON CONFLICT(UIF_REFERENCE, step) WHERE status = 'pending' DO UPDATE SET "
+            "recipients = excluded.recipients, attempts = excluded.attempts, next_attempt_at = excluded.next_attempt_at, "
+            "last_error = excluded.last_error, updated_at = excluded.updated_at, campaign = excluded.campaign",
+            (
+                uif_reference, int(step), ", ".join(recipients), attempts,
+                next_attempt.strftime('%Y-%m-%d %H:%M:%S'), str(error)[:500],
+                now.strftime('%Y-%m-%d %H:%M:%S'), now.strftime('%Y-%m-%d %H:%M:%S'), campaign or ''
+            )
+        )
+        conn.commit()
+    return next_attempt
+
+def get_retry_queue(status='pending', limit=200):
+    with connect() as conn:
+        return pd.read_sql_query(
+            "SELECT * FROM email_retry_queue WHERE status = ? ORDER BY next_attempt_at LIMIT ?",
+            conn, params=(status, limit)
+        )
+
+def _finish_retry(retry_id, status, error=None):
+    with connect() as conn:
+        conn.execute(
+            "UPDATE email_retry_queue SET status = ?, last_error = COALESCE(?, last_error), updated_at = ? WHERE retry_id = ?",
+            (status, error, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), retry_id)
+        )
+        conn.commit()
+
+def process_due_retries(smtp_password, limit=50, interval=SEND_INTERVAL_SECONDS, stop_event=None, breaker=None):
+    """Send queued retries whose backoff has elapsed. Returns a summary dict.
+
+    Runs independently of the main batch loop: each retry re-checks company
+    state and suppression, re-renders the template for the stored step and
+    either finishes, reschedules with a longer backoff or gives up. Stops early,
+    leaving the rest due, when the circuit breaker trips; retries for companies
+    another session holds a lease on also stay due.
+    """
+    summary = {'sent': 0, 'rescheduled': 0, 'failed': 0, 'cancelled': 0, 'in_flight': 0, 'circuit_open': False}
+    breaker = breaker or new_circuit_breaker()
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        due = conn.execute(
+            "SELECT r.retry_id, r.UIF_REFERENCE, r.step, r.attempts, r.campaign, c.TRADE_NAME "
+            "FROM email_retry_queue r LEFT JOIN companies c ON c.UIF_REFERENCE = r.UIF_REFERENCE "
+            "WHERE r.status = 'pending' AND r.next_attempt_at <= ? ORDER BY r.next_attempt_at LIMIT ?",
+            (now, limit)
+        ).fetchall()
+    if not due:
+        return summary
+    refs = [row[1] for row in due]
+    with company_leases(refs, new_lease_holder('retries'), label="Retry queue") as leased:
+        states = get_company_states(refs)
+        resolved = resolve_company_recipients(refs)
+        sent_any = False
+        for retry_id, uif_reference, step, attempts, campaign, trade_name in due:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if breaker['state'] == 'open':
+                summary['circuit_open'] = True
+                break
+            if uif_reference not in leased:
+                summary['in_flight'] += 1  # stays due; picked up once the other session lets go
+                continue
+            state = states.get(uif_reference, {})
+            recipients = resolved.get(uif_reference, {}).get('recipients', [])
+            if not state or state['completed'] or state['paused'] or not recipients:
+                _finish_retry(retry_id, 'cancelled')
+                summary['cancelled'] += 1
+                continue
+            if sent_any and interval and _wait_interval(interval, stop_event):
+                break
+            if not claim_send(uif_reference, step, campaign):
+                _finish_retry(retry_id, 'cancelled', "Already sent or in flight")
+                summary['cancelled'] += 1
+                continue
+            begin_send_metrics()
+            subject, body = get_email_template(uif_reference, trade_name or '', step)
+            result = send_email_detailed(recipients, subject, body, smtp_password, False, uif_reference, step, record=False)
+            sent_any = True
+            circuit_record(breaker, result['ok'], result.get('provider_error'), result['error'])
+            if result['ok']:
+                record_send_outcome(uif_reference, subject, "Sent", result, step, campaign)
+                _finish_retry(retry_id, 'sent')
+                summary['sent'] += 1
+            elif result['status'] == 'Deferred' and schedule_retry(uif_reference, step, recipients, result['error'], attempts + 1, campaign):
+                record_send_outcome(uif_reference, subject, "Deferred", result, step, campaign)
+                summary['rescheduled'] += 1
+            else:
+                record_send_outcome(uif_reference, subject, "Bounced" if result['status'] == 'Bounced' else "Failed", result, step, campaign)
+                _finish_retry(retry_id, 'failed', result['error'])
+                summary['failed'] += 1
+    flush_log_buffer()
+    return summary
+
+def run_retry_worker(smtp_password, stop_event, status=None, poll_interval=30):
+    """Process the retry queue in the background until `stop_event` is set."""
+    status = status if status is not None else {}
+    status.update({'running': True, 'last_error': None, 'totals': {'sent': 0, 'rescheduled': 0, 'failed': 0, 'cancelled': 0}})
+    while not stop_event.is_set():
+        try:
+            result = process_due_retries(smtp_password, stop_event=stop_event)
+            for key in status['totals']:
+                status['totals'][key] += result[key]
+            status['circuit_open'] = result['circuit_open']
+            status['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        except Exception as e:
+            status['last_error'] = f"{type(e).__name__}: {e}"
+        stop_event.wait(poll_interval)
+    status['running'] = False
+    return status
+
+def get_app_settings():
+    with connect() as conn:
+        return dict(conn.execute("SELECT key, value FROM app_settings").fetchall())
+
+def save_app_settings(values):
+    with connect() as conn:
+        conn.executemany(
+            "INSERT INTO app_settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [(key, str(value)) for key, value in values.items()]
+        )
+        conn.commit()
+
+def get_schedule_settings():
+    """Follow-up cadence (business days) and SAST send window hours, falling back to the defaults."""
+    stored = get_app_settings()
+
+    def _int(key, default):
+        try:
+            return int(stored.get(key, default))
+        except (TypeError, ValueError):
+            return default
+
+    return {
+        'cadence_days': _int('follow_up_cadence_days', FOLLOW_UP_CADENCE_BUSINESS_DAYS),
+        'window_start': _int('send_window_start_hour', SEND_WINDOW_START_HOUR),
+        'window_end': _int('send_window_end_hour', SEND_WINDOW_END_HOUR),
+    }
+
+def now_sast():
+    """Current South African time as a naive datetime, matching the stored timestamp format."""
+    return datetime.now(SAST).replace(tzinfo=None)
+
+def add_business_days(start, days):
+    current = start
+    while days > 0:
+        current += timedelta(days=1)
+        if current.weekday() < 5:
+            days -= 1
+    return current
+
+def _into_send_window(moment, settings):
+    """Return `moment` if it falls inside the weekday send window, else the start of the next window."""
+    window_start = moment.replace(hour=settings['window_start'], minute=0, second=0, microsecond=0)
+    window_end = moment.replace(hour=settings['window_end'], minute=0, second=0, microsecond=0)
+    if moment.weekday() < 5:
+        if window_start <= moment < window_end:
+            return moment
+        if moment < window_start:
+            return window_start
+    return add_business_days(window_start, 1)
+
+def next_due_after(sent_at, settings=None):
+    settings = settings or get_schedule_settings()
+    return _into_send_window(add_business_days(sent_at, settings['cadence_days']), settings)
+
+def is_within_send_window(moment=None, settings=None):
+    settings = settings or get_schedule_settings()
+    moment = moment or now_sast()
+    return _into_send_window(moment, settings) == moment
+
+def _backfill_next_due(conn):
+    """Seed next_due_at from each open company's last successful send when the column is first added."""
+    settings = {
+        'cadence_days': FOLLOW_UP_CADENCE_BUSINESS_DAYS,
+        'window_start': SEND_WINDOW_START_HOUR,
+        'window_end': SEND_WINDOW_END_HOUR,
+    }
+    rows = conn.execute(
+        "SELECT c.UIF_REFERENCE, COALESCE(c.last_sent, MAX(l.timestamp)) FROM companies c "
+        "LEFT JOIN email_logs l ON l.UIF_REFERENCE = c.UIF_REFERENCE AND l.status = 'Sent' "
+        "WHERE COALESCE(c.completed, 0) = 0 GROUP BY c.UIF_REFERENCE"
+    ).fetchall()
+    updates = []
+    for uif_reference, anchor in rows:
+        sent_at = pd.to_datetime(anchor, errors='coerce') if anchor else pd.NaT
+        if pd.notna(sent_at):
+            due_at = next_due_after(sent_at.to_pydatetime(), settings)
+            updates.append((due_at.strftime('%Y-%m-%d %H:%M:%S'), uif_reference))
+    conn.executemany("UPDATE companies SET next_due_at = ? WHERE UIF_REFERENCE = ?", updates)
+
+def set_next_due(uif_refs, sent_at=None):
+    """Move the companies' next follow-up one cadence past `sent_at` (default: now). Returns the due time."""
+    due_at = next_due_after(sent_at or now_sast())
+    with connect() as conn:
+        conn.executemany(
+            "UPDATE companies SET next_due_at = ? WHERE UIF_REFERENCE = ?",
+            [(due_at.strftime('%Y-%m-%d %H:%M:%S'), uif_reference) for uif_reference in uif_refs]
+        )
+        conn.commit()
+    return due_at
+
+# Never-emailed companies have no due date and stay off the automatic path until enrolled or sent to
+_DUE_QUERY = "SELECT {columns} FROM companies WHERE completed = 0 AND paused = 0 AND next_due_at <= ?"
+
+def get_due_companies(limit=DUE_BATCH_SIZE, moment=None):
+    """Open companies whose follow-up is due, most overdue first."""
+    moment = (moment or now_sast()).strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        return pd.read_sql_query(
+            _DUE_QUERY.format(columns="*") + " ORDER BY next_due_at LIMIT ?",
+            conn, params=(moment, limit or -1)
+        )
+
+def enrol_companies(uif_refs=None, due_at=None):
+    """Put never-emailed open companies on the follow-up schedule, due at `due_at` (default: now). Returns how many were enrolled.
+
+    Only companies without a due date are touched; `uif_refs=None` enrols
+    every open company that has never been emailed.
+    """
+    due_at = (due_at or now_sast()).strftime('%Y-%m-%d %H:%M:%S')
+    sql = "UPDATE companies SET next_due_at = ? WHERE next_due_at IS NULL AND completed = 0 AND paused = 0"
+    with connect() as conn:
+        if uif_refs is None:
+            cursor = conn.execute(sql, (due_at,))
+        else:
+            cursor = conn.executemany(sql + " AND UIF_REFERENCE = ?", [(due_at, uif_reference) for uif_reference in uif_refs])
+        conn.commit()
+        return cursor.rowcount
+
+def count_unenrolled_companies():
+    """Open companies that have never been emailed and are not on the follow-up schedule."""
+    with connect() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM companies WHERE next_due_at IS NULL AND completed = 0 AND paused = 0"
+        ).fetchone()[0]
+
+def count_due_companies(moment=None):
+    moment = (moment or now_sast()).strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM ({_DUE_QUERY.format(columns='UIF_REFERENCE')})", (moment,)
+        ).fetchone()[0]
+
+def _deliver_step(uif_reference, trade_name, step, recipients, smtp_password, breaker, dry_run=False, campaign=''):
+    """Render and send one escalation step, then do the post-send bookkeeping.
+
+    Returns ('sent' | 'deferred' | 'failed' | 'skipped', send result). The
+    step is claimed in the send ledger under `campaign` first and skipped if
+    it is already in flight or sent. Transient failures are handed to the
+    retry queue.
+    """
+    if not dry_run and not claim_send(uif_reference, step, campaign):
+        return 'skipped', {'ok': False, 'status': 'Duplicate', 'error': "Already sent or in flight", 'message_id': None}
+    if not dry_run:
+        begin_send_metrics()  # dry runs never reach record_send_outcome, which closes the record
+    subject, body = get_email_template(uif_reference, trade_name or '', step)
+    result = send_email_detailed(recipients, subject, body, smtp_password, dry_run, uif_reference, step, record=False)
+    if dry_run:
+        return ('sent' if result['ok'] else 'failed'), result
+    circuit_record(breaker, result['ok'], result.get('provider_error'), result['error'])
+    if result['ok']:
+        record_send_outcome(uif_reference, subject, "Sent", result, step, campaign)
+        return 'sent', result
+    if result['status'] == 'Deferred' and schedule_retry(uif_reference, step, recipients, result['error'], campaign=campaign):
+        record_send_outcome(uif_reference, subject, "Deferred", result, step, campaign)
+        return 'deferred', result
+    record_send_outcome(uif_reference, subject, "Bounced" if result['status'] == 'Bounced' else "Failed", result, step, campaign)
+    return 'failed', result
+
+def process_due_follow_ups(smtp_password, limit=DUE_BATCH_SIZE, interval=SEND_INTERVAL_SECONDS, stop_event=None, breaker=None):
+    """Send the next escalation step to companies whose follow-up is due. Returns a summary dict.
+
+    Only sends inside the SAST send window. Every attempt moves the company's
+    due date one cadence forward; transient failures go to the retry queue,
+    which then owns that step. Companies leased by another session are skipped.
+    """
+    summary = {'sent': 0, 'deferred': 0, 'failed': 0, 'skipped': 0, 'circuit_open': False, 'outside_window': False}
+    settings = get_schedule_settings()
+    if not is_within_send_window(settings=settings):
+        summary['outside_window'] = True
+        return summary
+    breaker = breaker or new_circuit_breaker()
+    due = get_due_companies(limit)
+    if due.empty:
+        return summary
+    refs = due['UIF_REFERENCE'].tolist()
+    with company_leases(refs, new_lease_holder('scheduler'), label="Scheduled follow-ups") as leased:
+        states = get_company_states(refs)
+        resolved = resolve_company_recipients(refs)
+        sent_any = False
+        for _, row in due.iterrows():
+            if stop_event is not None and stop_event.is_set():
+                break
+            if breaker['state'] == 'open':
+                summary['circuit_open'] = True
+                break
+            if not is_within_send_window(settings=settings):
+                summary['outside_window'] = True
+                break
+            uif_reference = row['UIF_REFERENCE']
+            state = states.get(uif_reference)
+            step = int(row['emails_sent'] or 0)
+            if uif_reference not in leased or not state or state['completed'] or state['paused'] or state['emails_sent'] != step:
+                # Held by, or just sent from, another session; its send moves the due date on
+                summary['skipped'] += 1
+                continue
+            recipient_info = resolved.get(uif_reference, {})
+            recipients = recipient_info.get('recipients', [])
+            if not recipients:
+                log_email(uif_reference, "N/A", "Skipped - Suppressed" if recipient_info.get('suppressed') else "Skipped - No recipients")
+                set_next_due([uif_reference])
+                summary['skipped'] += 1
+                continue
+            if sent_any and interval and _wait_interval(interval, stop_event):
+                break
+            outcome, _ = _deliver_step(
+                uif_reference, row['TRADE_NAME'], step, recipients, smtp_password, breaker, campaign='scheduled'
+            )
+            if outcome == 'skipped':
+                set_next_due([uif_reference])
+            else:
+                sent_any = True
+            summary[outcome] += 1
+    flush_log_buffer()
+    return summary
+
+def run_follow_up_scheduler(smtp_password, stop_event, status=None, poll_interval=60, breaker_factory=None):
+    """Send due follow-ups in the background until `stop_event` is set."""
+    status = status if status is not None else {}
+    status.update({'running': True, 'last_error': None, 'totals': {'sent': 0, 'deferred': 0, 'failed': 0, 'skipped': 0}})
+    while not stop_event.is_set():
+        try:
+            breaker = breaker_factory() if breaker_factory else None
+            result = process_due_follow_ups(smtp_password, stop_event=stop_event, breaker=breaker)
+            for key in status['totals']:
+                status['totals'][key] += result[key]
+            status['circuit_open'] = result['circuit_open']
+            status['outside_window'] = result['outside_window']
+            status['last_run'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        except Exception as e:
+            status['last_error'] = f"{type(e).__name__}: {e}"
+        stop_event.wait(poll_interval)
+    status['running'] = False
+    return status
+
+def email_step_for_type(email_type, emails_sent):
+    """Map an "Email Type" choice to the escalation step (emails_sent count) to render."""
+    if email_type == "Auto (Based on current count)":
+        return int(emails_sent or 0)
+    if email_type == "Initial Email (Override count)":
+        return 0
+    return int(email_type.split("#")[1].split()[0]) if "#" in email_type else 0
+
+def create_campaign(name, uif_refs, email_type="Auto (Based on current count)", dry_run=False):
+    """Persist a campaign and its per-company items. Returns the campaign id."""
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    uif_refs = list(dict.fromkeys(uif_refs))
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO campaigns (name, email_type, dry_run, status, total, created_at, updated_at) VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (name, email_type, int(bool(dry_run)), len(uif_refs), now, now)
+        )
+        campaign_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT OR IGNORE INTO campaign_items (campaign_id, UIF_REFERENCE) VALUES (?, ?)",
+            [(campaign_id, uif_reference) for uif_reference in uif_refs]
+        )
+        conn.commit()
+    return campaign_id
+
+def get_campaigns(limit=20):
+    with connect() as conn:
+        return pd.read_sql_query("SELECT * FROM campaigns ORDER BY campaign_id DESC LIMIT ?", conn, params=(limit,))
+
+def set_campaign_status(campaign_id, status, error=None):
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with connect() as conn:
+        conn.execute(
+            "UPDATE campaigns SET status = ?, last_error = ?, updated_at = ?, "
+            "started_at = CASE WHEN ? = 'running' THEN COALESCE(started_at, ?) ELSE started_at END, "
+            "finished_at = CASE WHEN ? IN ('completed', 'cancelled') THEN ? ELSE finished_at END "
+            "WHERE campaign_id = ?",
+            (status, error, now, status, now, status, now, campaign_id)
+        )
+        conn.commit()
+
+def get_campaign_progress(campaign_id):
+    """Per-status counts, completion fraction and an ETA based on the measured send rate."""
+    with connect() as conn:
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM campaign_items WHERE campaign_id = ? GROUP BY status", (campaign_id,)
+        ).fetchall())
+        first_attempt, last_attempt = conn.execute(
+            "SELECT MIN(attempted_at), MAX(attempted_at) FROM campaign_items WHERE campaign_id = ? AND attempted_at IS NOT NULL",
+            (campaign_id,)
+        ).fetchone()
+    total = sum(counts.values())
+    pending = counts.get('pending', 0)
+    done = total - pending
+    seconds_per_item = SEND_INTERVAL_SECONDS
+    if done > 1 and first_attempt and last_attempt:
+        elapsed = (datetime.strptime(last_attempt, '%Y-%m-%d %H:%M:%S') - datetime.strptime(first_attempt, '%Y-%m-%d %H:%M:%S')).total_seconds()
+        seconds_per_item = max(1.0, elapsed / (done - 1))
+    return {
+        'counts': counts,
+        'total': total,
+        'done': done,
+        'pending': pending,
+        'fraction': (done / total) if total else 1.0,
+        'eta_seconds': int(pending * seconds_per_item),
+    }
+
+def _finish_campaign_item(item_id, status, step=None, detail=None):
+    with connect() as conn:
+        conn.execute(
+            "UPDATE campaign_items SET status = ?, step = ?, detail = ?, attempted_at = ? WHERE item_id = ?",
+            (status, step, detail, datetime.now().strftime('%Y-%m-%d %H:%M:%S'), item_id)
+        )
+        conn.commit()
+
+_LEASED_ELSEWHERE = "In flight elsewhere"
+
+def _mark_items_leased_elsewhere(conn, campaign_id, holder, item_id=None):
+    """Flag pending items whose company another holder leases, stamped with when that lease was taken.
+
+    The first stamp is kept, so once the lease is released a send the other
+    holder made in the meantime can be recognised and not repeated.
+    """
+    conn.execute(
+        "UPDATE campaign_items SET detail = ?, attempted_at = ("
+        "SELECT strftime('%Y-%m-%d %H:%M:%S', l.acquired_at, 'unixepoch', 'localtime') FROM company_leases l "
+        "WHERE l.UIF_REFERENCE = campaign_items.UIF_REFERENCE) "
+        "WHERE campaign_id = ? AND status = 'pending' AND COALESCE(detail, '') != ? AND (? IS NULL OR item_id = ?) "
+        "AND UIF_REFERENCE IN (SELECT UIF_REFERENCE FROM company_leases WHERE expires_at >= ? AND holder != ?)",
+        (_LEASED_ELSEWHERE, campaign_id, _LEASED_ELSEWHERE, item_id, item_id, time.time(), holder)
+    )
+    conn.commit()
+
+def run_campaign_chunk(campaign_id, smtp_password, chunk_size=CAMPAIGN_CHUNK_SIZE, interval=SEND_INTERVAL_SECONDS, stop_event=None, breaker=None,
+                       lease_holder=None):
+    """Send the next chunk of pending items for a campaign. Returns a summary dict.
+
+    Each item is marked as soon as it is attempted, so a crash or a stop only
+    leaves the untouched items pending and the campaign resumes where it left off.
+    The chunk's companies are leased first. Items another session holds stay
+    pending (counted in `in_flight`) for a later chunk, and are only skipped
+    if that session sent the company an email while it held the lease.
+    """
+    summary = {'sent': 0, 'deferred': 0, 'failed': 0, 'skipped': 0, 'in_flight': 0, 'remaining': 0, 'circuit_open': False}
+    breaker = breaker or new_circuit_breaker()
+    holder = lease_holder or new_lease_holder(f"campaign-{campaign_id}")
+    leased_elsewhere = (
+        "EXISTS (SELECT 1 FROM company_leases l WHERE l.UIF_REFERENCE = i.UIF_REFERENCE AND l.expires_at >= ? AND l.holder != ?)"
+    )
+    with connect() as conn:
+        campaign = conn.execute("SELECT email_type, dry_run FROM campaigns WHERE campaign_id = ?", (campaign_id,)).fetchone()
+        if campaign is None:
+            return summary
+        email_type, dry_run = campaign[0], bool(campaign[1])
+        if dry_run:
+            # Dry runs send nothing, so they neither take leases nor wait for them
+            items = conn.execute(
+                "SELECT i.item_id, i.UIF_REFERENCE, c.TRADE_NAME, i.detail, i.attempted_at "
+                "FROM campaign_items i LEFT JOIN companies c ON c.UIF_REFERENCE = i.UIF_REFERENCE "
+                "WHERE i.campaign_id = ? AND i.status = 'pending' ORDER BY i.item_id LIMIT ?",
+                (campaign_id, chunk_size)
+            ).fetchall()
+        else:
+            _mark_items_leased_elsewhere(conn, campaign_id, holder)
+            items = conn.execute(
+                "SELECT i.item_id, i.UIF_REFERENCE, c.TRADE_NAME, i.detail, i.attempted_at "
+                "FROM campaign_items i LEFT JOIN companies c ON c.UIF_REFERENCE = i.UIF_REFERENCE "
+                f"WHERE i.campaign_id = ? AND i.status = 'pending' AND NOT {leased_elsewhere} ORDER BY i.item_id LIMIT ?",
+                (campaign_id, time.time(), holder, chunk_size)
+            ).fetchall()
+    refs = [item[1] for item in items]
+    leases = contextlib.nullcontext(set(refs)) if dry_run or not items else company_leases(
+        refs, holder, label=f"Campaign #{campaign_id}"
+    )
+    with leases as leased:
+        # Read state after leasing so emails_sent includes anything another session just sent
+        states = get_company_states(refs)
+        resolved = resolve_company_recipients(refs)
+        sent_any = False
+        for item_id, uif_reference, trade_name, detail, waited_since in items:
+            if stop_event is not None and stop_event.is_set():
+                break
+            if breaker['state'] == 'open':
+                summary['circuit_open'] = True
+                break
+            if uif_reference not in leased:
+                # Leased by another session since the chunk was read; try again in a later chunk
+                with connect() as conn:
+                    _mark_items_leased_elsewhere(conn, campaign_id, holder, item_id)
+                continue
+            state = states.get(uif_reference)
+            if state and detail == _LEASED_ELSEWHERE and waited_since and (state['last_sent'] or '') >= waited_since:
+                _finish_campaign_item(item_id, 'skipped', detail="Sent by another session")
+                summary['skipped'] += 1
+                continue
+            recipient_info = resolved.get(uif_reference, {})
+            recipients = recipient_info.get('recipients', [])
+            if not state or state['completed'] or state['paused'] or not recipients:
+                if not state:
+                    reason = "Unknown company"
+                elif state['completed']:
+                    reason = "Completed"
+                elif state['paused']:
+                    reason = "Paused"
+                else:
+                    reason = "Suppressed" if recipient_info.get('suppressed') else "No recipients"
+                _finish_campaign_item(item_id, 'skipped', detail=reason)
+                if state and not dry_run:
+                    log_email(uif_reference, "N/A", f"Skipped - {reason}")
+                summary['skipped'] += 1
+                continue
+            if sent_any and interval and not dry_run and _wait_interval(interval, stop_event):
+                break
+            step = email_step_for_type(email_type, state['emails_sent'])
+            outcome, result = _deliver_step(
+                uif_reference, trade_name, step, recipients, smtp_password, breaker, dry_run, campaign=f"campaign:{campaign_id}"
+            )
+            sent_any = sent_any or outcome != 'skipped'
+            _finish_campaign_item(item_id, outcome, step, result['status'] if result['ok'] else result['error'])
+            summary[outcome] += 1
+    flush_log_buffer()
+    with connect() as conn:
+        summary['remaining'] = conn.execute(
+            "SELECT COUNT(*) FROM campaign_items WHERE campaign_id = ? AND status = 'pending'", (campaign_id,)
+        ).fetchone()[0]
+        if not dry_run:
+            summary['in_flight'] = conn.execute(
+                f"SELECT COUNT(*) FROM campaign_items i WHERE i.campaign_id = ? AND i.status = 'pending' AND {leased_elsewhere}",
+                (campaign_id, time.time(), holder)
+            ).fetchone()[0]
+        conn.execute("UPDATE campaigns SET updated_at = ? WHERE campaign_id = ?", (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), campaign_id))
+        conn.commit()
+    return summary
+
+def run_campaign(campaign_id, smtp_password, stop_event, status=None, chunk_size=CAMPAIGN_CHUNK_SIZE, breaker=None,
+                 interval=SEND_INTERVAL_SECONDS, on_chunk=None):
+    """Work through a campaign chunk by chunk until it is done or stopped.
+
+    When the circuit breaker trips, the relay is probed like an inline batch
+    does, and the campaign carries on once it recovers. It is paused only if
+    the relay stays down for the breaker's max pause, or on a stop. The
+    latest probe message is kept in status['circuit_probe'].
+    `on_chunk(summary)` is called after every chunk, e.g. to report progress.
+    """
+    status = status if status is not None else {}
+    status.update({'running': True, 'last_error': None})
+    breaker = breaker or new_circuit_breaker()
+    lease_holder = new_lease_holder(f"campaign-{campaign_id}")
+    set_campaign_status(campaign_id, 'running')
+    try:
+        while not stop_event.is_set():
+            result = run_campaign_chunk(
+                campaign_id, smtp_password, chunk_size, interval, stop_event=stop_event, breaker=breaker, lease_holder=lease_holder
+            )
+            status['last_chunk'] = result
+            if on_chunk:
+                on_chunk(result)
+            if result['circuit_open']:
+                set_campaign_status(campaign_id, 'running', f"Circuit open, probing the relay: {breaker['last_error']}")
+                recovered = circuit_wait_for_recovery(
+                    breaker, smtp_password, stop_event=stop_event,
+                    on_probe=lambda attempt, ok, message, remaining: status.update(circuit_probe=f"#{attempt}: {message}")
+                )
+                if recovered:
+                    set_campaign_status(campaign_id, 'running')
+                    continue
+                set_campaign_status(campaign_id, 'paused', f"Circuit open: {breaker['last_error']}")
+                break
+            if result['remaining'] == 0:
+                set_campaign_status(campaign_id, 'completed')
+                break
+            if result['remaining'] == result['in_flight']:
+                # Everything left is leased by another session: wait for it to finish or for its leases to lapse
+                stop_event.wait(LEASE_HEARTBEAT_SECONDS)
+        else:
+            set_campaign_status(campaign_id, 'paused')
+    except Exception as e:
+        status['last_error'] = f"{type(e).__name__}: {e}"
+        set_campaign_status(campaign_id, 'paused', status['last_error'])
+    status['running'] = False
+    return status
+
+def get_company_states(uif_refs):
+    """Return {UIF_REFERENCE: {'completed', 'paused', 'emails_sent', 'last_sent'}} for the given companies."""
+    states = {}
+    refs = [r for r in uif_refs if r]
+    if not refs:
+        return states
+    try:
+        with connect() as conn:
+            cursor = conn.cursor()
+            # Chunk to stay under SQLite's host parameter limit
+            for start in range(0, len(refs), 500):
+                chunk = refs[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT UIF_REFERENCE, COALESCE(completed, 0), COALESCE(paused, 0), COALESCE(emails_sent, 0), last_sent FROM companies WHERE UIF_REFERENCE IN ({placeholders})",
+                    chunk
+                )
+                for uif, completed, paused, emails_sent, last_sent in cursor.fetchall():
+                    states[uif] = {
+                        'completed': int(completed) == 1, 'paused': int(paused) == 1,
+                        'emails_sent': int(emails_sent), 'last_sent': last_sent,
+                    }
+    except Exception:
+        pass
+    return states
+
+def _message_id_token(uif_reference):
+    """Encode a UIF reference into a Message-ID safe token (reversible)."""
+    if not uif_reference:
+        return None
+    encoded = base64.b32encode(str(uif_reference).encode('utf-8')).decode('ascii').rstrip('=').lower()
+    return f"uif{encoded}"
+
+def _uif_from_message_id(message_id):
+    """Recover the UIF reference from a Message-ID generated by `send_email`, or None."""
+    match = re.search(r'\.uif([a-z2-7]+)@', message_id or '')
+    if not match:
+        return None
+    token = match.group(1).upper()
+    token += '=' * (-len(token) % 8)
+    try:
+        return base64.b32decode(token).decode('utf-8')
+    except Exception:
+        return None
+
+def _extract_message_ids(header_value):
+    return re.findall(r'<[^<>\s]+>', header_value or '')
+
+def _build_sender_map(conn):
+    """Map lowercased recipient addresses (primary + additional) to the companies using them."""
+    sender_map = {}
+    cursor = conn.cursor()
+    cursor.execute("SELECT UIF_REFERENCE, EMAIL_ADDRESS FROM companies WHERE EMAIL_ADDRESS IS NOT NULL AND EMAIL_ADDRESS != ''")
+    rows = cursor.fetchall()
+    cursor.execute("SELECT UIF_REFERENCE, EMAIL FROM company_emails WHERE EMAIL IS NOT NULL AND EMAIL != ''")
+    rows.extend(cursor.fetchall())
+    for uif, addr in rows:
+        # Primary address cells sometimes hold several addresses
+        for candidate in _parse_email_candidates(addr):
+            key = candidate.lower()
+            refs = sender_map.setdefault(key, [])
+            if uif not in refs:
+                refs.append(uif)
+    return sender_map
+
+def _is_automatic_message(headers):
+    """True for auto-replies, out-of-office notices and delivery status notifications."""
+    auto_submitted = (headers.get('Auto-Submitted') or '').strip().lower()
+    if auto_submitted and auto_submitted != 'no':
+        return True
+    if headers.get('X-Autoreply') or headers.get('X-Autorespond'):
+        return True
+    if (headers.get('Precedence') or '').strip().lower() in ('auto_reply', 'bulk', 'junk', 'list'):
+        return True
+    if 'multipart/report' in (headers.get('Content-Type') or '').lower():
+        return True
+    sender = parseaddr(headers.get('From', ''))[1].lower()
+    if sender.split('@')[0] in ('mailer-daemon', 'postmaster'):
+        return True
+    subject = (headers.get('Subject') or '').lower()
+    return subject.startswith(('automatic reply', 'auto reply', 'autoreply', 'out of office'))
+
+def _lookup_message_ids(conn, message_ids):
+    """Resolve Message-IDs to UIF references through the indexed `email_deliveries` table."""
+    found = {}
+    ids = list(dict.fromkeys(message_ids))
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(
+            f"SELECT message_id, UIF_REFERENCE FROM email_deliveries WHERE message_id IN ({placeholders}) AND UIF_REFERENCE IS NOT NULL",
+            chunk
+        ).fetchall()
+        found.update({mid: uif for mid, uif in rows})
+    return found
+
+def match_reply_to_companies(headers, sender_map, known_refs, message_map=None):
+    """Return (uif_refs, matched_by) for an incoming message's headers.
+
+    In-Reply-To and References are checked first because they identify the exact
+    company (via `message_map` from the delivery log, or the UIF token in our
+    Message-IDs); the sender address is used as a fallback and only when unambiguous.
+    """
+    message_map = message_map or {}
+    for header_name, label in (('In-Reply-To', 'in-reply-to'), ('References', 'references')):
+        for mid in _extract_message_ids(headers.get(header_name)):
+            uif = message_map.get(mid) or _uif_from_message_id(mid)
+            if uif and uif in known_refs:
+                return [uif], label
+    senders = [addr.lower() for _, addr in getaddresses([headers.get('From', ''), headers.get('Reply-To', '')]) if addr]
+    for sender in senders:
+        refs = sender_map.get(sender, [])
+        if len(refs) == 1:
+            return refs, 'sender'
+        if len(refs) > 1:
+            return refs, 'sender-ambiguous'
+    return [], None
+
+def apply_reply_matches(matches, action='pause'):
+    """Record reply events and update company state in a single transaction.
+
+    `matches` is a list of dicts with message_id, uif_refs, sender, subject, matched_by, received.
+    `action` is 'pause' (stop follow-ups pending review) or 'complete'.
+    Returns the list of UIF references whose state changed.
+    """
+    if not matches:
+        return []
+    now = datetime.now()
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    date = now.strftime('%Y-%m-%d')
+    column = 'completed' if action == 'complete' else 'paused'
+    status = 'Completed - Replied' if action == 'complete' else 'Paused - Replied'
+    event_rows = []
+    to_update = []
+    for m in matches:
+        refs = m.get('uif_refs') or []
+        actionable = m.get('matched_by') in ('in-reply-to', 'references', 'sender')
+        event_rows.append((
+            m.get('message_id'),
+            ",".join(refs),
+            m.get('sender', ''),
+            m.get('subject', ''),
+            m.get('matched_by') or 'unmatched',
+            status if actionable else 'Review',
+            m.get('received', ''),
+            timestamp,
+        ))
+        if actionable:
+            to_update.extend(refs)
+    changed = []
+    with connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO reply_events (message_id, UIF_REFERENCE, sender, subject, matched_by, action, received, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            event_rows
+        )
+        if to_update:
+            unique_refs = list(dict.fromkeys(to_update))
+            for start in range(0, len(unique_refs), 500):
+                chunk = unique_refs[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(
+                    f"SELECT UIF_REFERENCE FROM companies WHERE UIF_REFERENCE IN ({placeholders}) AND COALESCE(completed, 0) = 0 AND COALESCE({column}, 0) = 0",
+                    chunk
+                )
+                changed.extend(r[0] for r in cursor.fetchall())
+            cursor.executemany(
+                f"UPDATE companies SET {column} = 1 WHERE UIF_REFERENCE = ?",
+                [(uif,) for uif in changed]
+            )
+            cursor.executemany(
+                "INSERT INTO email_logs (UIF_REFERENCE, timestamp, date, subject, status) VALUES (?, ?, ?, ?, ?)",
+                [(uif, timestamp, date, "Reply Received", status) for uif in changed]
+            )
+        conn.commit()
+    return changed
+
+def get_reply_events(uif_ref=None, limit=50):
+    """Return recent reply events, optionally for one company."""
+    with connect() as conn:
+        if uif_ref:
+            return pd.read_sql_query(
+                "SELECT * FROM reply_events WHERE UIF_REFERENCE = ? ORDER BY reply_id DESC LIMIT ?",
+                conn, params=(uif_ref, limit)
+            )
+        return pd.read_sql_query("SELECT * FROM reply_events ORDER BY reply_id DESC LIMIT ?", conn, params=(limit,))
+
+def _is_delivery_report(headers):
+    """True for bounce messages (DSNs) sent back by mail servers."""
+    content_type = (headers.get('Content-Type') or '').lower()
+    if 'multipart/report' in content_type:
+        return True
+    sender = parseaddr(headers.get('From', ''))[1].lower()
+    return sender.split('@')[0] in ('mailer-daemon', 'postmaster')
+
+def parse_bounce_report(message):
+    """Extract failed recipients and the original Message-ID from a DSN.
+
+    Returns ([(recipient, status, diagnostic), ...], original_message_id, original_subject).
+    """
+    failed = []
+    original_id = None
+    original_subject = None
+    for part in message.walk():
+        ctype = part.get_content_type()
+        if ctype == 'message/delivery-status':
+            blocks = part.get_payload()
+            for block in blocks if isinstance(blocks, list) else []:
+                action = (block.get('Action') or '').strip().lower()
+                recipient = block.get('Final-Recipient') or block.get('Original-Recipient') or ''
+                if action == 'failed' and recipient:
+                    failed.append((
+                        recipient.split(';', 1)[-1].strip().strip('<>'),
+                        (block.get('Status') or '').strip(),
+                        ' '.join(str(block.get('Diagnostic-Code', '')).split()),
+                    ))
+        elif ctype in ('text/rfc822-headers', 'message/rfc822') and original_id is None:
+            if ctype == 'message/rfc822':
+                payload = part.get_payload()
+                inner = payload[0] if isinstance(payload, list) and payload else None
+            else:
+                raw = part.get_payload(decode=True) or b''
+                inner = email.message_from_bytes(raw)
+            if inner is not None:
+                original_id = (inner.get('Message-ID') or '').strip() or None
+                original_subject = inner.get('Subject')
+    return failed, original_id, original_subject
+
+def apply_bounce_reports(bounces):
+    """Suppress hard-bounced recipients, mark their deliveries and log a Bounced row per company.
+
+    `bounces` is a list of dicts with recipient, status, diagnostic, message_id, uif_ref, subject.
+    Runs in one transaction. Returns the number of suppressed addresses.
+    """
+    if not bounces:
+        return 0
+    now = datetime.now()
+    timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    date = now.strftime('%Y-%m-%d')
+    entries = []
+    logged = set()
+    with connect() as conn:
+        for b in bounces:
+            status = b.get('status') or ''
+            code_match = re.search(r'\b([45]\d\d)\b', b.get('diagnostic') or '')
+            code = int(code_match.group(1)) if code_match else (550 if status.startswith('5') else 450)
+            hard = status.startswith('5.') and not status.startswith('5.7.')
+            if hard:
+                entries.append((b['recipient'], b.get('diagnostic') or status, b.get('uif_ref'), code))
+            if b.get('message_id'):
+                conn.execute(
+                    "UPDATE email_deliveries SET status = 'Bounced', smtp_code = ?, smtp_response = ? WHERE message_id = ? AND recipient = ?",
+                    (code, b.get('diagnostic') or status, b['message_id'], b['recipient'].lower())
+                )
+            key = (b.get('uif_ref'), b.get('message_id'))
+            if b.get('uif_ref') and key not in logged:
+                logged.add(key)
+                conn.execute(
+                    "INSERT INTO email_logs (UIF_REFERENCE, timestamp, date, subject, status) VALUES (?, ?, ?, ?, ?)",
+                    (b['uif_ref'], timestamp, date, b.get('subject') or 'Delivery Status Notification', 'Bounced')
+                )
+        count = _suppress_in_conn(conn, entries, 'dsn')
+        conn.commit()
+    return count
+
+def _imap_fetch_headers(mail, uids, spec=None):
+    """Fetch reply-matching headers (or the `spec` fetch item) for the given UIDs without marking them as seen."""
+    fields = "FROM REPLY-TO MESSAGE-ID IN-REPLY-TO REFERENCES SUBJECT DATE AUTO-SUBMITTED PRECEDENCE X-AUTOREPLY X-AUTORESPOND CONTENT-TYPE"
+    spec = spec or f"BODY.PEEK[HEADER.FIELDS ({fields})]"
+    results = []
+    for start in range(0, len(uids), REPLY_FETCH_CHUNK):
+        chunk = uids[start:start + REPLY_FETCH_CHUNK]
+        typ, data = mail.uid('FETCH', ",".join(str(u) for u in chunk), f"(UID {spec})")
+        if typ != 'OK' or not data:
+            continue
+        for item in data:
+            if not isinstance(item, tuple) or len(item) < 2:
+                continue
+            uid_match = re.search(rb'UID (\d+)', item[0])
+            headers = email.message_from_bytes(item[1])
+            results.append((int(uid_match.group(1)) if uid_match else 0, headers))
+    return results
+
+def scan_inbox_for_replies(smtp_password, action='pause', since_days=REPLY_LOOKBACK_DAYS, mail=None):
+    """Check INBOX for new replies and bounces, match them to companies and update state in bulk.
+
+    Only messages newer than the last processed UID are fetched (falling back to the
+    last `since_days` days on first run or after a UIDVALIDITY change). Bounce reports
+    feed the recipient suppression list. Returns a summary dict.
+    """
+    summary = {'checked': 0, 'matched': 0, 'updated': [], 'ambiguous': 0, 'ignored': 0, 'bounces': 0, 'suppressed': 0}
+    # Message-ID lookups below read email_deliveries, so land any buffered rows first
+    flush_log_buffer()
+    own_connection = mail is None
+    if own_connection:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+        mail.login(SENDER_EMAIL, smtp_password)
+    try:
+        typ, _ = mail.select('INBOX', readonly=True)
+        if typ != 'OK':
+            raise RuntimeError("Could not select INBOX")
+        uidvalidity = 0
+        try:
+            typ, data = mail.response('UIDVALIDITY')
+            if data and data[0]:
+                uidvalidity = int(data[0])
+        except Exception:
+            uidvalidity = 0
+
+        with connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT uidvalidity, last_uid FROM reply_watch_state WHERE mailbox = 'INBOX'")
+            state = cursor.fetchone()
+            sender_map = _build_sender_map(conn)
+            cursor.execute("SELECT UIF_REFERENCE FROM companies")
+            known_refs = {r[0] for r in cursor.fetchall()}
+
+        if state and state[0] == uidvalidity and state[1]:
+            last_uid = int(state[1])
+            typ, data = mail.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        else:
+            last_uid = 0
+            since = (datetime.now() - timedelta(days=since_days)).strftime('%d-%b-%Y')
+            typ, data = mail.uid('SEARCH', None, f'SINCE {since}')
+        uids = sorted(int(u) for u in (data[0].split() if typ == 'OK' and data and data[0] else []))
+        # `UID n:*` always returns the highest UID even when it is not new
+        uids = [u for u in uids if u > last_uid]
+
+        fetched = _imap_fetch_headers(mail, uids)
+        referenced_ids = []
+        for _, headers in fetched:
+            referenced_ids.extend(_extract_message_ids(headers.get('In-Reply-To')))
+            referenced_ids.extend(_extract_message_ids(headers.get('References')))
+        with connect() as conn:
+            message_map = _lookup_message_ids(conn, referenced_ids)
+
+        matches = []
+        bounce_uids = []
+        own_address = SENDER_EMAIL.lower()
+        for uid, headers in fetched:
+            summary['checked'] += 1
+            last_uid = max(last_uid, uid)
+            sender = parseaddr(headers.get('From', ''))[1].lower()
+            if _is_delivery_report(headers):
+                bounce_uids.append(uid)
+                continue
+            if sender == own_address or _is_automatic_message(headers):
+                summary['ignored'] += 1
+                continue
+            refs, matched_by = match_reply_to_companies(headers, sender_map, known_refs, message_map)
+            if not refs:
+                continue
+            if matched_by == 'sender-ambiguous':
+                summary['ambiguous'] += 1
+            else:
+                summary['matched'] += 1
+            matches.append({
+                'message_id': (headers.get('Message-ID') or '').strip() or f"<uid-{uidvalidity}-{uid}@{IMAP_SERVER}>",
+                'uif_refs': refs,
+                'sender': sender,
+                'subject': str(headers.get('Subject', '')),
+                'matched_by': matched_by,
+                'received': str(headers.get('Date', '')),
+            })
+
+        summary['updated'] = apply_reply_matches(matches, action)
+
+        if bounce_uids:
+            reports = [parse_bounce_report(msg) for _, msg in _imap_fetch_headers(mail, bounce_uids, spec="BODY.PEEK[]")]
+            with connect() as conn:
+                bounce_message_map = _lookup_message_ids(conn, [mid for _, mid, _ in reports if mid])
+            bounces = []
+            for failed, original_id, original_subject in reports:
+                uif = bounce_message_map.get(original_id) or _uif_from_message_id(original_id)
+                for recipient, status, diagnostic in failed:
+                    bounces.append({
+                        'recipient': recipient,
+                        'status': status,
+                        'diagnostic': diagnostic,
+                        'message_id': original_id,
+                        'uif_ref': uif if uif in known_refs else None,
+                        'subject': original_subject,
+                    })
+            summary['bounces'] = len(bounces)
+            summary['suppressed'] = apply_bounce_reports(bounces)
+        with connect() as conn:
+            conn.execute(
+                "INSERT INTO reply_watch_state (mailbox, uidvalidity, last_uid, last_checked) VALUES ('INBOX', ?, ?, ?) "
+                "ON CONFLICT(mailbox) DO UPDATE SET uidvalidity=excluded.uidvalidity, last_uid=excluded.last_uid, last_checked=excluded.last_checked",
+                (uidvalidity, last_uid, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            conn.commit()
+    finally:
+        if own_connection:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+    return summary
+
+def _imap_readline(mail, timeout):
+    """Read one line from the IMAP connection, or return None if none arrives within `timeout` seconds.
+
+    Reading through imaplib's buffered file also returns lines that arrived in
+    the same packet as an earlier one, which a select() on the socket misses.
+    """
+    sock = mail.socket()
+    sock.settimeout(timeout)
+    try:
+        return mail.readline()
+    except socket.timeout:
+        # A socket file refuses further reads after a timeout, so give imaplib a fresh one
+        mail.file = sock.makefile('rb')
+        return None
+
+def _imap_idle_wait(mail, timeout, stop_event=None):
+    """Block in IMAP IDLE until the server announces new mail, `timeout` elapses or `stop_event` is set.
+
+    Returns True when new mail was announced, False otherwise, and None if the
+    server does not support IDLE (callers should fall back to polling). The
+    tagged reply to IDLE is always read, so the connection stays in step.
+    """
+    if 'IDLE' not in getattr(mail, 'capabilities', ()):
+        return None
+    # imaplib's own tags are four capitals and a number, so a lower-case tag cannot clash
+    tag = f"idle{uuid.uuid4().hex[:8]}".encode()
+    sock = mail.socket()
+    previous_timeout = sock.gettimeout()
+    new_mail = False
+    idling = finished = False
+    try:
+        mail.send(tag + b' IDLE\r\n')
+        # Untagged responses may come before the continuation; keep reading until '+' or the tagged reply
+        while not idling:
+            line = _imap_readline(mail, IMAP_REPLY_TIMEOUT)
+            if line is None:
+                raise imaplib.IMAP4.abort("No reply to IDLE")
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(tag + b' '):
+                return None  # refused (NO/BAD): nothing to end
+            if line.startswith(b'+'):
+                idling = True
+            elif re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                new_mail = True
+        deadline = time.monotonic() + timeout
+        while not new_mail and time.monotonic() < deadline and not (stop_event and stop_event.is_set()):
+            line = _imap_readline(mail, min(5.0, max(0.01, deadline - time.monotonic())))
+            if line is None:
+                continue
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(tag + b' '):
+                finished = True  # the server ended IDLE itself
+                break
+            if re.match(rb'\* \d+ (EXISTS|RECENT)', line):
+                new_mail = True
+        if not finished:
+            mail.send(b'DONE\r\n')
+            while True:
+                line = _imap_readline(mail, IMAP_REPLY_TIMEOUT)
+                if line is None:
+                    raise imaplib.IMAP4.abort("No reply to DONE")
+                if not line or line.startswith(tag + b' '):
+                    break
+    finally:
+        sock.settimeout(previous_timeout)
+    return new_mail
+
+def watch_inbox_for_replies(smtp_password, stop_event, action='pause', status=None,
+                            idle_timeout=REPLY_IDLE_TIMEOUT, poll_interval=REPLY_POLL_INTERVAL):
+    """Run reply detection until `stop_event` is set.
+
+    Uses IMAP IDLE when the server supports it and falls back to polling every
+    `poll_interval` seconds otherwise. Progress is written into the `status` dict
+    so the UI can display it; this function never touches Streamlit.
+    """
+    status = status if status is not None else {}
+    status.update({'running': True, 'mode': 'starting', 'last_error': None, 'total_updated': 0})
+    while not stop_event.is_set():
+        mail = None
+        try:
+            mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+            mail.login(SENDER_EMAIL, smtp_password)
+            while not stop_event.is_set():
+                result = scan_inbox_for_replies(smtp_password, action=action, mail=mail)
+                status['last_checked'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                status['total_updated'] += len(result['updated'])
+                status['last_result'] = result
+                idle_result = _imap_idle_wait(mail, idle_timeout, stop_event)
+                if idle_result is None:
+                    status['mode'] = 'polling'
+                    stop_event.wait(poll_interval)
+                else:
+                    status['mode'] = 'idle'
+        except Exception as e:
+            status['last_error'] = f"{type(e).__name__}: {e}"
+            log_send_error('IMAP Reply Watcher', None, SENDER_EMAIL, e)
+            stop_event.wait(min(poll_interval, 60))
+        finally:
+            if mail is not None:
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+    status['running'] = False
+    return status
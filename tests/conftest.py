@@ -0,0 +1,67 @@
+"""Shared fixtures: every test runs core against a fresh scratch database.
+
+core resolves DATABASE_FILE (and the attachment folders) relative to the
+current directory, so each test gets its own temporary working directory.
+"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+import core  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """The core module with the schema created in an empty scratch directory."""
+    monkeypatch.chdir(tmp_path)
+    core.flush_log_buffer()
+    core.init_db()
+    yield core
+    core.flush_log_buffer()
+    # Anything still queued would be flushed at exit into the real database in the repo directory
+    with core.LOG_BUFFER['lock']:
+        core.LOG_BUFFER['groups'] = []
+        core.LOG_BUFFER['rows'] = 0
+        core.LOG_BUFFER['oldest'] = None
+
+
+@pytest.fixture
+def companies(db):
+    """Two open companies with one address each; returns their UIF references."""
+    db.import_companies(pd.DataFrame({
+        'UIF_REFERENCE': ['U0001', 'U0002'],
+        'TRADE_NAME': ['Alpha Traders', 'Beta Holdings'],
+        'EMAIL_ADDRESS': ['alpha@example.com', 'beta@example.com'],
+    }))
+    return ['U0001', 'U0002']
+
+
+@pytest.fixture
+def query(db):
+    """Run a read-only query against the scratch database and return all rows."""
+    def run(sql, params=()):
+        with db.connect() as conn:
+            return conn.execute(sql, params).fetchall()
+    return run
+
+
+@pytest.fixture
+def fake_transport(db, monkeypatch):
+    """Replace the SMTP send with an always-successful stand-in; returns the list of (UIF, step) sent."""
+    sent = []
+
+    def send(recipients, subject, body, smtp_password, dry_run, uif_reference, step, record=True):
+        sent.append((uif_reference, step))
+        return {
+            'ok': True, 'status': 'Sent', 'message_id': f"<{uif_reference}.{step}@test>",
+            'error': None, 'error_class': None, 'provider_error': False,
+        }
+
+    monkeypatch.setattr(db, 'send_email_detailed', send)
+    return sent
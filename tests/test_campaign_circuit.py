@@ -0,0 +1,60 @@
+"""A headless campaign must ride out a transient relay outage instead of pausing for good."""
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def flaky_relay(db, monkeypatch):
+    """First send fails with a provider error, later sends succeed; probes report the relay as healthy."""
+    calls = []
+
+    def send(recipients, subject, body, smtp_password, dry_run, uif_reference, step, record=True):
+        calls.append(uif_reference)
+        if len(calls) == 1:
+            return {'ok': False, 'status': 'Failed', 'message_id': None, 'error': "421 Service not available",
+                    'error_class': 'SMTPConnectError', 'provider_error': True}
+        return {'ok': True, 'status': 'Sent', 'message_id': f"<{uif_reference}@test>",
+                'error': None, 'error_class': None, 'provider_error': False}
+
+    probes = []
+    monkeypatch.setattr(db, 'send_email_detailed', send)
+    monkeypatch.setattr(db, 'test_smtp_connection', lambda password: probes.append(password) or (True, "relay healthy"))
+    return calls, probes
+
+
+def _breaker(db, max_pause):
+    return db.new_circuit_breaker(consecutive_failures=1, probe_interval=0.01, max_pause=max_pause)
+
+
+def test_campaign_resumes_after_the_relay_recovers(db, companies, flaky_relay):
+    calls, probes = flaky_relay
+    campaign_id = db.create_campaign("outage", companies)
+
+    status = db.run_campaign(campaign_id, 'password', threading.Event(), breaker=_breaker(db, 5), interval=0)
+
+    assert probes
+    assert status['circuit_probe'] == "#1: relay healthy"
+    assert calls == ['U0001', 'U0002']
+    campaign = db.get_campaigns().set_index('campaign_id').loc[campaign_id]
+    assert campaign['status'] == 'completed'
+
+
+def test_campaign_pauses_when_stopped_during_the_outage(db, companies, flaky_relay):
+    calls, probes = flaky_relay
+    campaign_id = db.create_campaign("outage", companies)
+    stop = threading.Event()
+    breaker = _breaker(db, 5)
+    breaker['probe_interval'] = 60
+
+    timer = threading.Timer(0.2, stop.set)
+    timer.start()
+    status = db.run_campaign(campaign_id, 'password', stop, breaker=breaker, interval=0)
+    timer.cancel()
+
+    assert not probes
+    assert calls == ['U0001']
+    campaign = db.get_campaigns().set_index('campaign_id').loc[campaign_id]
+    assert campaign['status'] == 'paused'
+    assert campaign['last_error'].startswith("Circuit open")
+    assert not status['running']
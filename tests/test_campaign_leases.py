@@ -0,0 +1,62 @@
+"""Campaign items whose company another session leases must wait, not be written off."""
+
+
+def _items(query, campaign_id):
+    return dict((ref, (status, detail)) for ref, status, detail in query(
+        "SELECT UIF_REFERENCE, status, detail FROM campaign_items WHERE campaign_id = ?", (campaign_id,)
+    ))
+
+
+def test_leased_item_stays_pending_until_released(db, companies, fake_transport, query):
+    campaign_id = db.create_campaign("leases", companies)
+    db.acquire_company_leases(['U0001'], 'other-session', 'Send Emails page')
+
+    first = db.run_campaign_chunk(campaign_id, 'password', interval=0)
+    assert (first['sent'], first['skipped'], first['in_flight'], first['remaining']) == (1, 0, 1, 1)
+    assert _items(query, campaign_id)['U0001'] == ('pending', "In flight elsewhere")
+
+    db.release_company_leases('other-session')
+    second = db.run_campaign_chunk(campaign_id, 'password', interval=0)
+    assert (second['sent'], second['remaining']) == (1, 0)
+    assert sorted(fake_transport) == [('U0001', 0), ('U0002', 0)]
+
+
+def test_item_sent_by_the_lease_holder_is_not_repeated(db, companies, fake_transport, query):
+    campaign_id = db.create_campaign("leases", companies)
+    db.acquire_company_leases(['U0001'], 'other-session', 'Send Emails page')
+    db.run_campaign_chunk(campaign_id, 'password', interval=0)
+
+    # The other session emails U0001 while it holds the lease, then lets go
+    db.record_send_outcome('U0001', "Initial", "Sent", {'message_id': '<other@test>'}, 0, 'manual:test')
+    db.flush_log_buffer()
+    db.release_company_leases('other-session')
+
+    summary = db.run_campaign_chunk(campaign_id, 'password', interval=0)
+    assert (summary['sent'], summary['skipped'], summary['remaining']) == (0, 1, 0)
+    assert _items(query, campaign_id)['U0001'] == ('skipped', "Sent by another session")
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0] == 1
+    assert fake_transport == [('U0002', 0)]
+
+
+def test_run_campaign_waits_for_leased_items(db, companies, fake_transport, monkeypatch):
+    campaign_id = db.create_campaign("leases", companies)
+    db.acquire_company_leases(['U0001'], 'other-session', 'Send Emails page')
+    monkeypatch.setattr(db, 'LEASE_HEARTBEAT_SECONDS', 0.01)
+    waits = []
+
+    class StopAfterWaiting:
+        """Stop event that lets the other session finish during the campaign's first wait."""
+        def is_set(self):
+            return False
+
+        def wait(self, timeout=None):
+            waits.append(timeout)
+            db.release_company_leases('other-session')
+            return False
+
+    status = db.run_campaign(campaign_id, 'password', StopAfterWaiting(), interval=0)
+    assert status['last_error'] is None
+    assert waits
+    progress = db.get_campaign_progress(campaign_id)
+    assert (progress['done'], progress['pending']) == (2, 0)
+    assert sorted(fake_transport) == [('U0001', 0), ('U0002', 0)]
@@ -0,0 +1,20 @@
+"""app.py star-imports core, so __all__ must list exactly core's own public names."""
+import ast
+import inspect
+import types
+
+import core
+
+
+def test_all_lists_every_public_definition_and_no_modules():
+    tree = ast.parse(inspect.getsource(core))
+    defined = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, ast.Assign):
+            defined.update(target.id for target in node.targets if isinstance(target, ast.Name))
+    public = {name for name in defined if not name.startswith('_')}
+    assert set(core.__all__) == public
+    assert len(core.__all__) == len(set(core.__all__))
+    assert not [name for name in core.__all__ if isinstance(getattr(core, name), types.ModuleType)]
@@ -0,0 +1,29 @@
+"""Export caches are keyed on get_data_version, so it must move with every commit, including WAL-only ones."""
+import os
+
+
+def test_version_changes_on_commits_that_only_touch_the_wal(db, companies):
+    with db.connect() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    main_before = os.stat(db.DATABASE_FILE)
+    versions = [db.get_data_version()]
+    for n in range(3):
+        db.log_email('U0001', f"Subject {n}", "Sent")
+        db.flush_log_buffer()
+        versions.append(db.get_data_version())
+
+    main_after = os.stat(db.DATABASE_FILE)
+    assert (main_after.st_mtime_ns, main_after.st_size) == (main_before.st_mtime_ns, main_before.st_size)
+    assert len(set(versions)) == len(versions)
+
+
+def test_export_is_rebuilt_after_a_new_send(db, companies):
+    db.log_email('U0001', "First", "Sent")
+    db.flush_log_buffer()
+    first = db.build_export('email_logs')
+    db.log_email('U0002', "Second", "Sent")
+    db.flush_log_buffer()
+    second = db.build_export('email_logs')
+    assert first != second
+    with open(second, encoding='utf-8') as handle:
+        assert 'Second' in handle.read()
@@ -0,0 +1,39 @@
+"""The automatic follow-up path must never send initial emails to companies nobody chose."""
+import pytest
+
+
+@pytest.fixture
+def window_open(db, monkeypatch):
+    monkeypatch.setattr(db, 'is_within_send_window', lambda moment=None, settings=None: True)
+
+
+def test_never_emailed_companies_are_not_due(db, companies, fake_transport, window_open):
+    assert db.count_due_companies() == 0
+    assert db.get_due_companies().empty
+    summary = db.process_due_follow_ups('password', interval=0)
+    assert summary['sent'] == 0
+    assert fake_transport == []
+    # init_db's seeded test company is covered too
+    assert db.count_unenrolled_companies() == 3
+
+
+def test_enrolled_company_gets_its_initial_email_then_moves_on(db, companies, fake_transport, window_open, query):
+    assert db.enrol_companies(['U0001']) == 1
+    assert db.enrol_companies(['U0001']) == 0  # already scheduled
+    assert db.get_due_companies()['UIF_REFERENCE'].tolist() == ['U0001']
+
+    summary = db.process_due_follow_ups('password', interval=0)
+    assert summary['sent'] == 1
+    assert fake_transport == [('U0001', 0)]
+    assert db.count_due_companies() == 0
+    next_due = query("SELECT next_due_at FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0]
+    assert next_due > db.now_sast().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def test_enrol_all_new_skips_scheduled_and_closed_companies(db, companies, query):
+    db.set_next_due(['U0001'])
+    with db.connect() as conn:
+        conn.execute("UPDATE companies SET completed = 1 WHERE UIF_REFERENCE = 'U0002'")
+        conn.commit()
+    assert db.enrol_companies() == 1  # only the seeded test company is left
+    assert query("SELECT COUNT(*) FROM companies WHERE next_due_at IS NULL")[0][0] == 1
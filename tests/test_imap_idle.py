@@ -0,0 +1,97 @@
+"""IMAP IDLE against a scripted server on a socket pair: no lost notifications, no stray tagged replies."""
+import socket
+import threading
+import time
+
+import pytest
+
+import core
+
+
+class FakeImap:
+    """The slice of imaplib.IMAP4 that _imap_idle_wait uses, over a real socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        self.capabilities = ('IMAP4REV1', 'IDLE')
+
+    def socket(self):
+        return self.sock
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        return self.file.readline()
+
+
+@pytest.fixture
+def imap():
+    """(client, run_server): run_server(script) answers IDLE in a thread and records what the client sent."""
+    client_sock, server_sock = socket.socketpair()
+    server_file = server_sock.makefile('rb')
+    received = []
+    threads = []
+
+    def run_server(reply, answer_done=True, after=b''):
+        def serve():
+            line = server_file.readline()
+            received.append(line)
+            tag = line.split(b' ')[0]
+            server_sock.sendall(reply.replace(b'TAG', tag))
+            if answer_done:
+                done = server_file.readline()
+                received.append(done)
+                if done == b'DONE\r\n':
+                    server_sock.sendall(tag + b' OK IDLE terminated\r\n' + after)
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        threads.append(thread)
+        return received
+
+    yield FakeImap(client_sock), run_server
+    for thread in threads:
+        thread.join(timeout=5)
+    client_sock.close()
+    server_sock.close()
+
+
+def test_notification_in_the_same_packet_as_the_continuation_is_seen(imap):
+    mail, run_server = imap
+    received = run_server(b'+ idling\r\n* 4 EXISTS\r\n', after=b'* OK next\r\n')
+    started = time.monotonic()
+    assert core._imap_idle_wait(mail, 30) is True
+    assert time.monotonic() - started < 3
+    assert received[0].startswith(b'idle') and received[0].endswith(b' IDLE\r\n')
+    assert received[1] == b'DONE\r\n'
+    assert mail.readline() == b'* OK next\r\n'  # the tagged OK was drained, nothing more
+
+
+def test_untagged_lines_before_the_continuation_are_read_through(imap):
+    mail, run_server = imap
+    received = run_server(b'* 2 EXISTS\r\n* 1 RECENT\r\n+ idling\r\n', after=b'* OK next\r\n')
+    assert core._imap_idle_wait(mail, 30) is True
+    assert received[1] == b'DONE\r\n'
+    assert mail.readline() == b'* OK next\r\n'
+
+
+def test_quiet_mailbox_times_out_and_the_connection_still_reads(imap):
+    mail, run_server = imap
+    received = run_server(b'+ idling\r\n', after=b'* OK next\r\n')
+    assert core._imap_idle_wait(mail, 0.3) is False
+    assert received[1] == b'DONE\r\n'
+    assert mail.readline() == b'* OK next\r\n'
+
+
+def test_refused_idle_is_not_ended(imap):
+    mail, run_server = imap
+    received = run_server(b'TAG BAD IDLE not allowed now\r\n', answer_done=False)
+    assert core._imap_idle_wait(mail, 30) is None
+    assert len(received) == 1
+
+
+def test_server_without_idle_falls_back_to_polling(imap):
+    mail, _ = imap
+    mail.capabilities = ('IMAP4REV1',)
+    assert core._imap_idle_wait(mail, 30) is None
@@ -0,0 +1,76 @@
+"""A bad buffered row must not take the rest of the group commit down with it."""
+import json
+import sqlite3
+
+
+def _letters(db):
+    with open(db.LOG_DEAD_LETTER_FILE, encoding='utf-8') as handle:
+        return [json.loads(line) for line in handle]
+
+
+def test_poison_row_is_dead_lettered_and_the_rest_written(db, companies, query):
+    assert db.claim_send('U0001', 0, 'manual:test')
+    db.record_send_outcome('U0001', "Initial", "Sent", {'message_id': '<a@test>'}, 0, 'manual:test')
+    db._buffer_rows(logs=[('U0002', 'not', 'enough', 'columns')])  # wrong arity: ProgrammingError
+    dead_before = db.LOG_BUFFER['dead_letters']
+
+    db.flush_log_buffer()
+
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0] == 1
+    assert query("SELECT COUNT(*) FROM email_logs WHERE UIF_REFERENCE = 'U0001' AND status = 'Sent'")[0][0] == 1
+    assert query("SELECT status FROM send_ledger WHERE UIF_REFERENCE = 'U0001'") == [('sent',)]
+    assert db.LOG_BUFFER['dead_letters'] == dead_before + 1
+    assert not db.LOG_BUFFER['groups'] and db.LOG_BUFFER['rows'] == 0
+    letters = _letters(db)
+    assert [list(letter['rows']) for letter in letters] == [['logs']]
+    assert letters[0]['rows']['logs'][0][0] == 'U0002'
+
+
+def test_poison_row_takes_its_whole_send_unit_with_it(db, companies, query):
+    """A send's log, counter and ledger rows are queued together and never split by the fallback."""
+    assert db.claim_send('U0001', 0, 'manual:test')
+    db.record_send_outcome('U0002', "Initial", "Sent", {'message_id': '<b@test>'})
+    db._buffer_rows(
+        logs=[('U0001', '2025-09-10 10:00:00', '2025-09-10', "Initial", 'Sent')],
+        sent_updates=[('2025-09-10 10:00:00', '2025-09-17 10:00:00', 'U0001')],
+        ledger_updates=[('sent', '<a@test>')],  # wrong arity: ProgrammingError
+    )
+
+    db.flush_log_buffer()
+
+    assert query("SELECT COUNT(*) FROM email_logs WHERE UIF_REFERENCE = 'U0001'")[0][0] == 0
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0] == 0
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0002'")[0][0] == 1
+    letters = _letters(db)
+    assert len(letters) == 1
+    assert sorted(letters[0]['rows']) == ['ledger_updates', 'logs', 'sent_updates']
+
+
+def test_locked_database_requeues_the_batch(db, companies, query, monkeypatch):
+    db.record_send_outcome('U0001', "Initial", "Sent", {'message_id': '<a@test>'}, 0, 'manual:test')
+
+    def locked(conn, groups):
+        raise sqlite3.OperationalError("database is locked")
+
+    original = db._write_buffered_rows
+    monkeypatch.setattr(db, '_write_buffered_rows', locked)
+    assert db.flush_log_buffer() == 0
+    assert db.LOG_BUFFER['groups'][0]['sent_updates'] and db.LOG_BUFFER['last_error'].startswith('OperationalError')
+
+    monkeypatch.setattr(db, '_write_buffered_rows', original)
+    db.flush_log_buffer()
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0] == 1
+
+
+def test_schema_error_is_dead_lettered_not_requeued_forever(db, companies, query):
+    with db.connect() as conn:
+        conn.execute("DROP TABLE send_metrics")
+    db.record_send_outcome('U0001', "Initial", "Sent", {'message_id': '<a@test>'})
+    db._buffer_rows(metrics=[('<a@test>', 'U0001', 0, 'Sent', 1, 100) + (None,) * (len(db.SEND_METRIC_STAGES) + 1)])
+
+    db.flush_log_buffer()
+
+    assert not db.LOG_BUFFER['groups'] and db.LOG_BUFFER['rows'] == 0
+    assert db.LOG_BUFFER['last_error'].startswith('OperationalError: no such table')
+    assert query("SELECT emails_sent FROM companies WHERE UIF_REFERENCE = 'U0001'")[0][0] == 1
+    assert [list(letter['rows']) for letter in _letters(db)] == [['metrics']]
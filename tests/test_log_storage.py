@@ -0,0 +1,155 @@
+"""Compact log storage: the legacy TEXT tables migrate losslessly behind the
+email_logs/email_error_logs views, and the rollups follow every write."""
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import core
+
+SUBJECT_INITIAL = "UIF Compliance Review – Request for Documents (UIF Ref: U0001)"
+SUBJECT_REMINDER = "Reminder: UIF Compliance Documents (UIF Ref: U0002)"
+TRACEBACK = "Traceback (most recent call last):\n  File \"core.py\", line 1, in send\nSMTPServerDisconnected\n"
+
+LEGACY_LOGS = [
+    (1, 'U0001', '2025-09-10T10:34:44.002592', '2025-09-10', SUBJECT_INITIAL, 'Sent'),
+    (2, 'U0002', '2025-09-11T11:07:18.776795', '2025-09-11', SUBJECT_REMINDER, 'Bounced'),
+    (3, 'U0001', '2025-09-11T23:59:59.999999', '2025-09-11', SUBJECT_INITIAL, 'Failed'),
+    (7, 'U0002', '2025-09-12T08:00:00', '2025-09-12', SUBJECT_REMINDER, 'Sent'),
+    (8, 'U0003', '2025-09-12T08:00:01.5', '2025-09-12', "Queued for later", 'Deferred'),
+    (9, 'U0003', '2025-09-13T09:15:00.000001', '2025-09-13', None, 'Manual note'),
+]
+
+LEGACY_ERRORS = [
+    (1, 'U0001', 'alpha@example.com', 'SMTP Send', '2025-09-18T09:30:52.677616',
+     'SMTPServerDisconnected', 'Connection unexpectedly closed', TRACEBACK),
+    (2, 'U0002', 'beta@example.com', 'IMAP Append to Sent', '2025-09-22T12:15:31.532736',
+     'TimeoutError', 'timed out', None),
+    (5, 'U0001', 'alpha@example.com', 'SMTP Send', '2025-10-06T11:30:20.528009',
+     'SMTPServerDisconnected', 'Connection unexpectedly closed', TRACEBACK),
+]
+
+LEGACY_COMPANIES = [
+    ('U0001', 'Alpha Traders', 'alpha@example.com', 2, '2025-09-11T23:59:59', 0, 0),
+    ('U0002', 'Beta Holdings', 'beta@example.com', 2, '2025-09-12T08:00:00', 1, 0),
+    ('U0003', 'Gamma Foods', 'gamma@example.com', 0, None, 0, 1),
+]
+
+
+def _seconds(value):
+    """The legacy ISO text as the compact tables store it: naive wall clock, truncated to the second."""
+    return pd.Timestamp(value).floor('s').strftime('%Y-%m-%d %H:%M:%S')
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    """A scratch database in the pre-compact layout, migrated by init_db."""
+    monkeypatch.chdir(tmp_path)
+    core.flush_log_buffer()
+    conn = sqlite3.connect(core.DATABASE_FILE)
+    conn.executescript('''
+        CREATE TABLE companies (
+            UIF_REFERENCE TEXT PRIMARY KEY, TRADE_NAME TEXT, EMAIL_ADDRESS TEXT, PHONE TEXT,
+            emails_sent INTEGER DEFAULT 0, last_sent TEXT, completed INTEGER DEFAULT 0,
+            paused INTEGER DEFAULT 0, next_due_at TEXT
+        );
+        CREATE TABLE email_error_logs (
+            error_id INTEGER PRIMARY KEY AUTOINCREMENT, UIF_REFERENCE TEXT, recipient TEXT, stage TEXT,
+            timestamp TEXT, error_type TEXT, error_message TEXT, traceback TEXT
+        );
+        CREATE TABLE email_logs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT, UIF_REFERENCE TEXT, timestamp TEXT, date TEXT,
+            subject TEXT, status TEXT,
+            FOREIGN KEY (UIF_REFERENCE) REFERENCES companies(UIF_REFERENCE)
+        );
+    ''')
+    conn.executemany(
+        "INSERT INTO companies (UIF_REFERENCE, TRADE_NAME, EMAIL_ADDRESS, emails_sent, last_sent, completed, paused) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)", LEGACY_COMPANIES
+    )
+    conn.executemany("INSERT INTO email_logs VALUES (?, ?, ?, ?, ?, ?)", LEGACY_LOGS)
+    conn.executemany("INSERT INTO email_error_logs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", LEGACY_ERRORS)
+    conn.commit()
+    conn.close()
+    core.init_db()
+    yield core
+    core.flush_log_buffer()
+
+
+def _rows(db, sql, params=()):
+    with db.connect() as conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def test_legacy_logs_read_back_identically_through_the_view(legacy_db):
+    tables = dict(_rows(legacy_db, "SELECT name, type FROM sqlite_master WHERE name IN ('email_logs', 'email_error_logs')"))
+    assert tables == {'email_logs': 'view', 'email_error_logs': 'view'}
+
+    migrated = _rows(legacy_db, "SELECT log_id, UIF_REFERENCE, timestamp, date, subject, status FROM email_logs ORDER BY log_id")
+    expected = [(log_id, uif, _seconds(ts), date, subject, status) for log_id, uif, ts, date, subject, status in LEGACY_LOGS]
+    assert migrated == expected
+
+
+def test_legacy_errors_read_back_identically_and_share_tracebacks(legacy_db):
+    migrated = _rows(legacy_db, "SELECT * FROM email_error_logs ORDER BY error_id")
+    expected = [row[:4] + (_seconds(row[4]),) + row[5:] for row in LEGACY_ERRORS]
+    assert migrated == expected
+
+    tracebacks = _rows(legacy_db, "SELECT traceback, occurrences, datetime(first_seen, 'unixepoch'), datetime(last_seen, 'unixepoch') FROM error_tracebacks")
+    assert tracebacks == [(TRACEBACK, 2, _seconds(LEGACY_ERRORS[0][4]), _seconds(LEGACY_ERRORS[2][4]))]
+
+
+def test_instead_of_triggers_write_and_delete_through_the_view(legacy_db):
+    with legacy_db.connect() as conn:
+        conn.execute(
+            "INSERT INTO email_logs (UIF_REFERENCE, timestamp, date, subject, status) VALUES (?, ?, ?, ?, ?)",
+            ('U0003', '2025-10-01T14:05:06.123456', '2025-10-01', "Brand new subject", 'Sent')
+        )
+        conn.execute("DELETE FROM email_logs WHERE log_id = 2")
+
+    rows = _rows(legacy_db, "SELECT log_id, UIF_REFERENCE, timestamp, date, subject, status FROM email_logs ORDER BY log_id")
+    assert [row[0] for row in rows] == [1, 3, 7, 8, 9, 10]  # AUTOINCREMENT carries on after the migrated ids
+    assert rows[-1] == (10, 'U0003', '2025-10-01 14:05:06', '2025-10-01', "Brand new subject", 'Sent')
+    assert _rows(legacy_db, "SELECT COUNT(*) FROM email_log_entries WHERE log_id = 2") == [(0,)]
+
+
+def test_rollups_are_backfilled_from_the_legacy_rows(legacy_db):
+    daily = _rows(legacy_db, "SELECT date, status, count FROM email_log_daily ORDER BY date, status")
+    expected = _rows(legacy_db, "SELECT date, status, COUNT(*) FROM email_logs GROUP BY date, status ORDER BY date, status")
+    assert daily == expected
+    assert legacy_db.get_company_summary() == {'total': 4, 'completed': 1, 'paused': 1, 'active': 2}  # with TEST123456
+
+
+def test_daily_rollup_follows_log_inserts_and_status_changes(db):
+    db.log_email('U0001', SUBJECT_INITIAL, 'Sent')
+    db.log_email('U0002', SUBJECT_REMINDER, 'Sent')
+    db.flush_log_buffer()
+    today = pd.Timestamp.now().strftime('%Y-%m-%d')
+    assert db.get_daily_email_count(today) == 2
+
+    with db.connect() as conn:
+        conn.execute(
+            "UPDATE email_log_entries SET status_id = (SELECT status_id FROM log_statuses WHERE status = 'Bounced') "
+            "WHERE UIF_REFERENCE = 'U0002'"
+        )
+    counts = dict(_rows(db, "SELECT status, count FROM email_log_daily WHERE date = ?", (today,)))
+    assert counts == {'Sent': 1, 'Bounced': 1}
+
+    # Rollups are history: deleting the log rows leaves them alone
+    with db.connect() as conn:
+        conn.execute("DELETE FROM email_logs")
+    assert db.get_daily_email_count(today) == 1
+
+
+def test_company_summary_follows_inserts_updates_and_deletes(db, companies):
+    assert db.get_company_summary() == {'total': 3, 'completed': 0, 'paused': 0, 'active': 3}
+    with db.connect() as conn:
+        conn.execute("UPDATE companies SET completed = 1 WHERE UIF_REFERENCE = 'U0001'")
+        conn.execute("UPDATE companies SET paused = 1 WHERE UIF_REFERENCE = 'U0002'")
+    assert db.get_company_summary() == {'total': 3, 'completed': 1, 'paused': 1, 'active': 1}
+
+    with db.connect() as conn:
+        conn.execute("DELETE FROM companies WHERE UIF_REFERENCE = 'U0001'")
+    summary = db.get_company_summary()
+    recount = _rows(db, "SELECT COUNT(*), SUM(completed = 1), SUM(paused = 1), SUM(completed != 1 AND paused != 1) FROM companies")[0]
+    assert (summary['total'], summary['completed'], summary['paused'], summary['active']) == recount == (2, 0, 1, 1)
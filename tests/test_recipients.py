@@ -0,0 +1,30 @@
+"""Suppressed addresses are never emailed, even when the suppression check itself fails."""
+import sqlite3
+
+import pytest
+
+
+def test_suppressed_address_is_left_out(db, companies):
+    db.add_additional_email('U0001', 'alpha.accounts@example.com')
+    db.suppress_recipients([('alpha@example.com', 'hard bounce', 'U0001', 550)])
+
+    resolved = db.resolve_company_recipients(['U0001', 'U0002'])
+    assert resolved['U0001']['recipients'] == ['alpha.accounts@example.com']
+    assert resolved['U0001']['suppressed'] == ['alpha@example.com']
+    assert resolved['U0002']['recipients'] == ['beta@example.com']
+
+
+def test_failed_suppression_check_sends_nothing(db, companies, fake_transport, monkeypatch):
+    def broken(conn, addresses):
+        raise sqlite3.OperationalError("no such table: suppressed_recipients")
+
+    monkeypatch.setattr(db, '_suppressed_subset', broken)
+    monkeypatch.setattr(db, 'is_within_send_window', lambda moment=None, settings=None: True)
+    db.enrol_companies(['U0001'])
+
+    with pytest.raises(sqlite3.OperationalError):
+        db.resolve_company_recipients(['U0001'])
+    with pytest.raises(sqlite3.OperationalError):
+        db.process_due_follow_ups('password', interval=0)
+    assert fake_transport == []
+    assert db.get_company_leases() == {}  # the batch's leases were released on the way out
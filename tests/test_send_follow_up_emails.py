@@ -0,0 +1,49 @@
+"""The Send Emails page batch must email each company at most once, even when it is run twice."""
+import pytest
+
+pytest.importorskip('streamlit')
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+
+def _send_twice_script():
+    """Runs as a Streamlit script: import the page, fake the transport, then send the same selection twice."""
+    import importlib
+
+    import streamlit_option_menu
+    streamlit_option_menu.option_menu = lambda *args, **kwargs: "🏠 Dashboard"
+    import core
+    app = importlib.import_module('app')
+
+    def fake_send(recipients, subject, body, smtp_password, dry_run, uif_reference, step, record=True):
+        return {
+            'ok': True, 'status': 'Sent', 'message_id': f"<{uif_reference}.{step}@test>",
+            'error': None, 'error_class': None, 'provider_error': False,
+        }
+
+    app.send_email_detailed = fake_send
+    app.SEND_INTERVAL_SECONDS = 0
+    for _ in range(2):
+        # Like a rerun or double click: the second pass re-reads the grid, whose emails_sent the first pass incremented
+        selection = core.get_companies_data()
+        selection = selection[selection['UIF_REFERENCE'].isin(['U0001', 'U0002'])].reset_index(drop=True)
+        app.send_follow_up_emails(selection, 'password', False)
+    # Skipped duplicates must not leave a send timing record open for later stages to pile into
+    assert getattr(core._SEND_METRICS, 'current', None) is None
+
+
+def test_second_run_does_not_escalate(companies, query, tmp_path):
+    (tmp_path / 'static').mkdir()
+    (tmp_path / 'static' / 'styles.css').write_text('')
+    app_test = AppTest.from_function(_send_twice_script, default_timeout=120)
+    app_test.run()
+    assert not app_test.exception
+
+    sent = dict(query(
+        "SELECT UIF_REFERENCE, COUNT(*) FROM send_ledger WHERE status = 'sent' GROUP BY UIF_REFERENCE"
+    ))
+    assert sent == {'U0001': 1, 'U0002': 1}
+    counts = dict(query("SELECT UIF_REFERENCE, emails_sent FROM companies WHERE UIF_REFERENCE IN ('U0001', 'U0002')"))
+    assert counts == {'U0001': 1, 'U0002': 1}
+    logged = query("SELECT COUNT(*) FROM email_logs WHERE status = 'Sent'")[0][0]
+    assert logged == 2
+    assert query("SELECT COUNT(*) FROM send_metrics")[0][0] == 2
@@ -0,0 +1,66 @@
+"""Exactly-once ledger: claims, outcome finalisation and stuck-claim release."""
+
+
+def _ledger(query, uif_reference='U0001'):
+    return query(
+        "SELECT step, campaign, status, message_id FROM send_ledger WHERE UIF_REFERENCE = ? ORDER BY step, campaign",
+        (uif_reference,)
+    )
+
+
+def test_second_claim_of_the_same_step_fails(db, companies):
+    assert db.claim_send('U0001', 0, 'manual:test')
+    assert not db.claim_send('U0001', 0, 'manual:test')
+    # Other steps, companies and campaign keys are independent claims
+    assert db.claim_send('U0001', 1, 'manual:test')
+    assert db.claim_send('U0002', 0, 'manual:test')
+    assert db.claim_send('U0001', 0, 'campaign:1')
+
+
+def test_outcome_finalises_the_claim(db, companies, query):
+    assert db.claim_send('U0001', 0, 'manual:test')
+    db.record_send_outcome('U0001', "Initial", "Sent", {'message_id': '<a@test>'}, 0, 'manual:test')
+    db.flush_log_buffer()
+    assert _ledger(query) == [(0, 'manual:test', 'sent', '<a@test>')]
+    assert not db.claim_send('U0001', 0, 'manual:test')
+
+
+def test_failed_and_deferred_claims_can_be_reclaimed(db, companies, query):
+    for outcome, status in (("Failed", 'failed'), ("Deferred", 'deferred')):
+        campaign = f"batch-{status}"
+        assert db.claim_send('U0001', 0, campaign)
+        db.record_send_outcome('U0001', "Initial", outcome, {'message_id': None}, 0, campaign)
+        db.flush_log_buffer()
+        assert query("SELECT status FROM send_ledger WHERE campaign = ?", (campaign,)) == [(status,)]
+        assert db.claim_send('U0001', 0, campaign)
+        assert not db.claim_send('U0001', 0, campaign)
+
+
+def test_single_step_claim_refuses_a_second_step_in_the_same_batch(db, companies):
+    assert db.claim_send('U0001', 0, 'manual:test', single_step=True)
+    assert not db.claim_send('U0001', 1, 'manual:test', single_step=True)
+    assert db.claim_send('U0001', 1, 'manual:other-day', single_step=True)
+
+
+def test_single_step_claim_allows_another_step_after_a_failure(db, companies):
+    assert db.claim_send('U0001', 0, 'manual:test', single_step=True)
+    db.record_send_outcome('U0001', "Initial", "Failed", {'message_id': None}, 0, 'manual:test')
+    db.flush_log_buffer()
+    assert db.claim_send('U0001', 1, 'manual:test', single_step=True)
+
+
+def test_stale_claims_are_listed_and_released(db, companies, query):
+    assert db.claim_send('U0001', 0, 'manual:test')
+    assert db.claim_send('U0002', 0, 'manual:test')
+    assert db.get_stale_claims().empty
+    with db.connect() as conn:
+        conn.execute("UPDATE send_ledger SET claimed_at = '2000-01-01 00:00:00' WHERE UIF_REFERENCE = 'U0001'")
+        conn.commit()
+
+    stale = db.get_stale_claims()
+    assert stale['UIF_REFERENCE'].tolist() == ['U0001']
+    db.release_stale_claims(stale['ledger_id'].tolist())
+    assert _ledger(query)[0][2] == 'failed'
+    assert db.claim_send('U0001', 0, 'manual:test')
+    # A fresh in-flight claim is left alone
+    assert not db.claim_send('U0002', 0, 'manual:test')